@@ -0,0 +1,302 @@
+"""
+Benchmark suite over a synthetic dataset.
+
+Each case runs in a fresh (spawned) process so its peak RSS is not inflated
+by earlier cases, and reports the wall time and peak RSS of its timed call.
+The peak is measured above the RSS after imports and setup, so it is the
+memory the call itself needs, not the interpreter's floor. Results are
+compared against a stored baseline; a case is a regression when it is
+slower or hungrier than the baseline by more than the tolerance.
+
+```
+$ python -m cart.benchmark --scale small -o results.json -b benchmarks/baseline.json
+```
+"""
+
+import argparse
+import contextlib
+import gc
+import glob
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+from multiprocessing import get_context
+from pathlib import Path
+
+from . import __version__, report
+from .synthetic import SCALES, generate
+
+
+DEFAULT_BASELINE = 'benchmarks/baseline.json'
+TIME_TOLERANCE = 0.25
+MEMORY_TOLERANCE = 0.20
+# changes below these are noise whatever the ratio
+MIN_DELTA = {'wall_s': 0.05, 'peak_rss_mb': 16}
+
+
+def main():
+    """
+    run script for the benchmark suite
+    ```
+    $ python -m cart.benchmark --scale small -b benchmarks/baseline.json
+    ```
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark cart on a synthetic dataset")
+    parser.add_argument(
+        "-d", "--data", type=str, default=None,
+        help="existing (synthetic) data root, generated in a temp dir if not given")
+    parser.add_argument(
+        "--scale", type=str, default='small', choices=list(SCALES),
+        help="scale of the generated dataset")
+    parser.add_argument(
+        "-o", "--output", type=str, default=None,
+        help="write results to this json file")
+    parser.add_argument(
+        "-b", "--baseline", type=str, default=DEFAULT_BASELINE,
+        help="baseline json to compare against")
+    parser.add_argument(
+        "--save-baseline", action='store_true',
+        help="store the results as the new baseline")
+    parser.add_argument(
+        "-r", "--repeat", type=int, default=1,
+        help="runs per case, the fastest is kept")
+    parser.add_argument(
+        "--cases", type=str, nargs='+', default=None, choices=list(CASES),
+        help="run only these cases")
+    parser.add_argument(
+        "--time-tolerance", type=float, default=TIME_TOLERANCE,
+        help="allowed relative increase of wall time")
+    parser.add_argument(
+        "--memory-tolerance", type=float, default=MEMORY_TOLERANCE,
+        help="allowed relative increase of peak RSS")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        data = args.data
+        if data is None:
+            data = os.path.join(tmp, 'data')
+            barcodes, genes, tiles = SCALES[args.scale]
+            generate(data, barcodes=barcodes, genes=genes, tiles=tiles)
+        results = run_suite(data, tmp, cases=args.cases, repeat=args.repeat)
+    results['scale'] = None if args.data else args.scale
+    print_results(results)
+
+    if args.output:
+        _write(results, args.output)
+    if args.save_baseline:
+        _write(results, args.baseline)
+        print(f"baseline written to {args.baseline}")
+        return
+    if not os.path.exists(args.baseline):
+        print(f"no baseline at {args.baseline}")
+        return
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get('scale') != results['scale']:
+        print(f"baseline is of scale {baseline.get('scale')}, "
+              f"results of scale {results['scale']}")
+    regressions = compare(
+        results, baseline,
+        time_tolerance=args.time_tolerance,
+        memory_tolerance=args.memory_tolerance)
+    for case, metric, before, after in regressions:
+        print(f"REGRESSION {case} {metric}: {before:.3f} -> {after:.3f}")
+    if regressions:
+        sys.exit(1)
+
+
+def run_suite(data_root, workdir, cases=None, repeat=1):
+    '''
+    run cases (all if None) on the dataset under data_root.
+    returns {'cases': {name: {'wall_s', 'peak_rss_mb', 'setup_rss_mb'}},
+    ...environment}
+    '''
+    results = {}
+    for name in cases or CASES:
+        runs = [run_case(name, data_root, workdir) for _ in range(repeat)]
+        results[name] = {
+            'wall_s': round(min(r['wall_s'] for r in runs), 4),
+            'peak_rss_mb': round(min(r['peak_rss_mb'] for r in runs), 1),
+            'setup_rss_mb': round(min(r['setup_rss_mb'] for r in runs), 1),
+        }
+    return {
+        'version': __version__,
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'cases': results,
+    }
+
+
+def run_case(name, data_root, workdir):
+    '''run one case in a fresh process, returns its wall time and peak rss'''
+    ctx = get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as p:
+        return p.apply(_measure, (name, str(data_root), str(workdir)))
+
+
+def compare(results, baseline, time_tolerance=TIME_TOLERANCE,
+        memory_tolerance=MEMORY_TOLERANCE):
+    '''
+    (case, metric, baseline value, value) of every metric that grew by
+    more than its tolerance (and MIN_DELTA). cases missing from the
+    baseline are skipped
+    '''
+    tolerances = {'wall_s': time_tolerance, 'peak_rss_mb': memory_tolerance}
+    regressions = []
+    for case, metrics in results['cases'].items():
+        before = baseline.get('cases', {}).get(case)
+        if before is None:
+            continue
+        for metric, tolerance in tolerances.items():
+            limit = max(
+                before[metric] * (1 + tolerance),
+                before[metric] + MIN_DELTA[metric])
+            if metrics[metric] > limit:
+                regressions.append(
+                    (case, metric, before[metric], metrics[metric]))
+    return regressions
+
+
+def print_results(results):
+    print(f"{'case':<24}{'wall (s)':>10}{'peak rss (MB)':>16}{'setup rss (MB)':>16}")
+    for case, metrics in results['cases'].items():
+        print(f"{case:<24}{metrics['wall_s']:>10.3f}"
+              f"{metrics['peak_rss_mb']:>16.1f}"
+              f"{metrics.get('setup_rss_mb', float('nan')):>16.1f}")
+
+
+def _write(results, path):
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2)
+
+
+def _measure(name, data_root, workdir):
+    '''
+    pool worker. set up and time one case, silencing its prints. the peak
+    rss of the call is taken above the rss after setup; where the peak
+    can't be reset (no /proc) it is the growth of the lifetime peak
+    '''
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        func = CASES[name](Path(data_root), Path(workdir))
+        gc.collect()
+        if report.reset_peak_rss():
+            setup = report.rss_mb()
+        else:
+            setup = report.peak_rss_mb()
+        start = time.perf_counter()
+        func()
+        wall = time.perf_counter() - start
+    peak = report.peak_rss_mb()
+    return {
+        'wall_s': wall,
+        'peak_rss_mb': max(peak - setup, 0.0),
+        'setup_rss_mb': setup,
+    }
+
+
+# cases take (data root, work dir), do their setup and return the
+# timed call. peak rss covers the call only
+def _tile_files(data_root):
+    tile_dir = sorted(Path(data_root).glob('[0-9]/[0-9][0-9][0-9][0-9]'))[0]
+    return (
+        tile_dir / 'matrix.mtx.gz',
+        tile_dir / 'barcodes.tsv.gz',
+        tile_dir / 'features.tsv.gz')
+
+
+def _read_barcodes(data_root, workdir):
+    from .util import read_barcodes
+    _, barcodes, _ = _tile_files(data_root)
+    return lambda: read_barcodes(barcodes)
+
+
+def _read_features(data_root, workdir):
+    from .util import read_features
+    _, _, features = _tile_files(data_root)
+    return lambda: read_features(features)
+
+
+def _read_matrix(data_root, workdir):
+    from .util import read_matrix
+    matrix, _, _ = _tile_files(data_root)
+    return lambda: read_matrix(matrix)
+
+
+def _read_sparse(data_root, workdir):
+    from .util import read_sparse
+    return lambda: read_sparse(*_tile_files(data_root))
+
+
+def _matrix2gdf(data_root, workdir):
+    from .convert import matrix2gdf
+    return lambda: matrix2gdf(*_tile_files(data_root), dst_crs='epsg:3857')
+
+
+def _convert2gpkg(data_root, workdir):
+    from .convert import convert2gpkg
+    output = workdir / f"benchmark-{os.getpid()}.gpkg"
+    return lambda: convert2gpkg(
+        *_tile_files(data_root), str(output), t_srs='epsg:3857')
+
+
+def _join_inputs(data_root):
+    from .util import read_barcodes, read_features, read_matrix
+    matrix, barcodes, features = _tile_files(data_root)
+    df_barcode = read_barcodes(barcodes, usecols=['x', 'y'])[['x', 'y']]
+    df_feature = read_features(features)[['gene_name']]
+    return read_matrix(matrix), df_barcode, df_feature
+
+
+def _merge_join(data_root, workdir):
+    df_matrix, df_barcode, df_feature = _join_inputs(data_root)
+    return lambda: (df_barcode
+        .merge(df_matrix, on='barcode_id')
+        .merge(df_feature, on='gene_id'))
+
+
+def _gather_join(data_root, workdir):
+    from .util import TileLookup
+    df_matrix, df_barcode, df_feature = _join_inputs(data_root)
+    return lambda: TileLookup(df_barcode, df_feature).join(df_matrix)
+
+
+def _extract_metadata_tiles(data_root, workdir):
+    from .meta import extract_metadata_tiles
+    return lambda: extract_metadata_tiles(data_root)
+
+
+def _xy_to_hexagon(data_root, workdir):
+    from .factor import read_centroid, xy_to_hexagon
+    fit_result = glob.glob(str(data_root / 'analysis' / '*fit_result.tsv.gz'))
+    df = read_centroid(fit_result[0])
+    return lambda: xy_to_hexagon(df, 80)
+
+
+def _factorde_conversion(data_root, workdir):
+    from .factorde import _conversion, read_table
+    df = read_table(data_root / 'analysis' / 'de.tsv.gz')
+    return lambda: _conversion(df, topn=20)
+
+
+CASES = {
+    'read_barcodes': _read_barcodes,
+    'read_features': _read_features,
+    'read_matrix': _read_matrix,
+    'read_sparse': _read_sparse,
+    'matrix2gdf': _matrix2gdf,
+    'convert2gpkg': _convert2gpkg,
+    'merge_join': _merge_join,
+    'gather_join': _gather_join,
+    'extract_metadata_tiles': _extract_metadata_tiles,
+    'xy_to_hexagon': _xy_to_hexagon,
+    'factorde_conversion': _factorde_conversion,
+}
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""
+on-disk cache for parsed sDGE tables
+
+each parsed table is written once as an uncompressed Arrow IPC file and
+memory-mapped on later reads, so gzip and text parsing happen only once
+per source file. an entry is rebuilt when the source file's size or
+mtime changes.
+"""
+
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+
+
+CACHE_FORMAT = '1'
+
+
+def is_cacheable(source):
+    ''' only files on disk can be cached (not in-memory buffers)'''
+    return isinstance(source, (str, os.PathLike))
+
+
+def cache_path(source, cache_dir) -> Path:
+    ''' cache file for source. keyed by the absolute source path'''
+    source = Path(source).resolve()
+    key = hashlib.sha1(str(source).encode()).hexdigest()[:12]
+    stem = source.name.split('.')[0]
+    return Path(cache_dir).expanduser() / f"{stem}-{key}.arrow"
+
+
+def fingerprint(source):
+    ''' size and mtime of source file'''
+    stat = os.stat(source)
+    return {
+        'size': str(stat.st_size),
+        'mtime_ns': str(stat.st_mtime_ns),
+    }
+
+
+def is_fresh(source, cache_dir):
+    ''' check whether a valid cache entry exists for source'''
+    path = cache_path(source, cache_dir)
+    if not path.exists():
+        return False
+    try:
+        with pa.memory_map(str(path)) as f:
+            meta = pa.ipc.open_file(f).schema.metadata or {}
+    except pa.ArrowInvalid:
+        return False
+    expected = dict(fingerprint(source), format=CACHE_FORMAT)
+    return all(
+        meta.get(f"cart.{k}".encode()) == v.encode()
+        for k, v in expected.items())
+
+
+def build(source, cache_dir, chunks):
+    '''
+    write chunks (iterable of dataframes) to the cache entry of source.
+    the file is written to a temporary name and renamed, so concurrent
+    readers never see a partial entry
+    '''
+    path = cache_path(source, cache_dir)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    meta = {
+        f"cart.{k}": v for k, v in
+        dict(fingerprint(source), format=CACHE_FORMAT).items()}
+    writer = None
+    try:
+        for df in chunks:
+            if df.index.name is not None:
+                meta['cart.index'] = df.index.name
+                df = df.reset_index()
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if writer is None:
+                schema = table.schema.with_metadata(meta)
+                writer = pa.ipc.new_file(str(tmp), schema)
+            writer.write_table(table.cast(schema))
+        if writer is None:
+            raise ValueError(f"{source} is empty")
+        writer.close()
+        os.replace(tmp, path)
+    finally:
+        if tmp.exists():
+            tmp.unlink()
+
+
+def read(source, cache_dir, columns=None) -> pd.DataFrame:
+    ''' read cached table of source. columns is a subset to load'''
+    table = _open(source, cache_dir, columns)
+    return _to_pandas(table, 0)
+
+
+def iter_read(source, cache_dir, chunksize, columns=None):
+    ''' yield cached table of source in chunks of chunksize rows'''
+    table = _open(source, cache_dir, columns)
+    for offset in range(0, table.num_rows, chunksize):
+        yield _to_pandas(table.slice(offset, chunksize), offset)
+
+
+def _open(source, cache_dir, columns):
+    path = cache_path(source, cache_dir)
+    table = pa.ipc.open_file(pa.memory_map(str(path))).read_all()
+    index = _index_name(table)
+    if columns is not None:
+        if index is not None and index not in columns:
+            columns = [index] + list(columns)
+        table = table.select(columns)
+    return table
+
+
+def _to_pandas(table, offset):
+    index = _index_name(table)
+    df = table.to_pandas(split_blocks=True)
+    if index is not None:
+        return df.set_index(index)
+    df.index = pd.RangeIndex(offset, offset + len(df))
+    return df
+
+
+def _index_name(table):
+    meta = table.schema.metadata or {}
+    index = meta.get(b'cart.index')
+    return index.decode() if index is not None else None
+
+
+def read_extent(source, cache_dir, columns):
+    ''' cached (xmin, ymin, xmax, ymax) of source, None if missing or stale'''
+    path = cache_path(source, cache_dir).with_suffix('.extent.json')
+    try:
+        with open(path) as f:
+            entry = json.load(f)
+    except (OSError, ValueError):
+        return None
+    expected = dict(fingerprint(source), format=CACHE_FORMAT, columns=columns)
+    if any(entry.get(k) != v for k, v in expected.items()):
+        return None
+    return tuple(entry['extent'])
+
+
+def write_extent(source, cache_dir, extent, columns):
+    ''' cache extent of source computed from columns'''
+    path = cache_path(source, cache_dir).with_suffix('.extent.json')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    entry = dict(
+        fingerprint(source), format=CACHE_FORMAT,
+        columns=columns, extent=list(extent))
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(entry, f)
+    os.replace(tmp, path)
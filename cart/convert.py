@@ -1,49 +1,181 @@
 import argparse
 import os
+import re
 from pathlib import Path
-from multiprocessing import Pool
 import subprocess
+import tempfile
 
 import yaml
+import fiona
+import pyarrow as pa
 import geopandas as gpd
+from pyproj import CRS, Transformer
 
 # from osgeo import gdal
 
 
+from . import cache, manifest, report
+from .schedule import imap_scheduled, parse_size, tile_memory
+from .sort import CURVES, metadata_bounds, sorted_frames
+from .shard import (
+    clear_done, mark_done, parse_shard, select, shard_path)
+from .store import is_gene_store, read_genes
 from .util import (
+    DEFAULT_CHUNKSIZE,
+    point_records,
+    read_chunks,
     read_matrix,
     read_features,
-    read_barcodes
+    read_barcodes,
+    tile_lookup,
 )
 
+# schema of the merged dataset, same fields as the per-tile gpkg
+MERGED_SCHEMA = {
+    'geometry': 'Point',
+    'properties': {
+        'cnt_spliced': 'int32',
+        'cnt_unspliced': 'int32',
+        'cnt_ambiguous': 'int32',
+        'cnt_total': 'int',
+        'gene_name': 'str',
+    },
+}
+MERGED_DRIVERS = {'.fgb': 'FlatGeobuf', '.gpkg': 'GPKG'}
+
+
 def main():
     parser = argparse.ArgumentParser(description="Convert SeqScope data to geographic format")
     parser.add_argument(
-        "-o", "--out", type=str, required=True,
+        "-o", "--out", type=str, default=None,
         help="Output dir")
     parser.add_argument(
         "-m", "--meta", type=str, default='metadata.yaml',
         help="Output dir")
+    parser.add_argument(
+        "-M", "--merged", type=str, default=None,
+        help="write all tiles into one .fgb or .gpkg file instead of per-tile gpkg")
     parser.add_argument(
         "-c", "--cpu", type=int, default=6,
         help="number of processes") 
+    parser.add_argument(
+        "-k", "--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+        help="number of matrix rows processed at once. 0 for whole tile")
+    parser.add_argument(
+        "--cache-dir", type=str, default=None,
+        help="directory for binary cache of parsed sDGE files")
+    parser.add_argument(
+        "--max-memory", type=str, default=None,
+        help="memory budget of concurrently converted tiles, e.g. 64G")
+    parser.add_argument(
+        "--sort", type=str, default=None, choices=CURVES,
+        help="write features in hilbert or zorder order over the dataset bounds")
+    parser.add_argument(
+        "--shard", type=str, default=None,
+        help="convert only shard i of N (i/N, i from 0), merged later with `merge`")
+    parser.add_argument(
+        "-f", "--force", action='store_true',
+        help="convert all tiles, even those up to date in the manifest")
+    parser.add_argument(
+        "--report", type=str, default=None,
+        help="append per-stage timing and memory records to this json-lines file")
     args = parser.parse_args()
+    if args.out is None and args.merged is None:
+        parser.error("either --out or --merged is required")
     with open(args.meta) as f:
         metadata = yaml.safe_load(f)  
-    tiles = list(metadata['tiles'].keys())
-    args_list = map(lambda t: (t, args.out, metadata),tiles)
-    
-    with Pool(args.cpu) as p:
-        p.starmap(convert_single, args_list)
+    shard = parse_shard(args.shard) if args.shard else None
+    with report.run(args.report, 'convert'):
+        if args.merged:
+            convert_merged(
+                metadata, args.merged, cpu=args.cpu,
+                chunksize=args.chunksize, cache_dir=args.cache_dir,
+                max_memory=parse_size(args.max_memory), shard=shard,
+                sort=args.sort)
+            return
+        convert_tiles(
+            metadata, args.out, cpu=args.cpu, chunksize=args.chunksize,
+            cache_dir=args.cache_dir, force=args.force,
+            max_memory=parse_size(args.max_memory), shard=shard,
+            sort=args.sort)
 
 
-def convert_single(lt_id, outdir, metadata):
+def convert_tiles(metadata, outdir, cpu=6, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None, force=False, max_memory=None, shard=None, sort=None):
+    '''
+    convert every tile to {lt_id}.gpkg in outdir, skipping tiles that are
+    up to date in the build manifest (same inputs, false origin, sort and
+    cart version, output untouched). the manifest is saved after each tile,
+    so an interrupted run resumes with the tiles that were not finished.
+    tiles are scheduled largest first within max_memory (bytes, see
+    schedule.imap_scheduled). with shard (index, count) only the tiles
+    of the shard are converted, recorded in the shard's own manifest and
+    marked done at the end (see cart.shard). sort ('hilbert'/'zorder')
+    orders the features of each tile along the curve (see cart.sort).
+    returns the ids of the converted tiles
+    '''
+    Path(outdir).mkdir(parents=True, exist_ok=True)
+    tiles = select(metadata['tiles'], shard)
+    if shard is not None:
+        clear_done(outdir, shard)
+    for lt_id in tiles:
+        for tmp in Path(outdir).glob(f".{lt_id}.*.tmp.gpkg"):
+            # left behind by an interrupted run
+            tmp.unlink()
+    recorded = {}
+    if not force:
+        recorded = manifest.load(outdir)
+        if shard is not None:
+            recorded.update(manifest.load(outdir, shard))
+    entries, jobs = {}, []
+    for lt_id in tiles:
+        metadata_tile = metadata['tiles'][lt_id]
+        entries[lt_id] = manifest.tile_entry(metadata_tile, sort)
+        output = Path(outdir) / f"{lt_id}.gpkg"
+        if manifest.is_up_to_date(entries[lt_id], recorded.get(lt_id), output):
+            print(f"{lt_id} is up to date")
+            continue
+        jobs.append((
+            tile_memory(metadata_tile, chunksize),
+            (lt_id, metadata_tile, outdir, chunksize, cache_dir, sort)))
+    # drop tiles no longer in metadata (or of other shards)
+    recorded = {k: v for k, v in recorded.items() if k in entries}
+
+    converted = []
+    results = imap_scheduled(_convert_tile, jobs, cpu, max_memory)
+    for lt_id, output in results:
+        recorded[lt_id] = dict(
+            entries[lt_id], output=cache.fingerprint(output))
+        manifest.save(outdir, recorded, shard)
+        converted.append(lt_id)
+    manifest.save(outdir, recorded, shard)
+    if shard is not None:
+        mark_done(outdir, shard, tiles)
+    return converted
+
+
+def _convert_tile(args):
+    return args[0], convert_tile(*args)
+
+
+def convert_single(lt_id, outdir, metadata, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None):
     '''read metadata.yaml from data root and convert a single tile'''
+    return convert_tile(
+        lt_id, metadata['tiles'][lt_id], outdir, chunksize, cache_dir)
+
+
+def convert_tile(lt_id, metadata_tile, outdir, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None, sort=None):
+    '''
+    convert a single tile given its own entry of metadata['tiles'].
+    the gpkg is written to a temporary file and renamed when complete,
+    so {lt_id}.gpkg is never left half written. returns the output path
+    '''
     # create outdir if not exist
     Path(outdir).mkdir(parents=True, exist_ok=True)
 
     # prepare data files 
-    metadata_tile = metadata['tiles'][lt_id]
     data_dir = Path(metadata_tile['data_dir'])
     features = data_dir / "features.tsv.gz"
     barcodes = data_dir / "barcodes.tsv.gz"
@@ -52,44 +184,228 @@ def convert_single(lt_id, outdir, metadata):
             metadata_tile['false_easting'], 
             metadata_tile['false_northing'])
     output_path = str(Path(outdir) / f"{lt_id}.gpkg")
+    tmp_path = str(Path(outdir) / f".{lt_id}.{os.getpid()}.tmp.gpkg")
     print(f"output_path:{output_path}")
-    convert2gpkg(
-        matrix, barcodes, features,
-        output=output_path,
-        t_srs=t_srs)
-
-
-def convert2gpkg(matrix, barcodes, features, output: str, t_srs: str):
-    '''convert dataset to gpkg'''
-    gdf = matrix2gdf(matrix, barcodes, features, t_srs)
-    gdf = gdf.drop(['barcode_id', 'gene_id'], axis=1)
-    schema = gpd.io.file.infer_schema(gdf)  # type: ignore
-    int32_fields = ['cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']
-    for f in int32_fields:
-        schema['properties'][f] = 'int32'
-    # gdf.to_file(output, layer=layer, driver=format, schema=schema, index=False)
-    gdf = gdf.to_crs('epsg:3857')  # type:ignore
-    gdf.to_file(output, layer='all', driver='GPKG', schema=schema, index=False)
-    print(f"conversion finisehd at {output}")
-
-
-def matrix2gdf(matrix, barcodes, features, t_srs="epsg:3857") -> gpd.GeoDataFrame:
-    '''convert matrix to long geodataframe with xy info from barcode table'''
-    df_matrix = read_matrix(matrix)
-    df_feature = read_features(features)[['gene_name']]
-    df_barcode = read_barcodes(barcodes)[['x', 'y']]
-    df = (df_barcode
-        .merge(df_matrix, on='barcode_id')
-        .merge(df_feature, on='gene_id')
-    )
-    gdf = (gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.x, df.y))
-        .drop(['x', 'y'], axis=1)
-        .set_crs(t_srs)  # type: ignore
-    )
-    print(gdf.dtypes)
+    try:
+        with report.tile(lt_id) as rec:
+            convert2gpkg(
+                matrix, barcodes, features,
+                output=tmp_path,
+                t_srs=t_srs,
+                chunksize=chunksize,
+                cache_dir=cache_dir,
+                sort=sort,
+                bounds=metadata_bounds({'tiles': {lt_id: metadata_tile}}))
+            rec.read(matrix, barcodes, features)
+            rec.wrote(tmp_path)
+        os.replace(tmp_path, output_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return output_path
+
+
+def convert2gpkg(matrix, barcodes, features, output: str, t_srs: str,
+        chunksize=DEFAULT_CHUNKSIZE, cache_dir=None, sort=None, bounds=None):
+    '''
+    convert dataset to gpkg
+    matrix is written `chunksize` rows at a time (whole tile if 0)
+    so that peak memory is bounded by the chunk size.
+    sort orders features along a curve over epsg:3857 bounds
+    '''
+    if sort:
+        gdfs = _sorted_gdfs(
+            matrix, barcodes, features, t_srs, chunksize, cache_dir,
+            sort, bounds, tmp_dir=Path(output).parent)
+    elif chunksize:
+        gdfs = iter_matrix2gdf(
+            matrix, barcodes, features, t_srs, chunksize, cache_dir,
+            dst_crs='epsg:3857')
+    else:
+        gdfs = [matrix2gdf(
+            matrix, barcodes, features, t_srs, cache_dir,
+            dst_crs='epsg:3857')]
+    mode = 'w'
+    for gdf in gdfs:
+        gdf = gdf.drop(['barcode_id', 'gene_id'], axis=1)
+        schema = gpd.io.file.infer_schema(  # type: ignore
+            gdf.astype({'gene_name': object}))
+        int32_fields = ['cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']
+        for f in int32_fields:
+            schema['properties'][f] = 'int32'
+        # gdf.to_file(output, layer=layer, driver=format, schema=schema, index=False)
+        with report.stage('write', output=output) as rec:
+            gdf.to_file(output, layer='all', driver='GPKG', schema=schema,
+                    index=False, mode=mode)
+            rec.rows(rows_in=len(gdf))
+        mode = 'a'
+
+
+def _sorted_gdfs(matrix, barcodes, features, t_srs, chunksize, cache_dir,
+        sort, bounds, tmp_dir):
+    '''epsg:3857 geodataframes of a tile in curve order'''
+    lookup = tile_lookup(barcodes, features, cache_dir)
+    chunks = read_chunks(matrix, chunksize, cache_dir)
+    frames = (
+        _join_xy(df_matrix, lookup, t_srs, dst_crs='epsg:3857')
+        for df_matrix in chunks)
+    for df in sorted_frames(frames, bounds, sort, tmp_dir=tmp_dir):
+        yield (gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.x, df.y))
+            .drop(['x', 'y'], axis=1)
+            .set_crs('epsg:3857'))
+
+
+def convert_merged(metadata, output, cpu=6, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None, max_memory=None, shard=None, sort=None):
+    '''
+    convert all tiles into a single dataset (layer 'all') in epsg:3857.
+    tiles are converted in a process pool; each worker spills the joined
+    chunks of its tile to a temporary arrow file next to the output, which
+    is appended to one writer in this process batch by batch and removed,
+    so neither the workers nor the writer hold more than a chunk. the
+    spatial index is built once when the writer is closed. tiles are
+    scheduled largest first within max_memory (bytes). with shard (index,
+    count) only the tiles of the shard are written to its partial output
+    and marked done (see cart.shard). sort ('hilbert'/'zorder') writes
+    features along the curve over the bounds of all tiles, through an
+    external merge sort
+    '''
+    driver = MERGED_DRIVERS[Path(output).suffix.lower()]
+    tiles = select(metadata['tiles'], shard)
+    if shard is not None:
+        clear_done(output, shard)
+        final, output = output, shard_path(output, shard)
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    if os.path.exists(output):
+        os.remove(output)
+    with tempfile.TemporaryDirectory(dir=Path(output).parent) as tmp:
+        jobs = [
+            (tile_memory(metadata['tiles'][lt_id], chunksize),
+             (lt_id, metadata['tiles'][lt_id], chunksize, cache_dir, tmp))
+            for lt_id in tiles]
+        with fiona.open(
+                output, 'w', driver=driver, layer='all',
+                schema=MERGED_SCHEMA, crs_wkt=CRS('epsg:3857').to_wkt(),
+                # shard outputs are indexed once by merge
+                SPATIAL_INDEX='YES' if shard is None else 'NO') as dst:
+            results = imap_scheduled(_merged_tile, jobs, cpu, max_memory)
+            frames = _tile_frames(results, output)
+            if sort:
+                frames = sorted_frames(
+                    frames, metadata_bounds(metadata), sort,
+                    tmp_dir=Path(output).parent)
+            with report.tile(Path(output).name):
+                for df in frames:
+                    with report.stage('write', output=output) as rec:
+                        dst.writerecords(point_records(df, MERGED_SCHEMA))
+                        rec.rows(rows_in=len(df))
+    if shard is not None:
+        mark_done(final, shard, tiles)
+
+
+def _tile_frames(results, output):
+    '''frames of the spilled tiles, one record batch at a time'''
+    for lt_id, path in results:
+        if path is not None:
+            reader = pa.ipc.open_file(pa.memory_map(path))
+            for i in range(reader.num_record_batches):
+                yield reader.get_batch(i).to_pandas()
+            del reader
+            os.remove(path)
+        print(f"{lt_id} written to {output}")
+
+
+def _merged_tile(args):
+    '''
+    pool worker for convert_merged. spills the epsg:3857 xy frames of a
+    tile to an arrow file in tmp, returns its path (None if empty)
+    '''
+    lt_id, metadata_tile, chunksize, cache_dir, tmp = args
+    data_dir = Path(metadata_tile['data_dir'])
+    t_srs = shifted_srs(
+            metadata_tile['false_easting'],
+            metadata_tile['false_northing'])
+    path = os.path.join(tmp, f"{lt_id}.arrow")
+    writer = None
+    with report.tile(lt_id):
+        lookup = tile_lookup(
+            data_dir / "barcodes.tsv.gz", data_dir / "features.tsv.gz",
+            cache_dir)
+        chunks = read_chunks(data_dir / "matrix.mtx.gz", chunksize, cache_dir)
+        try:
+            for df_matrix in chunks:
+                df = _join_xy(df_matrix, lookup, t_srs, dst_crs='epsg:3857')
+                with report.stage('spill', output=path):
+                    df['gene_name'] = df['gene_name'].astype(object)
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    if writer is None:
+                        writer = pa.ipc.new_file(path, table.schema)
+                    writer.write_table(table)
+        finally:
+            if writer is not None:
+                writer.close()
+    return lt_id, path if writer is not None else None
+
+
+def matrix2gdf(matrix, barcodes, features, t_srs="epsg:3857",
+        cache_dir=None, dst_crs=None) -> gpd.GeoDataFrame:
+    '''
+    convert matrix to long geodataframe with xy info from barcode table.
+    xy are in t_srs, reprojected to dst_crs if given
+    '''
+    df_matrix, = read_chunks(matrix, 0, cache_dir)
+    lookup = tile_lookup(barcodes, features, cache_dir)
+    return _join_tile(df_matrix, lookup, t_srs, dst_crs)
+
+
+def iter_matrix2gdf(matrix, barcodes, features, t_srs="epsg:3857",
+        chunksize=DEFAULT_CHUNKSIZE, cache_dir=None, dst_crs=None):
+    '''
+    same as matrix2gdf but yields geodataframes of at most `chunksize` rows.
+    barcode xy and gene names are loaded once, matrix is streamed.
+    '''
+    lookup = tile_lookup(barcodes, features, cache_dir)
+    for df_matrix in read_chunks(matrix, chunksize, cache_dir):
+        yield _join_tile(df_matrix, lookup, t_srs, dst_crs)
+
+
+def _join_tile(df_matrix, lookup, t_srs, dst_crs=None):
+    '''join matrix entries with barcode xy and gene names'''
+    df = _join_xy(df_matrix, lookup, t_srs, dst_crs)
+    crs = t_srs if dst_crs is None else dst_crs
+    with report.stage('geometry') as rec:
+        gdf = (gpd.GeoDataFrame(df, geometry=gpd.points_from_xy(df.x, df.y))
+            .drop(['x', 'y'], axis=1)
+            .set_crs(crs)  # type: ignore
+        )
+        rec.rows(len(df), len(gdf))
     return gdf
 
 
+def _join_xy(df_matrix, lookup, t_srs, dst_crs=None):
+    '''
+    join matrix entries with barcode xy and gene names
+    and reproject xy from t_srs to dst_crs if given
+    '''
+    with report.stage('join') as rec:
+        df = lookup.join(df_matrix)
+        rec.rows(len(df_matrix), len(df))
+    if dst_crs is None:
+        return df
+    with report.stage('reproject') as rec:
+        origin = false_origin(t_srs)
+        if origin is not None and is_web_mercator(dst_crs):
+            # pure translation: skip PROJ and shift coordinates
+            df['x'] = df['x'] - origin[0]
+            df['y'] = df['y'] - origin[1]
+        else:
+            transformer = Transformer.from_crs(t_srs, dst_crs, always_xy=True)
+            df['x'], df['y'] = transformer.transform(
+                df['x'].to_numpy(), df['y'].to_numpy())
+        rec.rows(len(df), len(df))
+    return df
+
+
 def shifted_srs(false_easting, false_northing):
     '''shifted srs for epsg:3857'''
     proj =  '+proj=merc +a=6378137 +b=6378137 +lat_ts=0 +lon_0=0 ' +\
@@ -98,6 +414,29 @@ def shifted_srs(false_easting, false_northing):
     return proj
 
 
+def false_origin(srs):
+    '''
+    (false_easting, false_northing) of a crs created by shifted_srs,
+    None for any other crs. such a crs is epsg:3857 translated by
+    the false origin, so x_3857 = x - false_easting
+    '''
+    srs = getattr(srs, 'srs', srs)
+    if not isinstance(srs, str):
+        return None
+    m = re.search(r'\+x_0=(\S+) \+y_0=(\S+) ', srs)
+    if m is None or srs != shifted_srs(m.group(1), m.group(2)):
+        return None
+    try:
+        return float(m.group(1)), float(m.group(2))
+    except ValueError:
+        return None
+
+
+def is_web_mercator(crs):
+    '''check whether crs is epsg:3857'''
+    return CRS.from_user_input(crs).to_epsg() == 3857
+
+
 def filter():
     '''filter merged dataset with marker list'''
     parser = argparse.ArgumentParser()
@@ -115,16 +454,106 @@ def filter():
         help="marker set configuration")
     parser.add_argument(
         "-s", "--singularity", type=str, default=None,
-        help="singularity image")
+        help="singularity image. only used with --ogr2ogr")
+    parser.add_argument(
+        "--ogr2ogr", action='store_true',
+        help="run one ogr2ogr per layer instead of a single in-process pass")
+    parser.add_argument(
+        "--report", type=str, default=None,
+        help="append per-stage timing and memory records to this json-lines file")
     args = parser.parse_args() 
 
     with open(args.marker) as f:
         config = yaml.safe_load(f)
     if os.path.exists(args.output):
         os.remove(args.output)
-    for name, items in config['marker_sets'][args.dataset_name].items():
-        option = make_trans_options(name, items, args.singularity)
-        create_layer(args.input, args.output, option)
+    marker_sets = config['marker_sets'][args.dataset_name]
+    with report.run(args.report, 'filter'):
+        if not args.ogr2ogr:
+            filter_markers(args.input, args.output, marker_sets)
+            return
+        for name, items in marker_sets.items():
+            option = make_trans_options(name, items, args.singularity)
+            create_layer(args.input, args.output, option)
+
+
+def filter_markers(input, output, marker_sets, batch_size=500000):
+    '''
+    write features of each marker set into its own layer of output gpkg
+    in a single pass over input. each gene_name is mapped to the layers
+    it belongs to, so every feature is routed to all its layers at once.
+    routed features are buffered and appended every batch_size features
+    '''
+    if is_gene_store(input):
+        filter_store_markers(input, output, marker_sets)
+        return
+    layers_of = marker_lookup(marker_sets)
+    where = f"gene_name in ({construct_in_clause(','.join(layers_of))})"
+    buffers = {name: [] for name in marker_sets}
+    with report.stage('filter') as rec, fiona.open(input) as src:
+        schema, crs_wkt = src.schema, src.crs_wkt
+        for name in marker_sets:
+            # create every layer, even if no feature matches
+            _append_layer(output, name, [], schema, crs_wkt, 'w')
+        buffered = 0
+        for feature in src.filter(where=where):
+            rec.rows(rows_in=1)
+            for name in layers_of.get(feature['properties']['gene_name'], ()):
+                buffers[name].append(feature)
+                buffered += 1
+            if buffered >= batch_size:
+                rec.rows(rows_out=buffered)
+                _flush_layers(output, buffers, schema, crs_wkt)
+                buffered = 0
+        rec.rows(rows_out=buffered)
+        rec.read(input)
+    _flush_layers(output, buffers, schema, crs_wkt)
+    print(f"filtered layers written to {output}")
+
+
+def filter_store_markers(store_dir, output, marker_sets):
+    '''
+    write each marker layer from a gene store (see split.write_gene_store),
+    reading only the files of the marker genes
+    '''
+    for name, items in marker_sets.items():
+        genes = [g for g in dict.fromkeys(i.strip() for i in items.split(',')) if g]
+        with report.stage('read', tile=name) as rec:
+            gdf = read_genes(store_dir, genes)
+            rec.rows(rows_out=len(gdf))
+        with report.stage('write', tile=name, output=output) as rec:
+            gdf.to_file(output, driver='GPKG', layer=name, index=False)
+            rec.rows(rows_in=len(gdf))
+    print(f"filtered layers written to {output}")
+
+
+def marker_lookup(marker_sets):
+    '''gene_name -> names of marker layers containing the gene'''
+    layers_of = {}
+    for name, items in marker_sets.items():
+        for gene in {i.strip() for i in items.split(',')}:
+            if gene and name not in layers_of.setdefault(gene, []):
+                layers_of[gene].append(name)
+    return layers_of
+
+
+def _flush_layers(output, buffers, schema, crs_wkt):
+    for name, features in buffers.items():
+        if features:
+            _append_layer(output, name, features, schema, crs_wkt, 'a')
+            features.clear()
+
+
+def _append_layer(output, layer, features, schema, crs_wkt, mode):
+    if mode == 'w':
+        dst = fiona.open(
+            output, 'w', driver='GPKG', layer=layer,
+            schema=schema, crs_wkt=crs_wkt)
+    else:
+        dst = fiona.open(output, 'a', layer=layer)
+    with report.stage('write', tile=layer, output=output) as rec, dst:
+        dst.writerecords(features)
+        rec.rows(rows_in=len(features))
 
 
 def make_trans_options(layername, filter_items, singularity):
@@ -153,7 +582,10 @@ def create_layer(input, output, trans_options):
         f"-append -update -nln {trans_options['layerName']} " +\
         f"-where \"{trans_options['where']}\""
     print(command)
-    subprocess.call([command], shell=True)
+    with report.stage(
+            'subprocess', tile=trans_options['layerName'],
+            children=True, output=output):
+        subprocess.call([command], shell=True)
 
 
 def construct_in_clause(items):
@@ -4,10 +4,14 @@ from pathlib import Path
 import re
 
 import yaml
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 from shapely.geometry import Polygon
 
+from . import report
+
 
 def main():
     """
@@ -45,6 +49,9 @@ def main():
     parser.add_argument(
         "-a", "--angle", type=int, default=0,
         help="rotation angle of hexagon")
+    parser.add_argument(
+        "--report", type=str, default=None,
+        help="append per-stage timing and memory records to this json-lines file")
     args = parser.parse_args()
     
     if args.metadata:
@@ -52,14 +59,22 @@ def main():
     else:
         false_easting, false_northing = args.false_easting, args.false_northing
 
-    df = read_centroid(
-        args.input,
-        false_easting=false_easting,
-        false_northing=false_northing,
-        scale=args.scale
-    )
-    gdf = xy_to_hexagon(df, args.radius, args.angle)
-    gdf.to_file(args.output, layer='hexagon', driver="GPKG")
+    with report.run(args.report, 'factor'):
+        with report.stage('read') as rec:
+            df = read_centroid(
+                args.input,
+                false_easting=false_easting,
+                false_northing=false_northing,
+                scale=args.scale
+            )
+            rec.read(args.input)
+            rec.rows(rows_out=len(df))
+        with report.stage('hexagon') as rec:
+            gdf = xy_to_hexagon(df, args.radius, args.angle)
+            rec.rows(len(df), len(gdf))
+        with report.stage('write', output=args.output) as rec:
+            gdf.to_file(args.output, layer='hexagon', driver="GPKG")
+            rec.rows(rows_in=len(gdf))
 
 
 def get_false_origin(file_path, metadata_path):
@@ -82,9 +97,7 @@ def xy_to_hexagon(df, inner_radius, rotation=0):
     to geodataframe with hexagons 
     """
     side = inner_radius * 2 / math.sqrt(3) 
-    df['geometry'] = df.apply(
-        lambda row: create_hexagon(side, row.x, row.y, rotation), 
-        axis=1)
+    df['geometry'] = create_hexagons(side, df['x'], df['y'], rotation)
     gdf = gpd.GeoDataFrame(
         df, geometry=df['geometry']
     ).set_crs('EPSG:3857')
@@ -112,6 +125,30 @@ def read_centroid(
     return df 
 
 
+def create_hexagons(r, x, y, rotation=0):
+    """
+    Create hexagons centered on arrays of (x, y) in one vectorised call.
+    Same vertices as create_hexagon
+    :param r: length of the hexagon's edge
+    :param x: x-coordinates of the hexagons' centers
+    :param y: y-coordinates of the hexagons' centers
+    :return: array of polygons
+    """
+    offsets = hexagon_offsets(r, rotation)
+    centers = np.column_stack([
+        np.asarray(x, dtype=float), np.asarray(y, dtype=float)])
+    coords = centers[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+    return shapely.polygons(coords)
+
+
+def hexagon_offsets(r, rotation=0):
+    """
+    vertex offsets of a hexagon from its center, shape (6, 2)
+    """
+    angles = np.radians(np.arange(0, 360, 60) + rotation)
+    return np.column_stack([np.cos(angles) * r, np.sin(angles) * r])
+
+
 def create_hexagon(r, x, y, rotation=0):
     """
     Create a hexagon centered on (x, y), side-topped when rotation=0 
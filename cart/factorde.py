@@ -2,10 +2,13 @@
 # converts de data to json grouped by factor 
 
 import argparse
-import json
+import io
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+from .util import DEFAULT_CHUNKSIZE
+
 
 def main():
     """
@@ -25,32 +28,85 @@ def main():
     parser.add_argument(
         "-n", "--topn", type=int, default=20,
         help="top n genes. All genes included if n=0")
+    parser.add_argument(
+        "-s", "--sidecar", type=str, default=None,
+        help="also write each factor to SIDECAR/factor-{k}.parquet")
     args = parser.parse_args()
-    conversion(args.input, args.output, args.topn)
+    conversion(args.input, args.output, args.topn, sidecar=args.sidecar)
 
 
-def conversion(input, output, topn):
+def conversion(input, output, topn, sidecar=None, chunksize=DEFAULT_CHUNKSIZE):
     # columns: gene, factor, Chi2, pval, FoldChange, gene_tot
-    df = read_table(input)
-    res_dict = _conversion(df, topn=topn)
+    if topn:
+        # keep only the running top n per factor while reading
+        df = None
+        for chunk in read_table(input, chunksize=chunksize):
+            df = top_genes(chunk if df is None else pd.concat([df, chunk]), topn)
+    else:
+        df = top_genes(read_table(input), topn)
+    groups = iter_factors(df)
+    if sidecar is not None:
+        groups = _with_sidecar(groups, sidecar)
     with open(output, 'w') as f:
-        f.write(res_dict)
+        write_json(f, groups)
 
 
 def _conversion(df, topn=2):
-    res = (df
-        .sort_values(['factor','Chi2'], ascending=False)
-        .groupby('factor')
-        .apply(lambda x: 
-                   x.head(topn).to_dict(orient='records') if topn 
-                   else x.to_dict(orient='records'))
-    ).to_json(indent=2)
-    return res
-
-
-def read_table(tsv_path):
-    """ read de tsv and convert it to dataframe
+    f = io.StringIO()
+    write_json(f, iter_factors(top_genes(df, topn)))
+    return f.getvalue()
+
+
+def top_genes(df, topn):
+    '''rows sorted by factor and descending Chi2, top n per factor (all if 0)'''
+    df = df.sort_values(
+        ['factor', 'Chi2'], ascending=[True, False], kind='mergesort')
+    if topn:
+        df = df.groupby('factor', sort=False).head(topn)
+    return df
+
+
+def iter_factors(df):
+    '''(factor, rows) of a frame sorted by factor'''
+    if df is None or df.empty:
+        return
+    factors = df['factor'].to_numpy()
+    bounds = np.flatnonzero(factors[1:] != factors[:-1]) + 1
+    for start, end in zip(np.r_[0, bounds], np.r_[bounds, len(df)]):
+        yield factors[start], df.iloc[start:end]
+
+
+def write_json(f, groups):
+    '''
+    write {factor: [records]} to f one factor at a time. each factor is
+    encoded by pandas to_json(indent=2), so floats keep its 10 decimals
+    '''
+    first = True
+    for factor, rows in groups:
+        fragment = pd.Series(
+            [rows.to_dict(orient='records')], index=[str(factor)],
+            dtype=object).to_json(indent=2)
+        # drop the enclosing braces, the entry is written into one object
+        f.write(("{\n" if first else ",\n") + fragment[2:-2])
+        first = False
+    f.write("{}" if first else "\n}")
+
+
+def _with_sidecar(groups, sidecar):
+    '''pass groups through, writing each factor to sidecar/factor-{k}.parquet'''
+    sidecar = Path(sidecar)
+    sidecar.mkdir(parents=True, exist_ok=True)
+    for factor, rows in groups:
+        rows.to_parquet(sidecar / f"factor-{factor}.parquet", index=False)
+        yield factor, rows
+
+
+def read_table(tsv_path, chunksize=None):
+    """ read de tsv and convert it to dataframe.
+    with chunksize, an iterator of dataframes of chunksize rows
     """
+    if chunksize:
+        return pd.read_csv(tsv_path, sep="\t", chunksize=chunksize)
     df = pd.DataFrame(pd.read_csv(tsv_path, sep="\t"))  
     return df 
 
@@ -0,0 +1,13 @@
+"""
+filter a merged dataset with marker sets, as a module (see convert.filter)
+
+```
+$ python -m cart.filter -i full_sdge.fgb -o marker.gpkg -m markers.yaml -n DATASET
+```
+"""
+
+from .convert import filter
+
+
+if __name__ == '__main__':
+    filter()
@@ -0,0 +1,75 @@
+"""
+build manifest for incremental conversion
+
+the manifest is a json file next to the output directory with one entry
+per converted tile: fingerprints of its sDGE inputs and of its output,
+its false origin, its sort order and the cart version that wrote it. a tile whose entry
+still matches is up to date and is skipped on the next run.
+"""
+
+import json
+import os
+from pathlib import Path
+
+from . import __version__
+from .cache import fingerprint
+
+
+SDGE_FILES = ['features.tsv.gz', 'barcodes.tsv.gz', 'matrix.mtx.gz']
+
+
+def manifest_path(outdir, shard=None) -> Path:
+    '''
+    manifest of outdir, e.g. output.manifest.json for output/.
+    a shard (index, count) keeps its own output.shard-0-of-4.manifest.json
+    '''
+    outdir = Path(outdir).expanduser().resolve()
+    name = outdir.name
+    if shard is not None:
+        name = f"{name}.shard-{shard[0]}-of-{shard[1]}"
+    return outdir.with_name(f"{name}.manifest.json")
+
+
+def load(outdir, shard=None):
+    ''' tile entries of the manifest of outdir, empty if missing'''
+    try:
+        with open(manifest_path(outdir, shard)) as f:
+            return json.load(f)['tiles']
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def save(outdir, tiles, shard=None):
+    ''' write the manifest atomically (temp file and rename)'''
+    path = manifest_path(outdir, shard)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump({'version': __version__, 'tiles': tiles}, f, indent=1)
+    os.replace(tmp, path)
+
+
+def tile_entry(metadata_tile, sort=None):
+    '''
+    manifest entry of a tile before conversion (without output).
+    sort is the curve the features are ordered along, None if unsorted
+    '''
+    data_dir = Path(metadata_tile['data_dir'])
+    return {
+        'inputs': {
+            name: fingerprint(data_dir / name) for name in SDGE_FILES},
+        'false_easting': metadata_tile['false_easting'],
+        'false_northing': metadata_tile['false_northing'],
+        'sort': sort,
+        'version': __version__,
+    }
+
+
+def is_up_to_date(entry, recorded, output):
+    '''
+    check whether output was written from the same inputs as entry
+    and has not been touched since
+    '''
+    if recorded is None or not os.path.exists(output):
+        return False
+    expected = dict(entry, output=fingerprint(output))
+    return recorded == expected
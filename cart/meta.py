@@ -1,14 +1,19 @@
 """ This module is used for generating metadata yaml for dataset"""
 
 import argparse
+import functools
 import pkgutil
 import io
 from pathlib import Path
+from multiprocessing import Pool
 
 import yaml
+import numpy as np
 import pandas as pd
 
-from .util import read_barcodes
+from . import cache, report
+from .shard import parse_shard, select
+from .util import DEFAULT_CHUNKSIZE, iter_barcodes
 
 
 def main():
@@ -35,61 +40,150 @@ def main():
     parser.add_argument(
         "-g", "--gap", type=int, default=0,
         help="tile layout")
+    parser.add_argument(
+        "-c", "--cpu", type=int, default=1,
+        help="number of processes for scanning tile extents")
+    parser.add_argument(
+        "--cache-dir", type=str, default=None,
+        help="directory for binary cache of parsed sDGE files and tile extents")
+    parser.add_argument(
+        "--shard", type=str, default=None,
+        help="only scan the extents of shard i of N (i/N) into --cache-dir")
+    parser.add_argument(
+        "--report", type=str, default=None,
+        help="append per-stage timing and memory records to this json-lines file")
     args = parser.parse_args()
-
-    metadata = {
-        'dataset': args.name,
-        'data_dir': args.data_dir,
-        'tiles': [],
-    }
-    layout = read_layout(args.layout)
-    tiles = extract_metadata_tiles(args.data_dir, layout=layout, lane_arg=args.lane)
-    Tile.grid_width, Tile.grid_height = _identify_tile_size(tiles)
-    Tile.grid_gap = args.gap
-    Tile.max_row = int(layout['row'].max())   # type: ignore
-    print(f"Grid width: {Tile.grid_width}, height: {Tile.grid_height}")
+    with report.run(args.report, 'meta'):
+        if args.shard:
+            # sharded runs only warm the extent cache, so they leave no
+            # .done marker to merge. a final run without --shard writes
+            # metadata from the cached extents, scanning any still missing
+            if args.cache_dir is None:
+                parser.error("--shard requires --cache-dir")
+            extract_metadata_tiles(
+                args.data_dir, lane_arg=args.lane, cache_dir=args.cache_dir,
+                cpu=args.cpu, shard=parse_shard(args.shard))
+            return
+
+        metadata = {
+            'dataset': args.name,
+            'data_dir': args.data_dir,
+            'tiles': [],
+        }
+        layout = read_layout(args.layout)
+        tiles = extract_metadata_tiles(
+            args.data_dir, layout=layout, lane_arg=args.lane,
+            cache_dir=args.cache_dir, cpu=args.cpu)
+        Tile.grid_width, Tile.grid_height = _identify_tile_size(tiles)
+        Tile.grid_gap = args.gap
+        Tile.max_row = int(layout['row'].max())   # type: ignore
+        print(f"Grid width: {Tile.grid_width}, height: {Tile.grid_height}")
     
-    for _, tile in tiles.items():
-        tile.set_false_origin()
-
-    # required for pyyaml tag issue
-    tile_dict = {key:tile.__dict__ for key, tile in tiles.items()}
-
-    metadata['tiles'] = tile_dict 
-    metadata['number_of_tiles'] = len(metadata['tiles']) 
-    metadata['list_of_tiles'] = sorted(list(tile_dict.keys())) 
-    metadata['tile_layout'] = {
-        'scheme': args.layout,
-        'max_row': Tile.max_row,
-        'grid_gap': Tile.grid_gap,
-        'grid_width': Tile.grid_width,
-        'grid_height': Tile.grid_height
-    }
-    path = Path(args.output)
-    path.parents[0].mkdir(parents=True, exist_ok=True)
-    with open(path, 'w') as file:
-        yaml.dump(metadata, file)
+        for _, tile in tiles.items():
+            tile.set_false_origin()
+
+        # required for pyyaml tag issue
+        tile_dict = {key:tile.__dict__ for key, tile in tiles.items()}
+
+        metadata['tiles'] = tile_dict 
+        metadata['number_of_tiles'] = len(metadata['tiles']) 
+        metadata['list_of_tiles'] = sorted(list(tile_dict.keys())) 
+        metadata['tile_layout'] = {
+            'scheme': args.layout,
+            'max_row': Tile.max_row,
+            'grid_gap': Tile.grid_gap,
+            'grid_width': Tile.grid_width,
+            'grid_height': Tile.grid_height
+        }
+        path = Path(args.output)
+        path.parents[0].mkdir(parents=True, exist_ok=True)
+        with open(path, 'w') as file:
+            yaml.dump(metadata, file)
 
 
 def sdge_to_gcs(lane_id, tile_id, x, y, **kwargs):
     """
     sdge_to_gcs(1, 1112, 123, 456, width=98749, height=20299, layout='hiseq')
     """
-    grid_width = kwargs["width"]
-    grid_height = kwargs["height"]
-    layout  = read_layout(kwargs.get("layout", 'hiseq'))
-    max_row = int(layout['row'].max())  
-    
-    row = int(layout.loc[(lane_id, tile_id)].row)
-    col = int(layout.loc[(lane_id, tile_id)].col)
-    
-    false_easting = -int(grid_width * (col - 1))
-    false_northing = -int( grid_height * (max_row - row))
-    
-    x_gcs = x - false_easting
-    y_gcs = y - false_northing
-    
-    return (x_gcs, y_gcs)
+    x_gcs, y_gcs = sdge_to_gcs_batch(
+        lane_id, tile_id, x, y,
+        kwargs["width"], kwargs["height"],
+        layout=kwargs.get("layout", 'hiseq'))
+    # scalars in, python scalars out; arrays pass through
+    return tuple(v.item() if v.ndim == 0 else v for v in (x_gcs, y_gcs))
+
+
+def sdge_to_gcs_batch(lane_id, tile_id, x, y, width, height,
+        layout='hiseq', gap=0):
+    """
+    vectorised sdge_to_gcs over arrays of lane, tile, x and y
+    x_gcs, y_gcs = sdge_to_gcs_batch(lanes, tiles, xs, ys, 98749, 20299)
+    """
+    index = layout_index(layout)
+    lane_id, tile_id = np.broadcast_arrays(lane_id, tile_id)
+    lanes = np.clip(lane_id, 0, index['row'].shape[0] - 1)
+    tiles = np.clip(tile_id, 0, index['row'].shape[1] - 1)
+    in_range = (lanes == lane_id) & (tiles == tile_id)
+    row = np.where(in_range, index['row'][lanes, tiles], 0)
+    col = np.where(in_range, index['col'][lanes, tiles], 0)
+    if np.any(row == 0):
+        missing = set(zip(lane_id[row == 0].tolist(), tile_id[row == 0].tolist()))
+        raise KeyError(f"tiles not in {layout} layout: {sorted(missing)[:5]}")
+
+    false_easting = -(width + gap) * (col - 1)
+    false_northing = -(height + gap) * (index['max_row'] - row)
+    return np.asarray(x) - false_easting, np.asarray(y) - false_northing
+
+
+def gcs_to_sdge_batch(x_gcs, y_gcs, width, height, layout='hiseq', gap=0):
+    """
+    inverse of sdge_to_gcs_batch. finds the tile containing each point
+    and returns (lane_id, tile_id, x, y) arrays in local tile coordinates.
+    lane_id and tile_id are 0 outside the layout
+    """
+    index = layout_index(layout)
+    x_gcs = np.asarray(x_gcs)
+    y_gcs = np.asarray(y_gcs)
+    col = np.floor_divide(x_gcs, width + gap).astype(np.int64) + 1
+    row = index['max_row'] - np.floor_divide(y_gcs, height + gap).astype(np.int64)
+    inside = (
+        (row >= 1) & (row < index['lane'].shape[0]) &
+        (col >= 1) & (col < index['lane'].shape[1]))
+    row = np.where(inside, row, 0)
+    col = np.where(inside, col, 0)
+    lane_id = index['lane'][row, col]
+    tile_id = index['tile'][row, col]
+
+    false_easting = -(width + gap) * (col - 1)
+    false_northing = -(height + gap) * (index['max_row'] - row)
+    return lane_id, tile_id, x_gcs + false_easting, y_gcs + false_northing
+
+
+@functools.lru_cache(maxsize=None)
+def layout_index(layout='hiseq'):
+    """
+    dense lookup arrays of a layout, loaded once per process.
+    'row'/'col' are indexed by (lane, tile), 'lane'/'tile' by (row, col).
+    0 marks entries that are not in the layout
+    """
+    df = read_layout(layout).reset_index()
+    lane, tile = df['lane'].to_numpy(), df['tile'].to_numpy()
+    row, col = df['row'].to_numpy(), df['col'].to_numpy()
+    index = {
+        'row': np.zeros((lane.max() + 1, tile.max() + 1), dtype=np.int64),
+        'col': np.zeros((lane.max() + 1, tile.max() + 1), dtype=np.int64),
+        'lane': np.zeros((row.max() + 1, col.max() + 1), dtype=np.int64),
+        'tile': np.zeros((row.max() + 1, col.max() + 1), dtype=np.int64),
+        'max_row': int(row.max()),
+    }
+    index['row'][lane, tile] = row
+    index['col'][lane, tile] = col
+    index['lane'][row, col] = lane
+    index['tile'][row, col] = tile
+    for value in index.values():
+        if isinstance(value, np.ndarray):
+            value.setflags(write=False)
+    return index
 
 
 def identify_tile_size(data_dir, lane_id):
@@ -118,28 +212,45 @@ def _identify_tile_size(tiles):
     return width_max, height_max
 
 
-def extract_metadata_tiles(data_root, layout=None, lane_arg=0):
-    ''' loop over data dir and append metadata for each tile'''
-    metadata_tiles = {} 
+def extract_metadata_tiles(
+        data_root, layout=None, lane_arg=0, cache_dir=None, cpu=1,
+        shard=None):
+    '''
+    loop over data dir and append metadata for each tile.
+    tile extents are scanned in a pool of `cpu` processes.
+    with shard (index, count) only the tiles of the shard are scanned
+    '''
     # todo: fix below
     lanes = [1, 2, '1', '2']
     if lane_arg != 0:
         lanes = [lane_arg, str(lane_arg)]
+    args_list = []
     for lane in Path(data_root).iterdir():
        if lane.is_dir() and (lane.stem in lanes):
             for tile in lane.iterdir():
                 if tile.is_dir():
                     if not tile.stem.isdigit(): continue
-                    metadata_tiles[f"{lane.stem}-{tile.stem}"] =\
-                        _metadata_tile(lane, tile, layout)
-    return metadata_tiles
-
-
-def _metadata_tile(lane, tile, layout):
+                    args_list.append((lane, tile, layout, cache_dir))
+    if shard is not None:
+        keys = {f"{lane.stem}-{tile.stem}": i
+                for i, (lane, tile, _, _) in enumerate(args_list)}
+        args_list = [args_list[keys[k]] for k in select(keys, shard)]
+    if cpu > 1:
+        with Pool(cpu) as p:
+            tiles = p.starmap(_metadata_tile, args_list)
+    else:
+        tiles = [_metadata_tile(*args) for args in args_list]
+    return {f"{tile.lane_id}-{tile.tile_id}": tile for tile in tiles}
+
+
+def _metadata_tile(lane, tile, layout, cache_dir=None):
     tile = Tile(int(lane.stem), int(tile.stem), str(tile))
-    if not layout.empty:
+    if layout is not None and not layout.empty:
         tile.set_rowcol(layout)
-    tile.get_extent()
+    with report.tile(f"{tile.lane_id}-{tile.tile_id}"), \
+            report.stage('read') as rec:
+        tile.get_extent(cache_dir=cache_dir)
+        rec.read(Path(tile.data_dir) / 'barcodes.tsv.gz')
     return tile
 
 
@@ -196,15 +307,37 @@ class Tile:
 
     def get_extent(
         self, barcode_file = 'barcodes.tsv.gz',
-        x='x', y='y'):  # pylint: disable=invalid-name
-
-        """ get extent of a tile"""
-        df_barcodes = read_barcodes(Path(self.data_dir) / barcode_file )
-        desc = df_barcodes[[x, y]].describe(percentiles=None)
-        self.xmin = int(desc['x']['min'])
-        self.ymin = int(desc['y']['min'])
-        self.xmax = int(desc['x']['max'])
-        self.ymax = int(desc['y']['max'])
+        x='x', y='y', chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None):  # pylint: disable=invalid-name
+
+        """
+        get extent of a tile, streaming the barcodes in chunks.
+        with cache_dir, the extent is cached until barcode_file changes
+        """
+        barcodes = Path(self.data_dir) / barcode_file
+        extent = None
+        if cache_dir is not None:
+            extent = cache.read_extent(barcodes, cache_dir, columns=[x, y])
+        if extent is None:
+            extent = self._scan_extent(barcodes, x, y, chunksize, cache_dir)
+            if cache_dir is not None:
+                cache.write_extent(barcodes, cache_dir, extent, columns=[x, y])
+        self.xmin, self.ymin, self.xmax, self.ymax = extent
+
+
+    @staticmethod
+    def _scan_extent(barcodes, x, y, chunksize, cache_dir):
+        """ (xmin, ymin, xmax, ymax) in one streaming pass over x, y"""
+        xmin = ymin = xmax = ymax = None
+        chunks = iter_barcodes(
+            barcodes, chunksize=chunksize, usecols=[x, y], cache_dir=cache_dir)
+        for df in chunks:
+            xs, ys = df[x], df[y]
+            xmin = xs.min() if xmin is None else min(xmin, xs.min())
+            ymin = ys.min() if ymin is None else min(ymin, ys.min())
+            xmax = xs.max() if xmax is None else max(xmax, xs.max())
+            ymax = ys.max() if ymax is None else max(ymax, ys.max())
+        return int(xmin), int(ymin), int(xmax), int(ymax)
 
 
 if __name__=='__main__':
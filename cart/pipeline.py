@@ -0,0 +1,431 @@
+"""
+pipeline runner for a whole dataset
+
+the steps of job/all-in-one.sh (meta, convert, filter, vector tiles,
+factor, factor DE, rasterize, hillshade, raster tiles, histology tiles)
+are stages of a DAG built from one yaml config. stages whose dependencies
+are finished run concurrently, as subprocesses, while their cpu and
+memory fit in the budget. a stage is skipped when its command, input
+and output fingerprints match the state recorded when it last succeeded,
+so a rerun only redoes what changed downstream of an edited input.
+
+```
+$ python -m cart.pipeline -c config/pipeline.yaml
+```
+
+```
+dataset: HD30-inj-colon-comb        # marker set name in marker_yaml
+sdge_dir: /path/to/sDGE
+output_dir: /path/to/output
+lane: 2                             # 0 for all lanes
+marker_yaml: config/markers.yaml    # optional
+factor_result: /path/to/fit_result.tsv.gz   # optional
+factor_de: /path/to/DEgene.tsv.gz   # optional
+histology_path: s3://bucket/histology.tif   # optional, local or s3
+container: /path/to/gdal.sif        # optional, for gdal command line tools
+cpu: 8
+max_memory: 64G
+skip: [hillshade]                   # optional, with their dependents
+stages:                             # optional per stage cpu and memory
+  convert: {cpu: 4, memory: 32G}
+```
+
+meta, convert and raster default to a memory estimate from the sizes of
+the sDGE files of their tiles (see schedule.pool_memory), taken when the
+stage is about to start, once metadata.yaml exists. other stages default
+to no memory
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+import yaml
+
+from .cache import fingerprint
+from .schedule import parse_size, pool_memory
+from .util import DEFAULT_CHUNKSIZE
+
+
+STATE_FILE = 'pipeline.state.json'
+# files up to this size are fingerprinted by content
+HASHED_SIZE = 2**20
+MVT_OPTIONS = [
+    '-dsco', 'MINZOOM=9', '-dsco', 'MAXZOOM=12',
+    '-dsco', 'MAX_SIZE=2500000', '-dsco', 'MAX_FEATURES=1500000']
+
+
+def main():
+    """
+    run script for the dataset pipeline
+    ```
+    $ python -m cart.pipeline -c config/pipeline.yaml --dry-run
+    ```
+    """
+    parser = argparse.ArgumentParser(
+        description="Run the cart pipeline of a dataset")
+    parser.add_argument(
+        "-c", "--config", type=str, required=True,
+        help="pipeline yaml")
+    parser.add_argument(
+        "-n", "--dry-run", action='store_true',
+        help="only print the stages that would run")
+    parser.add_argument(
+        "-f", "--force", action='store_true',
+        help="run all stages, even those up to date")
+    parser.add_argument(
+        "--skip", type=str, nargs='+', default=[],
+        help="stages left out, with the stages depending on them")
+    parser.add_argument(
+        "--report", type=str, default=None,
+        help="json-lines report passed to the cart stages (see cart.report)")
+    args = parser.parse_args()
+
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+    config['skip'] = list(config.get('skip', [])) + args.skip
+    if args.report:
+        config['report'] = args.report
+    stages = build_stages(config)
+    status = run_stages(
+        stages, Path(config['output_dir']) / STATE_FILE,
+        cpu=config.get('cpu', os.cpu_count()),
+        max_memory=parse_size(config.get('max_memory')),
+        force=args.force, dry_run=args.dry_run)
+    if any(s in ('failed', 'blocked') for s in status.values()):
+        sys.exit(1)
+
+
+class Stage:
+    '''
+    one step of the pipeline, run as a subprocess. memory is in bytes, or
+    a function returning them when the dependencies of the stage are done
+    '''
+
+    def __init__(self, name, command, inputs=(), outputs=(), deps=(),
+            cpu=1, memory=0):
+        self.name = name
+        self.command = [str(c) for c in command]
+        self.inputs = [str(p) for p in inputs]
+        self.outputs = [str(p) for p in outputs]
+        self.deps = list(deps)
+        self.cpu = cpu
+        self.memory = memory
+
+    def state(self):
+        ''' command and fingerprints recorded after a successful run'''
+        return {
+            'command': self.command,
+            'inputs': {p: path_fingerprint(p) for p in self.inputs},
+            'outputs': {p: path_fingerprint(p) for p in self.outputs},
+        }
+
+    def is_up_to_date(self, recorded):
+        if recorded is None:
+            return False
+        if any(not os.path.exists(p) for p in self.outputs):
+            return False
+        return recorded == self.state()
+
+    def estimate(self):
+        '''resolve a memory function into bytes'''
+        if callable(self.memory):
+            self.memory = self.memory()
+        return self.memory
+
+
+def build_stages(config):
+    '''
+    stages of the pipeline described by config, in dependency order.
+    stages of optional inputs that are not configured are left out, as
+    are the stages in config['skip'] and those depending on them
+    '''
+    out = Path(config['output_dir']).expanduser()
+    vector, raster, tile = out / 'vector', out / 'raster', out / 'tile'
+    metadata = vector / 'metadata.yaml'
+    options = config.get('stages') or {}
+    # cart stages with a process pool get half the cpu budget by default
+    wide = {
+        name: options.get(name, {}).get(
+            'cpu', max(1, config.get('cpu', os.cpu_count()) // 2))
+        for name in ['meta', 'convert', 'raster']}
+    gdal = ['singularity', 'exec', config['container']] \
+        if config.get('container') else []
+    report = ['--report', config['report']] if config.get('report') else []
+    cache = ['--cache-dir', config['cache_dir']] \
+        if config.get('cache_dir') else []
+
+    stages = [
+        Stage('meta',
+            _cart('meta', '-n', config['dataset'], '-d', config['sdge_dir'],
+                '-o', metadata, '-l', config.get('lane', 0),
+                '-c', wide['meta'], *cache, *report),
+            inputs=[config['sdge_dir']], outputs=[metadata], cpu=wide['meta'],
+            memory=lambda: pool_memory(
+                _sdge_tiles(config['sdge_dir'], config.get('lane', 0)),
+                wide['meta'], DEFAULT_CHUNKSIZE)),
+        Stage('convert',
+            _cart('convert', '-m', metadata, '--merged', vector / 'full_sdge.fgb',
+                '-c', wide['convert'], *cache, *report),
+            inputs=[metadata], outputs=[vector / 'full_sdge.fgb'],
+            deps=['meta'], cpu=wide['convert'],
+            memory=lambda: pool_memory(
+                _metadata_tiles(metadata), wide['convert'], DEFAULT_CHUNKSIZE)),
+        Stage('raster',
+            _cart('raster', '-m', metadata, '-r', config.get('resolution', 30),
+                '-o', raster / 'count_sdge.tif', '-c', wide['raster'], *cache),
+            inputs=[metadata], outputs=[raster / 'count_sdge.tif'],
+            deps=['meta'], cpu=wide['raster'],
+            memory=lambda: pool_memory(
+                _metadata_tiles(metadata), wide['raster'], DEFAULT_CHUNKSIZE)),
+        Stage('hillshade',
+            gdal + ['gdaldem', 'hillshade', '-z', '50', '-compute_edges',
+                '-alg', 'Horn', '-igor',
+                raster / 'count_sdge.tif', raster / 'hillshade.tif'],
+            inputs=[raster / 'count_sdge.tif'],
+            outputs=[raster / 'hillshade.tif'], deps=['raster']),
+        Stage('raster_tiles',
+            gdal + ['gdal2tiles.py', '-z', '6-15',
+                raster / 'hillshade.tif', tile / 'raster-count'],
+            inputs=[raster / 'hillshade.tif'],
+            outputs=[tile / 'raster-count'], deps=['hillshade']),
+    ]
+    if config.get('marker_yaml'):
+        stages += [
+            Stage('filter',
+                _cart('filter',
+                    '-i', vector / 'full_sdge.fgb', '-o', vector / 'marker.gpkg',
+                    '-m', config['marker_yaml'], '-n', config['dataset'],
+                    *report),
+                inputs=[vector / 'full_sdge.fgb', config['marker_yaml']],
+                outputs=[vector / 'marker.gpkg'], deps=['convert']),
+            Stage('marker_tiles',
+                gdal + ['ogr2ogr', '-f', 'MVT', tile / 'vector-sdge',
+                    vector / 'marker.gpkg', *MVT_OPTIONS],
+                inputs=[vector / 'marker.gpkg'],
+                outputs=[tile / 'vector-sdge'], deps=['filter']),
+        ]
+    if config.get('factor_result'):
+        factor = config.get('factor', {})
+        if 'false_easting' in factor or 'false_northing' in factor:
+            origin, factor_inputs, factor_deps = [
+                '-x0', factor.get('false_easting', 0),
+                '-y0', factor.get('false_northing', 0)], [], []
+        else:
+            # false origin of the fit result's tile from metadata
+            origin, factor_inputs, factor_deps = \
+                ['-m', metadata], [metadata], ['meta']
+        stages += [
+            Stage('factor',
+                _cart('factor', '-i', config['factor_result'],
+                    '-o', vector / 'factor.gpkg', *origin,
+                    '-s', factor.get('scale', 80), '-r', factor.get('radius', 80),
+                    *report),
+                inputs=[config['factor_result'], *factor_inputs],
+                outputs=[vector / 'factor.gpkg'], deps=factor_deps),
+            Stage('factor_tiles',
+                gdal + ['ogr2ogr', '-f', 'MVT', tile / 'vector-factor',
+                    vector / 'factor.gpkg', *MVT_OPTIONS],
+                inputs=[vector / 'factor.gpkg'],
+                outputs=[tile / 'vector-factor'], deps=['factor']),
+        ]
+    if config.get('factor_de'):
+        stages.append(Stage('factor_de',
+            _cart('factorde', '-i', config['factor_de'],
+                '-o', vector / 'factor_de.json'),
+            inputs=[config['factor_de']], outputs=[vector / 'factor_de.json']))
+    histology = config.get('histology_path')
+    if histology:
+        deps = []
+        if str(histology).startswith('s3://'):
+            stages.append(Stage('fetch_histology',
+                ['aws', 's3', 'cp', histology, raster / 'histology.tif'],
+                outputs=[raster / 'histology.tif']))
+            histology, deps = raster / 'histology.tif', ['fetch_histology']
+        stages.append(Stage('histology_tiles',
+            gdal + ['gdal2tiles.py', '-z', '6-15',
+                histology, tile / 'raster-histology'],
+            inputs=[histology], outputs=[tile / 'raster-histology'],
+            deps=deps))
+
+    for stage in stages:
+        stage.cpu = options.get(stage.name, {}).get('cpu', stage.cpu)
+        stage.memory = parse_size(
+            options.get(stage.name, {}).get('memory')) or stage.memory
+    return _without(stages, set(config.get('skip', [])))
+
+
+def run_stages(stages, state_path, cpu, max_memory=None, force=False,
+        dry_run=False):
+    '''
+    run stages as their dependencies finish, several at a time while the
+    sum of their cpu and memory fits in cpu and max_memory (bytes, no
+    limit if None). memory functions are resolved when a stage's
+    dependencies are done. a stage larger than the budget runs on its own.
+    stages up to date in the state file are skipped. the output of each
+    stage goes to logs/{name}.log next to the state file.
+    returns {name: 'done'|'skipped'|'failed'|'blocked'|'would run'}
+    '''
+    state_path = Path(state_path)
+    state = _load_state(state_path)
+    log_dir = state_path.parent / 'logs'
+    pending = list(stages)
+    status, running = {}, {}
+    with ThreadPoolExecutor(max_workers=max(len(stages), 1)) as executor:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for stage in list(pending):
+                    deps = [status.get(d) for d in stage.deps]
+                    if any(s in ('failed', 'blocked') for s in deps):
+                        status[stage.name] = 'blocked'
+                    elif not all(s in ('done', 'skipped', 'would run') for s in deps):
+                        continue
+                    elif not force and 'would run' not in deps and \
+                            stage.is_up_to_date(state.get(stage.name)):
+                        status[stage.name] = 'skipped'
+                    elif dry_run:
+                        status[stage.name] = 'would run'
+                    elif _fits(stage, running.values(), cpu, max_memory):
+                        print(f"{stage.name}: {' '.join(stage.command)}")
+                        future = executor.submit(_run, stage, log_dir)
+                        running[future] = stage
+                    else:
+                        continue
+                    pending.remove(stage)
+                    progress = True
+                    if stage.name in status:
+                        print(f"{stage.name}: {status[stage.name]}")
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                returncode, elapsed = future.result()
+                if returncode == 0:
+                    status[stage.name] = 'done'
+                    state[stage.name] = stage.state()
+                    _save_state(state_path, state)
+                else:
+                    status[stage.name] = 'failed'
+                    state.pop(stage.name, None)
+                    _save_state(state_path, state)
+                print(f"{stage.name}: {status[stage.name]} in {elapsed:.1f}s")
+    return status
+
+
+def path_fingerprint(path):
+    '''
+    fingerprint of a file (size and mtime, content hash if small) or of a
+    directory (number of files, total size and latest mtime of the files
+    below it). small files like metadata.yaml are hashed so that a stage
+    rewriting them unchanged does not rerun the stages after it
+    '''
+    path = Path(path)
+    if not path.exists():
+        return None
+    if not path.is_dir():
+        if path.stat().st_size <= HASHED_SIZE:
+            return {'sha1': hashlib.sha1(path.read_bytes()).hexdigest()}
+        return fingerprint(path)
+    count = size = mtime = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            stat = os.stat(os.path.join(root, name))
+            count += 1
+            size += stat.st_size
+            mtime = max(mtime, stat.st_mtime_ns)
+    return {'files': count, 'size': str(size), 'mtime_ns': str(mtime)}
+
+
+def _cart(module, *args):
+    return [sys.executable, '-m', f'cart.{module}', *args]
+
+
+def _metadata_tiles(metadata):
+    '''tiles of metadata.yaml, to estimate the memory of stages over them'''
+    with open(metadata) as f:
+        return list(yaml.safe_load(f)['tiles'].values())
+
+
+def _sdge_tiles(sdge_dir, lane=0):
+    '''tile directories of sDGE data, as metadata tiles (see meta)'''
+    lanes = ['1', '2'] if lane == 0 else [str(lane)]
+    return [
+        {'data_dir': path.parent}
+        for path in Path(sdge_dir).glob('*/*/matrix.mtx.gz')
+        if path.parent.parent.name in lanes and path.parent.name.isdigit()]
+
+
+def _without(stages, skip):
+    '''stages not in skip and not depending on a left out stage'''
+    kept, names = [], set()
+    for stage in stages:
+        if stage.name in skip or any(d not in names for d in stage.deps):
+            continue
+        kept.append(stage)
+        names.add(stage.name)
+    return kept
+
+
+def _fits(stage, running, cpu, max_memory):
+    if max_memory is not None:
+        stage.estimate()
+    running = list(running)
+    if not running:
+        return True
+    if sum(s.cpu for s in running) + stage.cpu > cpu:
+        return False
+    if max_memory is not None and \
+            sum(s.memory for s in running) + stage.memory > max_memory:
+        return False
+    return True
+
+
+def _run(stage, log_dir):
+    '''run the command of a stage after removing its old outputs'''
+    for output in stage.outputs:
+        if os.path.isdir(output):
+            shutil.rmtree(output)
+        elif os.path.exists(output):
+            os.remove(output)
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    start = time.monotonic()
+    with open(log_dir / f"{stage.name}.log", 'w') as log:
+        try:
+            returncode = subprocess.call(
+                stage.command, stdout=log, stderr=subprocess.STDOUT)
+        except OSError as e:
+            # command not found
+            log.write(f"{e}\n")
+            returncode = 127
+    return returncode, time.monotonic() - start
+
+
+def _load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_state(path, state):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(tmp, path)
+
+
+if __name__ == '__main__':
+    main()
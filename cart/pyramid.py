@@ -0,0 +1,224 @@
+"""
+Multi-resolution pyramid of per-gene counts.
+
+Points of each tile are binned once into a base grid (epsg:3857, pixels of
+`resolution`) as sparse (pixel, gene) sums. Coarser levels are built by
+summing 2x2 blocks of the level below, so level k has pixels of
+resolution * 2**k. Each level is stored as a sparse pixel x gene matrix,
+and any level, gene or marker set is rendered from these sums without
+rescanning the points.
+
+```
+pyramid/
+    pyramid.json    grid, genes and levels
+    level-0.npz     scipy.sparse csc matrix, pixels x genes
+    level-1.npz
+    ...
+```
+"""
+
+import argparse
+import json
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import yaml
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from .raster import COUNT_FIELDS, grid_bounds, grid_points
+from .util import DEFAULT_CHUNKSIZE
+
+PYRAMID_INDEX = 'pyramid.json'
+
+
+def main():
+    """
+    run script for building a count pyramid
+    ```
+    $ python -m cart.pyramid -m metadata.yaml -o pyramid -r 30 -l 8
+    ```
+    """
+    parser = argparse.ArgumentParser(
+        description="Build a multi-resolution pyramid of per-gene counts")
+    parser.add_argument(
+        "-m", "--meta", type=str, default='metadata.yaml',
+        help="metadata yaml")
+    parser.add_argument(
+        "-o", "--output", type=str, required=True,
+        help="output directory")
+    parser.add_argument(
+        "-r", "--resolution", type=float, default=30,
+        help="pixel size of the base level in sDGE units")
+    parser.add_argument(
+        "-l", "--levels", type=int, default=8,
+        help="number of levels including the base level")
+    parser.add_argument(
+        "-a", "--attribute", type=str, default='cnt_total',
+        choices=COUNT_FIELDS,
+        help="count field summed into pixels")
+    parser.add_argument(
+        "-c", "--cpu", type=int, default=6,
+        help="number of processes")
+    parser.add_argument(
+        "-k", "--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+        help="number of matrix rows processed at once. 0 for whole tile")
+    parser.add_argument(
+        "--cache-dir", type=str, default=None,
+        help="directory for binary cache of parsed sDGE files")
+    args = parser.parse_args()
+
+    with open(args.meta) as f:
+        metadata = yaml.safe_load(f)
+    build_pyramid(
+        metadata, args.output, resolution=args.resolution,
+        levels=args.levels, attribute=args.attribute, cpu=args.cpu,
+        chunksize=args.chunksize, cache_dir=args.cache_dir)
+
+
+def build_pyramid(metadata, output, resolution=30, levels=8,
+        attribute='cnt_total', cpu=6, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None):
+    '''
+    bin all tiles into the base level and write `levels` levels of
+    per-gene counts to the output directory
+    '''
+    minx, miny, maxx, maxy = grid_bounds(metadata, resolution)
+    width = int(round((maxx - minx) / resolution))
+    height = int(round((maxy - miny) / resolution))
+    grid = (minx, miny, resolution, width, height)
+    args_list = [
+        (metadata_tile, grid, attribute, chunksize, cache_dir)
+        for metadata_tile in metadata['tiles'].values()]
+
+    genes = {}
+    pixels, codes, counts = [], [], []
+    with Pool(cpu) as p:
+        for tile_pixels, tile_genes, tile_codes, tile_counts in \
+                p.imap_unordered(_bin_tile_genes, args_list):
+            # map tile gene codes to dataset-wide gene ids
+            ids = np.array(
+                [genes.setdefault(g, len(genes)) for g in tile_genes],
+                dtype=np.int64)
+            pixels.append(tile_pixels)
+            codes.append(ids[tile_codes] if len(ids) else tile_codes)
+            counts.append(tile_counts)
+
+    output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    level = sparse.coo_matrix(
+        (np.concatenate(counts) if counts else np.zeros(0),
+         (np.concatenate(pixels) if pixels else np.zeros(0, dtype=np.int64),
+          np.concatenate(codes) if codes else np.zeros(0, dtype=np.int64))),
+        shape=(width * height, len(genes))).tocsc()
+    shapes = []
+    for k in range(levels):
+        if k > 0:
+            level = coarsen(level, width, height)
+            width, height = (width + 1) // 2, (height + 1) // 2
+        level.sum_duplicates()
+        sparse.save_npz(output / f"level-{k}.npz", level, compressed=True)
+        shapes.append([width, height])
+    index = {
+        'minx': float(minx),
+        'maxy': float(maxy),
+        'resolution': resolution,
+        'attribute': attribute,
+        'crs': 'EPSG:3857',
+        'genes': list(genes),
+        'levels': shapes,
+    }
+    tmp = output / f"{PYRAMID_INDEX}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp, output / PYRAMID_INDEX)
+    print(f"pyramid of {levels} levels written to {output}")
+
+
+def coarsen(level, width, height):
+    '''
+    sum 2x2 pixel blocks of a pixels x genes matrix of a width x height
+    grid (pixels row major, rows from the top)
+    '''
+    coo = level.tocoo()
+    row, col = np.divmod(coo.row, width)
+    half_width = (width + 1) // 2
+    pixel = (row // 2) * half_width + col // 2
+    shape = (half_width * ((height + 1) // 2), level.shape[1])
+    return sparse.coo_matrix((coo.data, (pixel, coo.col)), shape=shape).tocsc()
+
+
+class Pyramid:
+    '''read access to a pyramid written by build_pyramid'''
+
+    def __init__(self, path):
+        self.path = Path(path)
+        with open(self.path / PYRAMID_INDEX) as f:
+            index = json.load(f)
+        self.minx = index['minx']
+        self.maxy = index['maxy']
+        self.resolution = index['resolution']
+        self.genes = pd.Index(index['genes'])
+        self.shapes = [tuple(s) for s in index['levels']]
+        self._levels = {}
+
+    def level(self, k):
+        '''pixels x genes csc matrix of level k'''
+        if k not in self._levels:
+            self._levels[k] = sparse.load_npz(self.path / f"level-{k}.npz")
+        return self._levels[k]
+
+    def transform(self, k):
+        '''(minx, maxy, pixel size) of level k, rows count from the top'''
+        return self.minx, self.maxy, self.resolution * 2 ** k
+
+    def counts(self, k, genes=None) -> np.ndarray:
+        '''
+        height x width counts of level k, summed over genes
+        (e.g. a marker set) or over all genes if None
+        '''
+        width, height = self.shapes[k]
+        matrix = self.level(k)
+        if genes is not None:
+            ids = self.genes.get_indexer(list(genes))
+            matrix = matrix[:, ids[ids >= 0]]
+        sums = np.asarray(matrix.sum(axis=1)).ravel()
+        return sums.reshape(height, width)
+
+
+def _bin_tile_genes(args):
+    '''
+    pool worker. bin points of one tile into base grid pixels per gene.
+    returns (pixel, tile gene names, gene code, count) of nonzero sums
+    '''
+    metadata_tile, grid, attribute, chunksize, cache_dir = args
+    width = grid[3]
+    genes, keys, weights = [], [], []
+    for df in grid_points(metadata_tile, grid, chunksize, cache_dir):
+        # gene names are categories of the tile's gene lookup
+        genes = list(df['gene_name'].cat.categories)
+        pixel = df['row'].to_numpy() * width + df['col'].to_numpy()
+        keys.append(pixel * len(genes) + df['gene_name'].cat.codes.to_numpy())
+        weights.append(df[attribute].to_numpy())
+        # reduce per chunk so memory follows occupied (pixel, gene) pairs
+        keys[:], weights[:] = _reduce(keys, weights)
+    keys, weights = _reduce(keys, weights)
+    keys, weights = keys[0], weights[0]
+    pixel, code = np.divmod(keys, max(len(genes), 1))
+    return pixel, genes, code, weights
+
+
+def _reduce(keys, weights):
+    '''sum weights of equal keys over lists of arrays'''
+    if not keys:
+        return [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    unique, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    sums = np.bincount(
+        inverse, weights=np.concatenate(weights), minlength=len(unique))
+    return [unique], [sums.astype(np.int64)]
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Count rasteriser for sDGE tiles.
+
+Points of each tile are binned into the global (epsg:3857) pixel grid with
+np.bincount, tile by tile straight from the sDGE files and the false origins
+in metadata.yaml. Tile grids are summed into a disk-backed array and then
+written block by block into a tiled, compressed GeoTIFF, so memory stays
+bounded by one tile and one block row regardless of the flowcell size.
+"""
+
+import argparse
+import os
+import tempfile
+from multiprocessing import Pool
+from pathlib import Path
+
+import yaml
+import numpy as np
+import rasterio
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+from .convert import _join_xy, shifted_srs
+from .util import DEFAULT_CHUNKSIZE, read_chunks, tile_lookup
+
+COUNT_FIELDS = ['cnt_total', 'cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']
+BLOCK_SIZE = 512
+
+
+def main():
+    """
+    run script for rasterising counts
+    ```
+    $ python -m cart.raster -m metadata.yaml -o count_sdge.tif -r 30
+    ````
+    """
+    parser = argparse.ArgumentParser(
+        description="Rasterise sDGE counts into a GeoTIFF")
+    parser.add_argument(
+        "-m", "--meta", type=str, default='metadata.yaml',
+        help="metadata yaml")
+    parser.add_argument(
+        "-o", "--output", type=str, required=True,
+        help="Output tif path")
+    parser.add_argument(
+        "-r", "--resolution", type=float, default=30,
+        help="pixel size in sDGE units")
+    parser.add_argument(
+        "-a", "--attribute", type=str, default='cnt_total',
+        choices=COUNT_FIELDS,
+        help="count field summed into pixels")
+    parser.add_argument(
+        "-g", "--genes", type=str, default=None,
+        help="comma separated gene names. all genes if not given")
+    parser.add_argument(
+        "-c", "--cpu", type=int, default=6,
+        help="number of processes")
+    parser.add_argument(
+        "-k", "--chunksize", type=int, default=DEFAULT_CHUNKSIZE,
+        help="number of matrix rows processed at once. 0 for whole tile")
+    parser.add_argument(
+        "--cache-dir", type=str, default=None,
+        help="directory for binary cache of parsed sDGE files")
+    args = parser.parse_args()
+
+    with open(args.meta) as f:
+        metadata = yaml.safe_load(f)
+    genes = None
+    if args.genes:
+        genes = [g.strip() for g in args.genes.split(',')]
+    rasterize(
+        metadata, args.output, resolution=args.resolution,
+        attribute=args.attribute, genes=genes, cpu=args.cpu,
+        chunksize=args.chunksize, cache_dir=args.cache_dir)
+
+
+def rasterize(metadata, output, resolution=30, attribute='cnt_total',
+        genes=None, cpu=6, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    '''
+    sum `attribute` of all points (optionally of `genes` only) per pixel
+    and write a tiled, compressed epsg:3857 GeoTIFF
+    '''
+    minx, miny, maxx, maxy = grid_bounds(metadata, resolution)
+    width = int(round((maxx - minx) / resolution))
+    height = int(round((maxy - miny) / resolution))
+    grid = (minx, miny, resolution, width, height)
+    args_list = [
+        (metadata_tile, grid, attribute, genes, chunksize, cache_dir)
+        for metadata_tile in metadata['tiles'].values()]
+
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=Path(output).parent) as tmp:
+        counts = np.memmap(
+            os.path.join(tmp, 'counts.bin'), dtype='int32', mode='w+',
+            shape=(height, width))
+        with Pool(cpu) as p:
+            for window in p.imap_unordered(_bin_tile, args_list):
+                if window is None:
+                    continue
+                row, col, block = window
+                h, w = block.shape
+                counts[row:row + h, col:col + w] += block
+        _write_geotiff(output, counts, from_origin(minx, maxy, resolution, resolution))
+        del counts
+    print(f"raster written to {output}")
+
+
+def grid_bounds(metadata, resolution):
+    '''epsg:3857 bounds of all tiles snapped to the pixel grid'''
+    tiles = metadata['tiles'].values()
+    minx = min(t['xmin'] - t['false_easting'] for t in tiles)
+    miny = min(t['ymin'] - t['false_northing'] for t in tiles)
+    maxx = max(t['xmax'] - t['false_easting'] for t in tiles)
+    maxy = max(t['ymax'] - t['false_northing'] for t in tiles)
+    minx = np.floor(minx / resolution) * resolution
+    miny = np.floor(miny / resolution) * resolution
+    maxx = (np.floor(maxx / resolution) + 1) * resolution
+    maxy = (np.floor(maxy / resolution) + 1) * resolution
+    return minx, miny, maxx, maxy
+
+
+def grid_points(metadata_tile, grid, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None):
+    '''
+    yield the matrix entries of a tile joined with epsg:3857 xy and gene
+    names, `chunksize` rows at a time (whole tile if 0), with the row and
+    col of their pixel in grid (minx, miny, resolution, width, height).
+    pixels include their lower-left edges, rows count from the top, and
+    points outside the grid are clipped to its edge
+    '''
+    minx, miny, resolution, width, height = grid
+    data_dir = Path(metadata_tile['data_dir'])
+    t_srs = shifted_srs(
+            metadata_tile['false_easting'],
+            metadata_tile['false_northing'])
+    lookup = tile_lookup(
+        data_dir / "barcodes.tsv.gz", data_dir / "features.tsv.gz", cache_dir)
+    for df_matrix in read_chunks(data_dir / "matrix.mtx.gz", chunksize, cache_dir):
+        df = _join_xy(df_matrix, lookup, t_srs, dst_crs='epsg:3857')
+        row = height - 1 - ((df['y'].to_numpy() - miny) // resolution)
+        col = (df['x'].to_numpy() - minx) // resolution
+        df['row'] = np.clip(row.astype(np.int64), 0, height - 1)
+        df['col'] = np.clip(col.astype(np.int64), 0, width - 1)
+        yield df
+
+
+def _bin_tile(args):
+    '''
+    pool worker. bin the points of one tile into its window of the grid.
+    returns (row, col, counts) of the window, None for an empty tile
+    '''
+    metadata_tile, grid, attribute, genes, chunksize, cache_dir = args
+    rows, cols, weights = [], [], []
+    for df in grid_points(metadata_tile, grid, chunksize, cache_dir):
+        if genes is not None:
+            df = df[df['gene_name'].isin(genes)]
+        rows.append(df['row'].to_numpy())
+        cols.append(df['col'].to_numpy())
+        weights.append(df[attribute].to_numpy())
+    if sum(len(r) for r in rows) == 0:
+        return None
+    rows = np.concatenate(rows)
+    cols = np.concatenate(cols)
+    weights = np.concatenate(weights)
+    row0, col0 = rows.min(), cols.min()
+    h, w = rows.max() - row0 + 1, cols.max() - col0 + 1
+    block = np.bincount(
+        (rows - row0) * w + (cols - col0),
+        weights=weights, minlength=h * w)
+    return int(row0), int(col0), block.reshape(h, w).astype('int32')
+
+
+def _write_geotiff(output, counts, transform):
+    '''write counts block row by block row into a tiled, compressed GeoTIFF'''
+    height, width = counts.shape
+    profile = {
+        'driver': 'GTiff',
+        'dtype': 'int32',
+        'count': 1,
+        'width': width,
+        'height': height,
+        'crs': 'EPSG:3857',
+        'transform': transform,
+        'nodata': 0,
+        'tiled': True,
+        'blockxsize': BLOCK_SIZE,
+        'blockysize': BLOCK_SIZE,
+        'compress': 'deflate',
+        'predictor': 2,
+        'BIGTIFF': 'IF_SAFER',
+    }
+    with rasterio.open(output, 'w', **profile) as dst:
+        for row in range(0, height, BLOCK_SIZE):
+            h = min(BLOCK_SIZE, height - row)
+            window = Window(0, row, width, h)
+            dst.write(np.asarray(counts[row:row + h]), 1, window=window)
+
+
+if __name__ == '__main__':
+    main()
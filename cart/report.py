@@ -0,0 +1,363 @@
+"""
+per-stage timing and memory report of a run
+
+entry points started with `--report run.jsonl` append one json line per
+stage to the report: wall and cpu time, peak rss, rows in/out and bytes
+read/written, for each tile (or worker) and stage (read, join, reproject,
+write, subprocess, ...). the report path is passed to pool workers
+through the environment, and every record is a single append, so all
+processes of a run write to the same file. stages run repeatedly inside
+a tile (e.g. once per matrix chunk) are summed into one record per tile.
+at the end of the run a summary table per stage and the slowest tiles
+are printed.
+
+peak rss is measured per stage on linux: the kernel's high-water mark of
+the process is reset when a stage starts (/proc/self/clear_refs) and read
+when it ends, so reused pool workers don't carry earlier peaks over.
+rss_scope tells what peak_rss_mb covers: 'stage', or 'process' (lifetime
+high-water mark, where it can't be reset) or, for stages measuring
+waited-for children, 'children' (largest child so far, when the children
+of the stage stayed below it).
+
+```
+{"run": "convert-1700000000-1234", "command": "convert", "stage": "join",
+ "tile": "2-2101", "pid": 1236, "calls": 12, "wall_s": 3.2, "cpu_s": 3.1,
+ "peak_rss_mb": 812.4, "rss_scope": "stage", "rows_in": 5800000,
+ "rows_out": 5800000, "bytes_read": 0, "bytes_written": 0}
+```
+"""
+
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+from pathlib import Path
+
+import pandas as pd
+
+
+REPORT_ENV = 'CART_REPORT'
+RUN_ENV = 'CART_REPORT_RUN'
+COUNTERS = ['rows_in', 'rows_out', 'bytes_read', 'bytes_written']
+
+# stages of the current tile of this process, summed until the tile ends
+_tile = None
+_stages = {}
+# running peak rss of the open stages of this process, see _start_peak
+_open_peaks = []
+
+
+class Stage:
+    '''measurements of one stage, filled in by the instrumented code'''
+
+    def __init__(self, name, tile=None):
+        self.name = name
+        self.tile = tile
+        self.calls = 1
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self.peak_rss_mb = 0.0
+        self.rss_scope = 'stage'
+        self.rows_in = 0
+        self.rows_out = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def rows(self, rows_in=None, rows_out=None):
+        '''count rows going in and out of the stage'''
+        self.rows_in += rows_in or 0
+        self.rows_out += rows_out or 0
+
+    def read(self, *paths):
+        '''count the size of files read by the stage'''
+        self.bytes_read += sum(_size(p) for p in paths)
+
+    def wrote(self, *paths):
+        '''count the size of files written by the stage'''
+        self.bytes_written += sum(_size(p) for p in paths)
+
+    def add(self, other):
+        self.calls += other.calls
+        self.wall_s += other.wall_s
+        self.cpu_s += other.cpu_s
+        self.peak_rss_mb = max(self.peak_rss_mb, other.peak_rss_mb)
+        if other.rss_scope != 'stage':
+            self.rss_scope = other.rss_scope
+        for name in COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+    def record(self):
+        return {
+            'run': os.environ.get(RUN_ENV),
+            'command': os.environ.get(RUN_ENV, '').rsplit('-', 2)[0],
+            'stage': self.name,
+            'tile': self.tile,
+            'pid': os.getpid(),
+            'calls': self.calls,
+            'wall_s': round(self.wall_s, 4),
+            'cpu_s': round(self.cpu_s, 4),
+            'peak_rss_mb': round(self.peak_rss_mb, 1),
+            'rss_scope': self.rss_scope,
+            **{name: int(getattr(self, name)) for name in COUNTERS},
+        }
+
+
+def enabled():
+    return bool(os.environ.get(REPORT_ENV))
+
+
+@contextlib.contextmanager
+def run(path, command):
+    '''
+    report the stages of a command to path (json lines, appended) and
+    print the summary at the end, also written next to the report as
+    a tsv (see summary_path). no-op if path is None
+    '''
+    if path is None:
+        yield
+        return
+    previous = os.environ.get(REPORT_ENV), os.environ.get(RUN_ENV)
+    run_id = f"{command}-{int(time.time())}-{os.getpid()}"
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    os.environ[REPORT_ENV] = str(Path(path).resolve())
+    os.environ[RUN_ENV] = run_id
+    try:
+        with stage('total'):
+            yield
+    finally:
+        for name, value in zip([REPORT_ENV, RUN_ENV], previous):
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+    df = load(path, run_id)
+    table = summary(df)
+    if not table.empty:
+        table.to_csv(summary_path(path), sep="\t")
+    print_summary(table, slowest_tiles(df))
+
+
+def summary_path(path) -> Path:
+    '''summary table of a report, e.g. run.summary.tsv for run.jsonl'''
+    path = Path(path)
+    return path.with_name(f"{path.stem}.summary.tsv")
+
+
+@contextlib.contextmanager
+def stage(name, tile=None, children=False, output=None):
+    '''
+    measure the enclosed block as stage `name` of tile (the current tile
+    if None). peak rss is that of the block (see rss_scope). with
+    children, cpu time and peak rss are those of waited-for child
+    processes, e.g. of a subprocess.call. the growth of the output file
+    is counted as bytes written. yields the Stage to count rows and bytes on
+    '''
+    rec = Stage(name, tile if tile is not None else _tile)
+    if not enabled():
+        yield rec
+        return
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    start, cpu = time.perf_counter(), _cpu_time(who)
+    size = _size(output) if output is not None else 0
+    if children:
+        children_peak = _maxrss_mb(who)
+    else:
+        peak = _start_peak()
+    try:
+        yield rec
+    finally:
+        if output is not None:
+            rec.bytes_written += max(_size(output) - size, 0)
+        rec.wall_s = time.perf_counter() - start
+        rec.cpu_s = _cpu_time(who) - cpu
+        if children:
+            # the largest child so far; this stage's own if it grew
+            rec.peak_rss_mb = _maxrss_mb(who)
+            if rec.peak_rss_mb <= children_peak:
+                rec.rss_scope = 'children'
+        else:
+            rec.peak_rss_mb, rec.rss_scope = _end_peak(peak)
+        if _tile is not None and rec.tile == _tile:
+            if name in _stages:
+                _stages[name].add(rec)
+            else:
+                _stages[name] = rec
+        else:
+            _emit(rec)
+
+
+@contextlib.contextmanager
+def tile(tile_id):
+    '''
+    sum the stages inside the block per stage and report them, and the
+    whole block as stage 'tile', under tile_id when the block ends
+    '''
+    global _tile, _stages
+    previous = _tile, _stages
+    _tile, _stages = tile_id, {}
+    try:
+        with stage('tile') as total:
+            yield total
+    finally:
+        stages = _stages
+        _tile, _stages = previous
+        for rec in stages.values():
+            _emit(rec)
+
+
+def timed(iterable, name, path=None):
+    '''
+    iterate while measuring each step as stage `name`, counting the
+    rows of the items, e.g. chunks read from the file at path
+    '''
+    iterator = iter(iterable)
+    while True:
+        with stage(name) as rec:
+            if path is not None:
+                rec.read(path)
+                path = None
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            rec.rows(rows_out=len(item))
+        yield item
+
+
+def load(path, run_id=None) -> pd.DataFrame:
+    '''records of a report, only those of run_id if given'''
+    with open(path) as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    if run_id is not None and not df.empty:
+        df = df[df['run'] == run_id]
+    return df
+
+
+def summary(df) -> pd.DataFrame:
+    '''totals per stage over tiles: wall and cpu time, max rss, counters'''
+    if df.empty:
+        return df
+    df = df.assign(tile=df['tile'].fillna(''))
+    return df.groupby('stage', sort=False).agg(
+        tiles=('tile', lambda t: t[t != ''].nunique()),
+        calls=('calls', 'sum'),
+        wall_s=('wall_s', 'sum'),
+        max_wall_s=('wall_s', 'max'),
+        cpu_s=('cpu_s', 'sum'),
+        peak_rss_mb=('peak_rss_mb', 'max'),
+        **{name: (name, 'sum') for name in COUNTERS},
+    ).sort_values('wall_s', ascending=False).round(4)
+
+
+def slowest_tiles(df, n=5) -> pd.DataFrame:
+    '''tiles with the longest wall time'''
+    if df.empty:
+        return df
+    tiles = df[(df['stage'] == 'tile') & df['tile'].notna()]
+    return tiles.nlargest(n, 'wall_s')[['tile', 'wall_s', 'cpu_s', 'peak_rss_mb']]
+
+
+def print_summary(table, tiles=None, file=None):
+    if table.empty:
+        return
+    file = file or sys.stdout
+    with pd.option_context('display.width', 200, 'display.max_columns', 20):
+        print(table.round(2).to_string(), file=file)
+        if tiles is not None and not tiles.empty:
+            print("slowest tiles", file=file)
+            print(tiles.round(2).to_string(index=False), file=file)
+
+
+def _emit(rec):
+    line = json.dumps(rec.record()) + "\n"
+    # a single O_APPEND write, so lines of concurrent processes don't mix
+    fd = os.open(os.environ[REPORT_ENV], os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def reset_peak_rss():
+    '''
+    reset the high-water mark of this process's rss to its current rss
+    (linux). False where it can't be reset
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_mb():
+    '''
+    high-water mark of this process's rss since the last reset_peak_rss,
+    the lifetime peak (ru_maxrss) without /proc
+    '''
+    value = _proc_status('VmHWM')
+    return _maxrss_mb(resource.RUSAGE_SELF) if value is None else value
+
+
+def rss_mb():
+    '''current rss of this process, None without /proc'''
+    return _proc_status('VmRSS')
+
+
+def _proc_status(field):
+    '''a memory field (MB) of /proc/self/status'''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def _start_peak():
+    '''
+    reset the rss high-water mark for a stage starting. the peak so far is
+    first folded into the stages already open, which the reset would lose
+    '''
+    if _open_peaks:
+        peak = peak_rss_mb()
+        for running in _open_peaks:
+            running[0] = max(running[0], peak)
+    running = [0.0, reset_peak_rss()]
+    _open_peaks.append(running)
+    return running
+
+
+def _end_peak(running):
+    '''peak rss and rss_scope of the stage ending, folded into open stages'''
+    peak = max(running[0], peak_rss_mb())
+    _open_peaks.remove(running)
+    for other in _open_peaks:
+        other[0] = max(other[0], peak)
+    return peak, 'stage' if running[1] else 'process'
+
+
+def _maxrss_mb(who):
+    # ru_maxrss is in kilobytes on linux, bytes on macos
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(who).ru_maxrss * scale / 2**20
+
+
+def _size(path):
+    '''size of a file, 0 if missing or not a path (e.g. a buffer)'''
+    if not enabled() or not isinstance(path, (str, os.PathLike)):
+        return 0
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
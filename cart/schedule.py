@@ -0,0 +1,103 @@
+"""
+memory-aware scheduling of tile jobs on a process pool
+
+each job carries an estimate of its peak memory. jobs are dispatched
+largest first and a job is only started while the estimates of the
+running jobs plus its own fit in the memory budget, so big tiles do not
+run side by side while small tiles fill the remaining cores.
+"""
+
+import os
+import queue
+import re
+from multiprocessing import Pool
+from pathlib import Path
+
+
+# rough peak memory per byte of gzipped sDGE input, measured on hiseq tiles
+MEMORY_PER_GZ_BYTE = 12
+# rough memory per matrix row held in a chunk (parsed frame plus join)
+MEMORY_PER_MATRIX_ROW = 120
+
+SIZE_UNITS = {'': 1, 'K': 2**10, 'M': 2**20, 'G': 2**30, 'T': 2**40}
+
+
+def parse_size(size):
+    ''' bytes of a size like 512M, 16G or 1000000. None stays None'''
+    if size is None:
+        return None
+    match = re.fullmatch(r'\s*([\d.]+)\s*([KMGT]?)i?B?\s*', str(size), re.I)
+    if match is None:
+        raise ValueError(f"invalid size: {size}")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def tile_memory(metadata_tile, chunksize=0):
+    '''
+    estimated peak memory (bytes) of converting a tile, from the sizes
+    of its sDGE files. with a chunksize the matrix part is capped at one
+    chunk since only one chunk is held at a time, also by convert_merged
+    which spills each chunk to disk
+    '''
+    data_dir = Path(metadata_tile['data_dir'])
+    lookup = sum(
+        os.path.getsize(data_dir / name)
+        for name in ['barcodes.tsv.gz', 'features.tsv.gz'])
+    matrix = os.path.getsize(data_dir / 'matrix.mtx.gz') * MEMORY_PER_GZ_BYTE
+    if chunksize:
+        matrix = min(matrix, chunksize * MEMORY_PER_MATRIX_ROW)
+    return lookup * MEMORY_PER_GZ_BYTE + matrix
+
+
+def pool_memory(metadata_tiles, cpu, chunksize=0):
+    '''
+    estimated peak memory (bytes) of a pool of cpu processes over tiles:
+    the sum of the cpu largest tile_memory estimates
+    '''
+    estimates = sorted(
+        (tile_memory(t, chunksize) for t in metadata_tiles), reverse=True)
+    return sum(estimates[:max(cpu, 1)])
+
+
+def imap_scheduled(func, jobs, cpu, max_memory=None):
+    '''
+    apply func to the args of jobs [(estimate, args), ...] on a pool of
+    cpu processes and yield results as they finish. jobs start largest
+    estimate first while the running estimates fit in max_memory (bytes,
+    no limit if None). a job larger than the budget runs on its own
+    '''
+    pending = sorted(jobs, key=lambda job: job[0], reverse=True)
+    done = queue.Queue()
+    running, used = 0, 0
+    with Pool(cpu) as p:
+        while pending or running:
+            while pending and running < cpu:
+                index = _next_fitting(pending, used, max_memory, running)
+                if index is None:
+                    break
+                estimate, args = pending.pop(index)
+                p.apply_async(
+                    func, (args,),
+                    callback=lambda r, e=estimate: done.put((e, r, None)),
+                    error_callback=lambda x, e=estimate: done.put((e, None, x)))
+                running += 1
+                used += estimate
+            estimate, result, error = done.get()
+            running -= 1
+            used -= estimate
+            if error is not None:
+                raise error
+            yield result
+
+
+def _next_fitting(pending, used, max_memory, running):
+    '''index of the largest pending job that fits in the budget'''
+    if max_memory is None:
+        return 0
+    if pending[0][0] > max_memory:
+        # larger than the budget: wait until the pool is idle, run it alone
+        return 0 if running == 0 else None
+    for index, (estimate, _) in enumerate(pending):
+        if used + estimate <= max_memory:
+            return index
+    return None
@@ -0,0 +1,190 @@
+"""
+shard/merge protocol for running a step as N independent jobs
+
+a step run with `--shard i/N` (i in 0..N-1, e.g. a SLURM array task id)
+processes every N-th tile of the sorted tile ids, writes its partial
+output under a shard name derived from the final output and, only when
+it is complete, a `.done` marker. `merge` combines the partial outputs
+once the markers of all N shards exist.
+
+```
+$ convert -m metadata.yaml --merged full_sdge.fgb --shard 0/4   # ... 3/4
+$ merge -o full_sdge.fgb -n 4
+```
+"""
+
+import argparse
+import json
+import os
+import re
+from pathlib import Path
+
+import fiona
+import pandas as pd
+
+from . import manifest
+from .sort import BLOCK_SIZE, CURVES, sorted_frames
+from .util import point_records
+
+
+def main():
+    '''
+    run script for merging shard outputs
+    ```
+    $ merge -o full_sdge.fgb -n 4
+    $ merge -o /output/dir -n 4
+    ```
+    '''
+    parser = argparse.ArgumentParser(
+        description="Merge the outputs of sharded convert runs")
+    parser.add_argument(
+        "-o", "--output", type=str, required=True,
+        help="final output given to the sharded runs (.fgb/.gpkg or dir)")
+    parser.add_argument(
+        "-n", "--shards", type=int, required=True,
+        help="number of shards")
+    parser.add_argument(
+        "--sort", type=str, default=None, choices=CURVES,
+        help="write features in hilbert or zorder order")
+    parser.add_argument(
+        "--keep", action='store_true',
+        help="keep shard outputs and markers after merging")
+    args = parser.parse_args()
+    merge(args.output, args.shards, keep=args.keep, sort=args.sort)
+
+
+def parse_shard(text):
+    ''' (index, count) of a shard spec like 3/8'''
+    match = re.fullmatch(r'\s*(\d+)\s*/\s*(\d+)\s*', text)
+    if match is None:
+        raise ValueError(f"invalid shard {text}, expected i/N")
+    index, count = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < count:
+        raise ValueError(f"shard index must be in 0..{count - 1}: {text}")
+    return index, count
+
+
+def select(keys, shard):
+    ''' keys of shard (index, count): every count-th of the sorted keys'''
+    if shard is None:
+        return list(keys)
+    index, count = shard
+    return sorted(keys)[index::count]
+
+
+def shard_path(output, shard) -> Path:
+    ''' partial output of shard, e.g. full_sdge.shard-0-of-4.fgb'''
+    output = Path(output)
+    index, count = shard
+    name = f"{output.stem}.shard-{index}-of-{count}{output.suffix}"
+    return output.with_name(name)
+
+
+def marker_path(output, shard) -> Path:
+    ''' completion marker of shard, e.g. full_sdge.fgb.shard-0-of-4.done'''
+    output = Path(output)
+    index, count = shard
+    return output.with_name(f"{output.name}.shard-{index}-of-{count}.done")
+
+
+def mark_done(output, shard, tiles):
+    ''' write the completion marker of shard listing its tiles'''
+    path = marker_path(output, shard)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, 'w') as f:
+        json.dump({'shard': list(shard), 'tiles': sorted(tiles)}, f)
+    os.replace(tmp, path)
+
+
+def clear_done(output, shard):
+    ''' remove the marker of shard when it is (re)started'''
+    path = marker_path(output, shard)
+    if path.exists():
+        path.unlink()
+
+
+def pending_shards(output, count):
+    ''' indices of shards without a completion marker'''
+    return [
+        index for index in range(count)
+        if not marker_path(output, (index, count)).exists()]
+
+
+def merge(output, count, keep=False, sort=None):
+    '''
+    combine the partial outputs of count shards into output.
+    a .fgb/.gpkg output is rewritten from the shard files with one
+    spatial index (in curve order with sort, see cart.sort), a directory
+    output gets the shard manifests merged (the tile files are already
+    in place)
+    '''
+    pending = pending_shards(output, count)
+    if pending:
+        raise RuntimeError(f"shards not finished: {pending}")
+    shards = [(index, count) for index in range(count)]
+    if Path(output).suffix.lower() in ('.fgb', '.gpkg'):
+        _merge_files(output, [shard_path(output, s) for s in shards], sort)
+    else:
+        _merge_manifests(output, shards)
+    if not keep:
+        for shard in shards:
+            partial = shard_path(output, shard)
+            if partial.is_file():
+                partial.unlink()
+            shard_manifest = manifest.manifest_path(output, shard)
+            if shard_manifest.exists():
+                shard_manifest.unlink()
+            marker_path(output, shard).unlink()
+    print(f"{count} shards merged into {output}")
+
+
+def _merge_files(output, partials, sort=None):
+    if os.path.exists(output):
+        os.remove(output)
+    bounds = []
+    for partial in partials:
+        with fiona.open(partial) as src:
+            profile = dict(
+                driver=src.driver, schema=src.schema, crs_wkt=src.crs_wkt)
+            if len(src):
+                bounds.append(src.bounds)
+    with fiona.open(
+            output, 'w', layer='all', SPATIAL_INDEX='YES', **profile) as dst:
+        if not sort or not bounds:
+            for partial in partials:
+                with fiona.open(partial) as src:
+                    dst.writerecords(src)
+            return
+        bounds = (
+            min(b[0] for b in bounds), min(b[1] for b in bounds),
+            max(b[2] for b in bounds), max(b[3] for b in bounds))
+        frames = (
+            df for partial in partials for df in _read_frames(partial))
+        for df in sorted_frames(
+                frames, bounds, sort, tmp_dir=Path(output).parent):
+            dst.writerecords(point_records(df, profile['schema']))
+
+
+def _read_frames(path, batch_size=BLOCK_SIZE):
+    '''point features of path as dataframes with x, y and properties'''
+    with fiona.open(path) as src:
+        names = list(src.schema['properties'])
+        rows = []
+        for feature in src:
+            x, y = feature['geometry']['coordinates'][:2]
+            properties = feature['properties']
+            rows.append([x, y] + [properties[n] for n in names])
+            if len(rows) >= batch_size:
+                yield pd.DataFrame(rows, columns=['x', 'y'] + names)
+                rows = []
+        if rows:
+            yield pd.DataFrame(rows, columns=['x', 'y'] + names)
+
+
+
+def _merge_manifests(outdir, shards):
+    tiles = manifest.load(outdir)
+    for shard in shards:
+        tiles.update(manifest.load(outdir, shard))
+    manifest.save(outdir, tiles)
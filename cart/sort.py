@@ -0,0 +1,152 @@
+"""
+spatial ordering of point features along a space filling curve
+
+features are keyed by their position on a Hilbert (or Z-order) curve over
+the dataset bounds and written in key order, so points close in space are
+close in the file and a bbox query reads few, contiguous pages. sorting is
+an external merge sort: sorted runs of at most `run_size` rows are spilled
+to temporary Arrow files and merged block by block, so memory is bounded
+by the run size, not by the dataset.
+"""
+
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from .tiler import morton_key
+
+
+CURVES = ['hilbert', 'zorder']
+# bits per axis of the curve grid
+CURVE_ORDER = 16
+DEFAULT_RUN_SIZE = 5_000_000
+BLOCK_SIZE = 65536
+
+
+def metadata_bounds(metadata):
+    ''' epsg:3857 (minx, miny, maxx, maxy) of all tiles in metadata'''
+    tiles = metadata['tiles'].values()
+    return (
+        min(t['xmin'] - t['false_easting'] for t in tiles),
+        min(t['ymin'] - t['false_northing'] for t in tiles),
+        max(t['xmax'] - t['false_easting'] for t in tiles),
+        max(t['ymax'] - t['false_northing'] for t in tiles))
+
+
+def curve_key(x, y, bounds, curve='hilbert', order=CURVE_ORDER):
+    ''' position of points (x, y) on the curve over bounds, as int64'''
+    minx, miny, maxx, maxy = bounds
+    cells = (1 << order) - 1
+    gx = _quantize(x, minx, maxx, cells)
+    gy = _quantize(y, miny, maxy, cells)
+    if curve == 'hilbert':
+        return hilbert_key(gx, gy, order)
+    if curve == 'zorder':
+        return morton_key(gx, gy).astype(np.int64)
+    raise ValueError(f"unknown curve {curve}, expected one of {CURVES}")
+
+
+def hilbert_key(x, y, order=CURVE_ORDER):
+    ''' Hilbert curve distance of integer grid cells (x, y) < 2**order'''
+    n = 1 << order
+    x = np.array(x, dtype=np.int64)
+    y = np.array(y, dtype=np.int64)
+    d = np.zeros(x.shape, dtype=np.int64)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx) ^ ry)
+        # rotate the quadrant so the sub-curve has the right orientation
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        x, y = np.where(~ry, y, x), np.where(~ry, x, y)
+        s >>= 1
+    return d
+
+
+def _quantize(v, vmin, vmax, cells):
+    scale = cells / (vmax - vmin) if vmax > vmin else 0
+    g = np.floor((np.asarray(v, dtype=np.float64) - vmin) * scale)
+    return np.clip(g, 0, cells).astype(np.int64)
+
+
+def sorted_frames(frames, bounds, curve='hilbert', run_size=DEFAULT_RUN_SIZE,
+        tmp_dir=None):
+    '''
+    yield the rows of frames (dataframes with x and y) sorted by curve_key,
+    block by block. categorical columns come back as plain values
+    '''
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as tmp:
+        runs = _write_runs(frames, bounds, curve, run_size, tmp)
+        if not runs:
+            return
+        yield from _merge_runs(runs)
+
+
+def _write_runs(frames, bounds, curve, run_size, tmp):
+    '''sort frames into runs of run_size rows spilled to arrow files'''
+    runs, buffer, buffered = [], [], 0
+
+    def spill():
+        df = pd.concat(buffer, ignore_index=True)
+        buffer.clear()
+        df['_key'] = curve_key(df['x'], df['y'], bounds, curve)
+        df = df.sort_values('_key', kind='stable', ignore_index=True)
+        path = os.path.join(tmp, f"run-{len(runs)}.arrow")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        with pa.ipc.new_file(path, table.schema) as writer:
+            writer.write_table(table, max_chunksize=BLOCK_SIZE)
+        runs.append(path)
+
+    for df in frames:
+        df = df.astype({
+            c: object for c in df.columns
+            if isinstance(df[c].dtype, pd.CategoricalDtype)})
+        buffer.append(df)
+        buffered += len(df)
+        if buffered >= run_size:
+            spill()
+            buffered = 0
+    if buffer:
+        spill()
+    return runs
+
+
+def _merge_runs(runs):
+    '''
+    k-way merge of sorted runs, one block per run in memory. each step
+    emits every buffered row with a key up to the smallest last key of
+    the runs' current blocks; those rows can't be preceded by unread rows
+    '''
+    readers = [pa.ipc.open_file(pa.memory_map(path)) for path in runs]
+    positions = [0] * len(readers)
+    blocks = [None] * len(readers)
+
+    def refill(i):
+        while blocks[i] is None or len(blocks[i]) == 0:
+            if positions[i] >= readers[i].num_record_batches:
+                blocks[i] = None
+                return
+            blocks[i] = readers[i].get_batch(positions[i]).to_pandas()
+            positions[i] += 1
+
+    for i in range(len(readers)):
+        refill(i)
+    while any(b is not None for b in blocks):
+        live = [i for i, b in enumerate(blocks) if b is not None]
+        bound = min(blocks[i]['_key'].iloc[-1] for i in live)
+        parts = []
+        for i in live:
+            keys = blocks[i]['_key'].to_numpy()
+            cut = int(np.searchsorted(keys, bound, side='right'))
+            parts.append(blocks[i].iloc[:cut])
+            blocks[i] = blocks[i].iloc[cut:]
+            refill(i)
+        df = pd.concat(parts, ignore_index=True)
+        df = df.sort_values('_key', kind='stable', ignore_index=True)
+        yield df.drop(columns='_key')
@@ -1,12 +1,21 @@
 import subprocess
 import argparse
+import itertools
+import json
 import os
+import sqlite3
 from pathlib import Path
 from multiprocessing import Pool
 
+import yaml
+import fiona
 import pandas as pd
 import numpy as np
 
+from . import report
+from .store import GENE_INDEX, is_gene_store, write_gene_store
+from .util import DEFAULT_CHUNKSIZE, read_chunks, tile_lookup
+
 
 def main():
     """
@@ -18,12 +27,13 @@ def main():
 
     Input:
     merged.fgb: all gene expressions in one layer 'all'
+    metadata.yaml: with -m, genes are counted from the sDGE tiles instead
     
     Output:
     *.fgb: point layer named 'all' for single gene
-    merged.csv: gene column extracted from merged.fgb. used for counting
+    genes/: gene-partitioned parquet store with --store (see write_gene_store)
     count.csv: gene_name, count, cum_fraction, freq
-    freq.json: {'freq'{'Lypd8': 0.0153, 'Cyp2c70':0.0144, ...}}
+    split.json: {'freq'{'Lypd8': 0.0153, 'Cyp2c70':0.0144, ...}}
     """
     parser = argparse.ArgumentParser(description="Convert SeqScope data to geographic format")
     parser.add_argument(
@@ -32,23 +42,48 @@ def main():
     parser.add_argument(
         "-o", "--out", type=str, required=True,
         help="Output dir")
+    parser.add_argument(
+        "-m", "--meta", type=str, default=None,
+        help="metadata yaml. count genes from the sDGE tiles in parallel")
     parser.add_argument(
         "-c", "--cpu", type=int, default=6,
         help="number of processes") 
     parser.add_argument(
         "-t", "--threshold", type=float, default=.8,
         help="inclusion threshold. top X genes are included") 
+    parser.add_argument(
+        "--store", action='store_true',
+        help="also write a gene-partitioned store to OUT/genes")
+    parser.add_argument(
+        "--cache-dir", type=str, default=None,
+        help="directory for binary cache of parsed sDGE files")
+    parser.add_argument(
+        "--report", type=str, default=None,
+        help="append per-stage timing and memory records to this json-lines file")
     args = parser.parse_args()
-    run(args.source, args.out, args.threshold, args.cpu)
+    metadata = None
+    if args.meta:
+        with open(args.meta) as f:
+            metadata = yaml.safe_load(f)
+    with report.run(args.report, 'split'):
+        run(args.source, args.out, args.threshold, args.cpu, args.store,
+            metadata=metadata, cache_dir=args.cache_dir)
  
 
-def run(src_fgb, output_path, threshold=0.05, cpu=4):
+def run(src_fgb, output_path, threshold=0.05, cpu=4, store=False,
+        metadata=None, cache_dir=None):
     output_dir = Path(output_path).expanduser()
     output_dir.mkdir(parents=True, exist_ok=True)
-    dst_csv = output_dir / "merged.csv"
-    
-    _extract_genes(src_fgb, dst_csv)
-    df = _count_genes(dst_csv)
+    if metadata is not None:
+        counts = count_tile_genes(metadata, cpu, cache_dir=cache_dir)
+        if store:
+            write_gene_store(
+                src_fgb, output_dir / "genes", genes=int((counts > 0).sum()))
+    else:
+        if store:
+            write_gene_store(src_fgb, output_dir / "genes")
+        counts = count_genes(src_fgb)
+    df = frequency_table(counts)
     df.to_csv(output_dir / "count.csv", index=False)
    
     for thres in np.arange(0.05, 1.05, .05):
@@ -59,30 +94,90 @@ def run(src_fgb, output_path, threshold=0.05, cpu=4):
     # _split_fgb(src_fgb, output_dir, genes_to_split, cpu)
 
 
-def _extract_genes(src_fgb, dst_csv):
+def count_genes(src, batch_size=1000000) -> pd.Series:
+    """
+    number of rows per gene_name of a merged file (or a gene store).
+    a GeoPackage is counted by a GROUP BY in sqlite, other formats by
+    reading only the gene_name column, batch_size features at a time.
+    with the sDGE tiles at hand count_tile_genes is faster still
+    """
+    if is_gene_store(src):
+        with open(Path(src).expanduser() / GENE_INDEX) as f:
+            genes = json.load(f)['genes']
+        return pd.Series({g: e['count'] for g, e in genes.items()}, dtype='int64')
+    with report.stage('read') as rec:
+        if Path(src).suffix.lower() == '.gpkg':
+            counts = _count_gpkg_genes(src)
+        else:
+            counts = _count_file_genes(src, batch_size)
+        rec.read(src)
+        rec.rows(rows_out=int(counts.sum()))
+    return counts
+
+
+def _count_gpkg_genes(src):
+    layer = fiona.listlayers(src)[0]
+    with sqlite3.connect(f"file:{src}?mode=ro", uri=True) as db:
+        rows = db.execute(
+            f'SELECT gene_name, COUNT(*) FROM "{layer}" GROUP BY gene_name')
+        counts = dict(rows.fetchall())
+    return pd.Series(counts, dtype='int64')
+
+
+def _count_file_genes(src, batch_size):
+    counts = pd.Series(dtype='int64')
+    with fiona.open(src, include_fields=['gene_name'], ignore_geometry=True) as f:
+        features = iter(f)
+        while True:
+            genes = [
+                feature['properties']['gene_name']
+                for feature in itertools.islice(features, batch_size)]
+            if not genes:
+                break
+            counts = counts.add(pd.Series(genes).value_counts(), fill_value=0)
+    return counts.astype('int64')
+
+
+def count_tile_genes(metadata, cpu=4, chunksize=DEFAULT_CHUNKSIZE,
+        cache_dir=None) -> pd.Series:
     """
-    create command for reading gene_name columns 
-    from full gene fgb.
-    ogr2ogr -f CSV -sql "select gene_name from \"all\"" \
-    merged.csv merged.fgb
+    number of sDGE entries per gene_name over all tiles in metadata,
+    i.e. the rows per gene convert writes. tiles are counted in parallel
+    with a bincount over gene ids and the per-tile counts summed
     """
-    command = "ogr2ogr -f CSV " +\
-        "-sql \"select gene_name from \\\"all\\\"\" "+\
-        f"{dst_csv} {src_fgb}"
-    print(command)
-    subprocess.call([command], shell=True)
-    # return command
-
-
-def _count_genes(gene_csv, cutoff=1.0):
-    df_all = pd.read_csv(gene_csv)
-    df = df_all['gene_name'].value_counts().reset_index()   # type: ignore
-    df.columns = ['gene_name', 'count']
+    args_list = [
+        (metadata_tile, chunksize, cache_dir)
+        for metadata_tile in metadata['tiles'].values()]
+    total = pd.Series(dtype='int64')
+    with Pool(cpu) as p:
+        for counts in p.imap_unordered(_count_tile, args_list):
+            total = total.add(counts[counts > 0], fill_value=0)
+    return total.astype('int64')
+
+
+def _count_tile(args):
+    metadata_tile, chunksize, cache_dir = args
+    data_dir = Path(metadata_tile['data_dir'])
+    lt_id = f"{data_dir.parent.name}-{data_dir.name}"
+    with report.tile(lt_id):
+        lookup = tile_lookup(
+            data_dir / "barcodes.tsv.gz", data_dir / "features.tsv.gz",
+            cache_dir)
+        counts = np.zeros(len(lookup.genes), dtype=np.int64)
+        chunks = read_chunks(data_dir / "matrix.mtx.gz", chunksize, cache_dir)
+        for df_matrix in chunks:
+            with report.stage('join') as rec:
+                counts += lookup.gene_counts(df_matrix)
+                rec.rows(len(df_matrix), len(df_matrix))
+    return pd.Series(counts, index=lookup.genes)
+
+
+def frequency_table(counts) -> pd.DataFrame:
+    """ gene_name, count, cum_fraction, freq sorted by count descending"""
+    counts = counts[counts > 0].sort_values(ascending=False, kind='stable')
+    df = counts.rename_axis('gene_name').reset_index(name='count')
     df['cum_fraction'] = (df['count'].cumsum() / df['count'].sum())
     df['freq'] = (df['count'] / df['count'].sum())
-
-    df.to_csv("~/data/seqscope/hd30-hml22-incol/count.csv")
-    df = df[df['cum_fraction'] <= cutoff]
     return df
 
 
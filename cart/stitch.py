@@ -1,6 +1,25 @@
 import argparse
-from cv2 import cv2
+import os
+import tempfile
+import warnings
+from multiprocessing import Pool
+from pathlib import Path
+
+import cv2
+import yaml
+import numpy as np
+import rasterio
 from imutils import paths
+from rasterio.enums import ColorInterp, Resampling
+from rasterio.errors import NotGeoreferencedWarning
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+
+BLOCK_SIZE = 512
+# least overlap (pixels) of two images to register them
+MIN_OVERLAP = 16
+# OpenCV's BGR(A) channel order to the RGB(A) of a GeoTIFF
+TO_RGB = {3: cv2.COLOR_BGR2RGB, 4: cv2.COLOR_BGRA2RGBA}
 
 
 def main():
@@ -12,13 +31,42 @@ def main():
     parser.add_argument(
         "-o", "--output", type=str, required=True,
         help="output tiff path")
+    parser.add_argument(
+        "-m", "--meta", type=str, default=None,
+        help="metadata yaml. place images by tile layout; "
+             "image file names are tile ids, e.g. 2-2113.png")
+    parser.add_argument(
+        "-s", "--scale", type=float, default=None,
+        help="image pixels per sDGE unit. from tile_layout grid_width and "
+             "--overlap if not given")
+    parser.add_argument(
+        "--overlap", type=float, default=None,
+        help="fraction of an image's width shared with its neighbour, "
+             "used to derive the scale when -s is not given")
+    parser.add_argument(
+        "-c", "--cpu", type=int, default=6,
+        help="number of processes for refining tile pair offsets")
+    parser.add_argument(
+        "--max-shift", type=int, default=50,
+        help="largest offset correction (pixels) accepted from a tile pair")
+    parser.add_argument(
+        "--blend", type=int, default=50,
+        help="width (pixels) of the feathered seam")
     args = parser.parse_args()
 
-    input_dir = args.input 
+    input_dir = args.input
     output = args.output
     image_paths = sorted(list(paths.list_images(input_dir)))
     print(image_paths, len(image_paths))
-    stitch(image_paths, output)
+    if args.meta is None:
+        stitch(image_paths, output)
+        return
+    with open(args.meta) as f:
+        metadata = yaml.safe_load(f)
+    stitch_layout(
+        image_paths, metadata, output, scale=args.scale,
+        overlap=args.overlap, cpu=args.cpu, max_shift=args.max_shift,
+        blend=args.blend)
 
 
 def stitch(image_paths, output):
@@ -31,5 +79,300 @@ def stitch(image_paths, output):
     print(status)
     cv2.imwrite(output, stitched)
 
+
+def stitch_layout(image_paths, metadata, output, scale=None, overlap=None,
+        cpu=6, max_shift=50, blend=50):
+    '''
+    stitch images placed by the tile layout in metadata instead of
+    matching features across all images. only adjacent tiles are
+    registered, by phase correlation of their overlap, and the positions
+    are solved from the pair offsets and the nominal layout. images are
+    centred on their tiles, so an image larger than its tile (grid size
+    * scale) overlaps its neighbours. without scale it is derived from
+    overlap, the fraction of an image's width shared with a neighbour.
+    returns the pixel positions of the images in the mosaic
+    '''
+    images = {Path(p).name.split('.')[0]: p for p in image_paths}
+    tiles = {k: v for k, v in metadata['tiles'].items() if k in images}
+    if not tiles:
+        raise ValueError("no image is named after a tile in metadata")
+    names = sorted(tiles)
+    shapes = {name: image_header(images[name])[0] for name in names}
+    grid = metadata['tile_layout']
+    if scale is None:
+        scale = shapes[names[0]][1] * (1 - (overlap or 0)) / grid['grid_width']
+    nominal, origin = nominal_positions(
+        tiles, shapes, scale, grid['grid_width'], grid.get('grid_height'))
+
+    pairs = adjacent_pairs(tiles)
+    if pairs and not any(_overlaps(shapes[a], shapes[b], nominal[b] - nominal[a])
+            for a, b in pairs):
+        raise ValueError(
+            "neighbouring images do not overlap at this scale, so their "
+            "offsets cannot be refined. give the overlap or the scale")
+    args_list = [
+        (images[a], images[b], nominal[b] - nominal[a]) for a, b in pairs]
+    with Pool(cpu) as p:
+        results = p.map(_pair_offset, args_list)
+    offsets = []
+    for (a, b), (shift, response) in zip(pairs, results):
+        if response is None or np.abs(shift).max() > max_shift:
+            print(f"{a}-{b}: no reliable overlap, layout offset kept")
+            continue
+        offsets.append((a, b, nominal[b] - nominal[a] + shift))
+    positions, shift = solve_positions(names, nominal, offsets)
+    image_paths = [images[n] for n in names]
+    positions = [positions[n] for n in names]
+    shapes = [shapes[n] for n in names]
+    if Path(output).suffix.lower() in ('.tif', '.tiff'):
+        # epsg:3857 of the mosaic's top left corner, as in convert output
+        left = (origin[0] + shift[0]) / scale
+        top = (origin[1] - shift[1]) / scale
+        write_geotiff(
+            image_paths, positions, shapes, output,
+            from_origin(left, top, 1 / scale, 1 / scale), blend)
+    else:
+        blend_images(image_paths, positions, shapes, output, blend)
+    print(f"stitched {len(names)} images into {output}")
+    return dict(zip(names, positions))
+
+
+def image_header(path):
+    '''
+    (shape, dtype) of an image as cv2.imread(IMREAD_UNCHANGED) returns it,
+    read from the file header without decoding the pixels
+    '''
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', NotGeoreferencedWarning)
+        with rasterio.open(path) as src:
+            height, width, count = src.height, src.width, src.count
+            dtype = np.dtype(src.dtypes[0])
+            if src.colorinterp[0] == ColorInterp.palette:
+                # OpenCV expands palette images to BGR
+                count = 3
+    return ((height, width, count) if count > 1 else (height, width)), dtype
+
+
+def nominal_positions(tiles, shapes, scale, grid_width, grid_height=None):
+    '''
+    (col, row) pixel position of the top left corner of each image in the
+    mosaic, from the false origins of the tiles. images are centred on
+    their tile, the margin beyond the tile (grid size * scale) being the
+    overlap with the neighbours. the vertical margin has the horizontal
+    ratio if grid_height is not known. also returns the (x, y) pixel
+    coordinates of position (0, 0), i.e. epsg:3857 coordinates * scale
+    '''
+    left, top = {}, {}
+    for k, t in tiles.items():
+        h, w = shapes[k][:2]
+        margin_x = w - grid_width * scale
+        if grid_height is None:
+            margin_y = h * margin_x / w
+        else:
+            margin_y = h - grid_height * scale
+        left[k] = -t['false_easting'] * scale - margin_x / 2
+        top[k] = -t['false_northing'] * scale + h - margin_y / 2
+    minx, maxy = min(left.values()), max(top.values())
+    positions = {
+        k: np.array([left[k] - minx, maxy - top[k]]) for k in tiles}
+    return positions, (minx, maxy)
+
+
+def adjacent_pairs(tiles):
+    '''pairs of tiles next to each other in the layout rows and cols'''
+    cells = {(t['row'], t['col']): k for k, t in tiles.items()}
+    pairs = []
+    for (row, col), a in sorted(cells.items()):
+        for neighbour in [(row, col + 1), (row + 1, col)]:
+            if neighbour in cells:
+                pairs.append((a, cells[neighbour]))
+    return pairs
+
+
+def pair_offset(image_a, image_b, nominal, min_overlap=MIN_OVERLAP):
+    '''
+    correction (dx, dy) of b's position relative to a placed at nominal
+    offset, from phase correlation of the overlap of the two images.
+    returns (shift, response); response is None without enough overlap
+    '''
+    if not _overlaps(image_a.shape, image_b.shape, nominal, min_overlap):
+        return np.zeros(2), None
+    ha, wa = image_a.shape[:2]
+    hb, wb = image_b.shape[:2]
+    dx, dy = (int(round(v)) for v in nominal)
+    # overlap in the frame of image a
+    x0, x1 = max(0, dx), min(wa, dx + wb)
+    y0, y1 = max(0, dy), min(ha, dy + hb)
+    strip_a = _gray(image_a[y0:y1, x0:x1])
+    strip_b = _gray(image_b[y0 - dy:y1 - dy, x0 - dx:x1 - dx])
+    window = cv2.createHanningWindow(strip_a.shape[::-1], cv2.CV_64F)
+    (sx, sy), response = cv2.phaseCorrelate(strip_a, strip_b, window)
+    # strip_b is strip_a moved by (sx, sy), so b sits at -(sx, sy)
+    return -np.array([sx, sy]), response
+
+
+def _overlaps(shape_a, shape_b, nominal, min_overlap=MIN_OVERLAP):
+    '''whether b at nominal offset from a overlaps it by min_overlap pixels'''
+    ha, wa = shape_a[:2]
+    hb, wb = shape_b[:2]
+    dx, dy = (int(round(v)) for v in nominal)
+    return (min(wa, dx + wb) - max(0, dx) >= min_overlap and
+            min(ha, dy + hb) - max(0, dy) >= min_overlap)
+
+
+def _pair_offset(args):
+    path_a, path_b, nominal = args
+    return pair_offset(
+        cv2.imread(path_a, cv2.IMREAD_UNCHANGED),
+        cv2.imread(path_b, cv2.IMREAD_UNCHANGED), nominal)
+
+
+def _gray(image):
+    if image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    return image.astype(np.float64)
+
+
+def solve_positions(names, nominal, offsets, prior=1e-3):
+    '''
+    least squares positions from measured pair offsets [(a, b, offset)],
+    weakly tied to the nominal layout so unregistered tiles stay in place.
+    positions are rounded and shifted to start at 0; the shift is
+    returned with them
+    '''
+    index = {n: i for i, n in enumerate(names)}
+    rows, rhs = [], []
+    for a, b, offset in offsets:
+        row = np.zeros(len(names))
+        row[index[b]], row[index[a]] = 1, -1
+        rows.append(row)
+        rhs.append(offset)
+    for n in names:
+        row = np.zeros(len(names))
+        row[index[n]] = prior
+        rows.append(row)
+        rhs.append(prior * np.asarray(nominal[n], dtype=float))
+    solution, *_ = np.linalg.lstsq(np.array(rows), np.array(rhs), rcond=None)
+    # images are pasted at whole pixels
+    solution = np.round(solution)
+    shift = solution.min(axis=0)
+    solution -= shift
+    return {n: solution[index[n]] for n in names}, shift
+
+
+def blend_images(image_paths, positions, shapes, output, blend=50):
+    '''
+    paste images at positions into one mosaic, feathering the seams over
+    `blend` pixels from each image border. the mosaic is blended one
+    block row at a time into a disk backed array, but OpenCV encodes it
+    in one piece, so the output is limited by memory (1 byte per pixel
+    and channel). use write_geotiff (a .tif output) for large mosaics
+    '''
+    corners = [np.round(p).astype(int) for p in positions]
+    width = max(c[0] + s[1] for c, s in zip(corners, shapes))
+    height = max(c[1] + s[0] for c, s in zip(corners, shapes))
+    channels = shapes[0][2] if len(shapes[0]) == 3 else 1
+    dtype = image_header(image_paths[0])[1]
+    out_dir = Path(output).parent
+    out_dir.mkdir(parents=True, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=out_dir) as tmp:
+        mosaic = np.memmap(
+            os.path.join(tmp, 'mosaic.bin'), dtype=dtype, mode='w+',
+            shape=(height, width, channels))
+        rows = _blended_rows(
+            image_paths, corners, shapes, width, height, channels, dtype,
+            blend)
+        for row0, block in rows:
+            mosaic[row0:row0 + len(block)] = block
+        cv2.imwrite(str(output), mosaic if channels > 1 else mosaic[..., 0])
+        del mosaic
+
+
+def write_geotiff(image_paths, positions, shapes, output, transform,
+        blend=50):
+    '''
+    blend images into a tiled, compressed epsg:3857 GeoTIFF with overviews.
+    the mosaic is written one block row at a time; only the images
+    overlapping the current block row are held in memory
+    '''
+    corners = [np.round(p).astype(int) for p in positions]
+    width = max(c[0] + s[1] for c, s in zip(corners, shapes))
+    height = max(c[1] + s[0] for c, s in zip(corners, shapes))
+    channels = shapes[0][2] if len(shapes[0]) == 3 else 1
+    profile = {
+        'driver': 'GTiff',
+        'dtype': image_header(image_paths[0])[1].name,
+        'count': channels,
+        'width': width,
+        'height': height,
+        'crs': 'EPSG:3857',
+        'transform': transform,
+        'tiled': True,
+        'blockxsize': BLOCK_SIZE,
+        'blockysize': BLOCK_SIZE,
+        'compress': 'deflate',
+        'BIGTIFF': 'IF_SAFER',
+    }
+    if channels in TO_RGB:
+        profile['photometric'] = 'RGB'
+    if channels == 4:
+        profile['alpha'] = 'YES'
+    Path(output).parent.mkdir(parents=True, exist_ok=True)
+    with rasterio.open(output, 'w', **profile) as dst:
+        rows = _blended_rows(
+            image_paths, corners, shapes, width, height, channels,
+            profile['dtype'], blend, rgb=True)
+        for row0, block in rows:
+            dst.write(
+                np.moveaxis(block, 2, 0),
+                window=Window(0, row0, width, len(block)))
+        factors = []
+        while max(width, height) // 2 ** (len(factors) + 1) >= BLOCK_SIZE // 2:
+            factors.append(2 ** (len(factors) + 1))
+        if factors:
+            dst.build_overviews(factors, Resampling.average)
+            dst.update_tags(ns='rio_overview', resampling='average')
+
+
+def _blended_rows(image_paths, corners, shapes, width, height, channels,
+        dtype, blend, rgb=False):
+    '''
+    (first row, block) of the feathered mosaic, BLOCK_SIZE rows at a time.
+    only the images overlapping the current block row are held in memory
+    '''
+    loaded = {}
+    for row0 in range(0, height, BLOCK_SIZE):
+        row1 = min(row0 + BLOCK_SIZE, height)
+        total = np.zeros((row1 - row0, width, channels), dtype='float32')
+        weight = np.zeros((row1 - row0, width), dtype='float32')
+        for i, (x, y) in enumerate(corners):
+            h, w = shapes[i][:2]
+            if y >= row1 or y + h <= row0:
+                loaded.pop(i, None)
+                continue
+            if i not in loaded:
+                image = cv2.imread(image_paths[i], cv2.IMREAD_UNCHANGED)
+                if rgb and channels in TO_RGB:
+                    image = cv2.cvtColor(image, TO_RGB[channels])
+                loaded[i] = (
+                    image.reshape(h, w, channels), _feather(h, w, blend))
+            image, w_map = loaded[i]
+            r0, r1 = max(row0, y), min(row1, y + h)
+            part = w_map[r0 - y:r1 - y]
+            total[r0 - row0:r1 - row0, x:x + w] += \
+                image[r0 - y:r1 - y] * part[..., None]
+            weight[r0 - row0:r1 - row0, x:x + w] += part
+        block = total / np.maximum(weight, 1e-6)[..., None]
+        yield row0, block.round().astype(dtype)
+
+
+def _feather(h, w, blend):
+    '''weights rising linearly from the border over blend pixels'''
+    ramp_y = np.minimum(np.arange(h), np.arange(h)[::-1]) + 1
+    ramp_x = np.minimum(np.arange(w), np.arange(w)[::-1]) + 1
+    ramp = np.minimum.outer(ramp_y, ramp_x).astype('float32')
+    return np.clip(ramp / max(blend, 1), 0, 1)
+
+
 if __name__=='__main__':
     main()
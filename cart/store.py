@@ -0,0 +1,145 @@
+"""
+gene-partitioned parquet store of a merged dataset
+
+written by `split --store`, read by `filter` and `split.count_genes`.
+genes.json next to the dataset maps each gene to its row count and
+files, so a gene or marker set is loaded without scanning the merged file
+"""
+
+import json
+import resource
+from pathlib import Path
+
+import fiona
+import pandas as pd
+import geopandas as gpd
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from . import report
+
+
+GENE_INDEX = 'genes.json'
+
+
+def write_gene_store(src, store_dir, batch_size=1000000, genes=None):
+    """
+    write src (merged points, layer 'all') into a parquet dataset
+    partitioned by gene_name in a single pass, with x/y columns in place
+    of geometry. genes.json maps each gene to its row count and files,
+    so one gene is loaded by reading only its own files (read_gene).
+    genes is the number of distinct gene names if known; otherwise a
+    batch is bounded by its batch_size rows
+    """
+    store_dir = Path(store_dir).expanduser()
+    partitions = max(genes or batch_size, 1)
+    counts = {}
+    with report.stage('write') as rec, fiona.open(src) as f:
+        crs_wkt = f.crs_wkt
+        schema = _arrow_schema(f.schema)
+        batches = _iter_point_batches(f, batch_size, schema, counts)
+        ds.write_dataset(
+            batches, store_dir,
+            schema=schema, format='parquet',
+            partitioning=['gene_name'], partitioning_flavor='hive',
+            max_partitions=partitions,
+            max_open_files=_max_open_files(partitions),
+            existing_data_behavior='delete_matching')
+        rec.read(src)
+        rec.rows(sum(counts.values()), sum(counts.values()))
+
+    files = {}
+    dataset = ds.dataset(store_dir, format='parquet', partitioning='hive')
+    for fragment in dataset.get_fragments():
+        gene = ds.get_partition_keys(fragment.partition_expression)['gene_name']
+        files.setdefault(gene, []).append(
+            str(Path(fragment.path).relative_to(store_dir)))
+    index = {
+        'crs_wkt': crs_wkt,
+        'genes': {
+            gene: {'count': int(count), 'files': sorted(files[gene])}
+            for gene, count in sorted(counts.items())},
+    }
+    with open(store_dir / GENE_INDEX, 'w') as f:
+        json.dump(index, f)
+    print(f"gene store written to {store_dir}")
+
+
+def read_gene(store_dir, gene_name) -> gpd.GeoDataFrame:
+    """ load the points of one gene from a gene store"""
+    return read_genes(store_dir, [gene_name])
+
+
+def read_genes(store_dir, gene_names) -> gpd.GeoDataFrame:
+    """ load the points of a list of genes (e.g. a marker set)"""
+    store_dir = Path(store_dir).expanduser()
+    with open(store_dir / GENE_INDEX) as f:
+        index = json.load(f)
+    tables = []
+    for gene in dict.fromkeys(gene_names):
+        entry = index['genes'].get(gene)
+        if entry is None:
+            continue
+        table = ds.dataset(
+            [str(store_dir / p) for p in entry['files']],
+            format='parquet').to_table()
+        tables.append(table.to_pandas().assign(gene_name=gene))
+    if tables:
+        df = pd.concat(tables, ignore_index=True)
+    else:
+        df = pd.DataFrame(columns=['x', 'y', 'gene_name'])
+    return gpd.GeoDataFrame(
+        df.drop(columns=['x', 'y']),
+        geometry=gpd.points_from_xy(df['x'], df['y']),
+        crs=index['crs_wkt'])
+
+
+def is_gene_store(path):
+    """ check whether path is a store written by write_gene_store"""
+    return (Path(path).expanduser() / GENE_INDEX).exists()
+
+
+def _arrow_schema(schema):
+    """ arrow schema of x, y and the fiona properties"""
+    types = {'int32': pa.int32(), 'int': pa.int64(), 'int64': pa.int64(),
+             'float': pa.float64(), 'str': pa.string(), 'bool': pa.bool_()}
+    fields = [('x', pa.float64()), ('y', pa.float64())]
+    for name, kind in schema['properties'].items():
+        fields.append((name, types[kind.split(':')[0]]))
+    return pa.schema(fields)
+
+
+def _max_open_files(partitions):
+    '''
+    one open file per gene, within the file descriptor limit. above it
+    pyarrow closes the least recently used file and the gene gets another
+    '''
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        return partitions
+    return max(min(partitions, soft - 64), 1)
+
+
+def _iter_point_batches(src, batch_size, schema, counts):
+    """
+    yield record batches with x, y and the attributes of point features,
+    counting rows per gene_name into counts
+    """
+    names = list(src.schema['properties'])
+    rows = []
+    for feature in src:
+        x, y = feature['geometry']['coordinates'][:2]
+        properties = feature['properties']
+        rows.append([x, y] + [properties[n] for n in names])
+        if len(rows) >= batch_size:
+            yield _point_batch(rows, schema, counts)
+            rows = []
+    if rows:
+        yield _point_batch(rows, schema, counts)
+
+
+def _point_batch(rows, schema, counts):
+    df = pd.DataFrame(rows, columns=schema.names)
+    for gene, count in df['gene_name'].value_counts().items():
+        counts[gene] = counts.get(gene, 0) + count
+    return pa.RecordBatch.from_pandas(df, schema=schema, preserve_index=False)
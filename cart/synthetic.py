@@ -0,0 +1,212 @@
+"""
+Synthetic STTools output for tests and benchmarks.
+
+Writes a lane/tile tree of sDGE files with the same layout and columns as
+STTools, plus an LDA hexagon fit result and a factor DE table:
+
+```
+root/
+    2/2101/barcodes.tsv.gz
+    2/2101/features.tsv.gz
+    2/2101/matrix.mtx.gz
+    ...
+    analysis/LDA_hexagon.nFactor_10.d_18.lane_2.2101_2102.fit_result.tsv.gz
+    analysis/de.tsv.gz
+```
+
+barcodes are spread uniformly over the tile, genes per barcode follow a
+Zipf-like distribution so a few genes dominate as in real data.
+"""
+
+import argparse
+import gzip
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+
+# (barcodes per tile, genes, tiles) of the preset scales
+SCALES = {
+    'tiny': (2_000, 200, 2),
+    'small': (50_000, 2_000, 4),
+    'medium': (500_000, 20_000, 8),
+    'large': (2_000_000, 30_000, 32),
+}
+TILE_WIDTH = 98749
+TILE_HEIGHT = 20299
+
+
+def main():
+    """
+    run script for generating a synthetic dataset
+    ```
+    $ python -m cart.synthetic -o /tmp/synthetic --scale small
+    ```
+    """
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic STTools output")
+    parser.add_argument(
+        "-o", "--output", type=str, required=True,
+        help="output data root")
+    parser.add_argument(
+        "--scale", type=str, default='small', choices=list(SCALES),
+        help="preset of barcodes per tile, genes and tiles")
+    parser.add_argument(
+        "-b", "--barcodes", type=int, default=None,
+        help="barcodes per tile, overrides the scale")
+    parser.add_argument(
+        "-g", "--genes", type=int, default=None,
+        help="number of genes, overrides the scale")
+    parser.add_argument(
+        "-t", "--tiles", type=int, default=None,
+        help="number of tiles, overrides the scale")
+    parser.add_argument(
+        "-e", "--entries", type=float, default=3,
+        help="mean number of genes per barcode")
+    parser.add_argument(
+        "--seed", type=int, default=0,
+        help="random seed")
+    args = parser.parse_args()
+    barcodes, genes, tiles = SCALES[args.scale]
+    generate(
+        args.output,
+        barcodes=args.barcodes or barcodes,
+        genes=args.genes or genes,
+        tiles=args.tiles or tiles,
+        entries=args.entries, seed=args.seed)
+
+
+def generate(root, barcodes=50_000, genes=2_000, tiles=4, lane=2,
+        entries=3, factors=10, seed=0):
+    '''
+    write a synthetic dataset of `tiles` tiles of lane `lane` under root.
+    returns the list of tile directories
+    '''
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+    # tiles 2101, 2102, ... then 2201, ... like the hiseq layout
+    tile_ids = [
+        lane * 1000 + 100 * (1 + i // 16) + 1 + i % 16 for i in range(tiles)]
+    gene_names = [f"Gene{i}" for i in range(1, genes + 1)]
+    weights = 1 / np.arange(1, genes + 1)
+    weights /= weights.sum()
+
+    tile_dirs = []
+    for tile_id in tile_ids:
+        tile_dir = root / str(lane) / str(tile_id)
+        tile_dir.mkdir(parents=True, exist_ok=True)
+        matrix = _write_matrix(tile_dir, rng, barcodes, genes, weights, entries)
+        _write_barcodes(tile_dir, rng, barcodes, lane, tile_id, matrix)
+        _write_features(tile_dir, gene_names, matrix)
+        tile_dirs.append(tile_dir)
+
+    analysis = root / "analysis"
+    analysis.mkdir(parents=True, exist_ok=True)
+    _write_fit_result(analysis, rng, lane, tile_ids, factors)
+    _write_de(analysis, rng, gene_names, factors)
+    return tile_dirs
+
+
+def _write_matrix(tile_dir, rng, barcodes, genes, weights, entries):
+    counts_per_barcode = rng.poisson(entries, barcodes) + 1
+    barcode_id = np.repeat(np.arange(1, barcodes + 1), counts_per_barcode)
+    gene_id = rng.choice(genes, size=len(barcode_id), p=weights) + 1
+    df = pd.DataFrame({'gene_id': gene_id, 'barcode_id': barcode_id})
+    df = df.drop_duplicates().sort_values(['barcode_id', 'gene_id'])
+    n = len(df)
+    df['cnt_spliced'] = rng.geometric(0.7, n) - (rng.random(n) < 0.3)
+    df['cnt_unspliced'] = rng.binomial(2, 0.15, n)
+    df['cnt_ambiguous'] = rng.binomial(1, 0.05, n)
+    # every entry of a sparse matrix has at least one count
+    empty = df[['cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']].sum(axis=1) == 0
+    df.loc[empty, 'cnt_spliced'] = 1
+    with gzip.open(tile_dir / "matrix.mtx.gz", 'wt') as f:
+        f.write("%%MatrixMarket matrix coordinate integer general\n%\n")
+        f.write(f"{genes} {barcodes} {n}\n")
+        df.to_csv(f, sep=" ", header=False, index=False)
+    return df
+
+
+def _write_barcodes(tile_dir, rng, barcodes, lane, tile_id, matrix):
+    totals = matrix.groupby('barcode_id')[
+        ['cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']].sum()
+    totals = totals.reindex(np.arange(1, barcodes + 1), fill_value=0)
+    bases = np.array(list("ACGT"))
+    letters = bases[rng.integers(0, 4, (barcodes, 30))]
+    df = pd.DataFrame({
+        'barcode': letters.view(f"<U30").ravel(),
+        'barcode_id': np.arange(1, barcodes + 1),
+        'col1': rng.integers(1, 10_000, barcodes),
+        'col2': rng.integers(1, 10, barcodes),
+        'lane': lane,
+        'tile': tile_id,
+        'y': rng.integers(0, TILE_HEIGHT, barcodes),
+        'x': rng.integers(0, TILE_WIDTH, barcodes),
+        'counts': _joined(totals),
+    })
+    df.to_csv(
+        tile_dir / "barcodes.tsv.gz", sep="\t", header=False, index=False)
+
+
+def _write_features(tile_dir, gene_names, matrix):
+    totals = matrix.groupby('gene_id')[
+        ['cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']].sum()
+    gene_ids = np.arange(1, len(gene_names) + 1)
+    totals = totals.reindex(gene_ids, fill_value=0)
+    df = pd.DataFrame({
+        'name': [f"ENSMUSG{i:011d}" for i in gene_ids],
+        'gene_name': gene_names,
+        'desc': "Gene Expression",
+        'gene_id': gene_ids,
+        'total_count': totals.sum(axis=1).to_numpy(),
+        'counts': _joined(totals),
+    })
+    df.to_csv(
+        tile_dir / "features.tsv.gz", sep="\t", header=False, index=False)
+
+
+def _write_fit_result(analysis, rng, lane, tile_ids, factors, d=18):
+    '''LDA hexagon centers in hexagon units, columns as read by cart.factor'''
+    n = max(1, len(tile_ids) * TILE_WIDTH * TILE_HEIGHT // (d * 80) ** 2)
+    df = pd.DataFrame({
+        'Hex_center_x': rng.uniform(0, TILE_HEIGHT / 80, n),
+        'Hex_center_y': rng.uniform(0, len(tile_ids) * TILE_WIDTH / 80, n),
+        'offs_x': rng.integers(0, 2, n),
+        'offs_y': rng.integers(0, 2, n),
+        'hex_x': rng.integers(0, 1000, n),
+        'hex_y': rng.integers(0, 1000, n),
+    })
+    theta = rng.dirichlet(np.full(factors, 0.3), n)
+    df['topK'] = theta.argmax(axis=1)
+    for k in range(factors):
+        df[str(k)] = theta[:, k].round(6)
+    tiles = "_".join(str(t) for t in tile_ids)
+    name = f"LDA_hexagon.nFactor_{factors}.d_{d}.lane_{lane}.{tiles}.fit_result.tsv.gz"
+    df.to_csv(analysis / name, sep="\t", index=False)
+
+
+def _write_de(analysis, rng, gene_names, factors):
+    '''factor DE table with the columns read by cart.factorde'''
+    n = len(gene_names)
+    df = pd.DataFrame({
+        'gene': np.tile(gene_names, factors),
+        'factor': np.repeat(np.arange(factors), n),
+        'Chi2': rng.exponential(50, n * factors).round(3),
+        'pval': rng.uniform(0, 1, n * factors),
+        'FoldChange': rng.lognormal(0, 1, n * factors).round(4),
+        'gene_tot': np.tile(rng.integers(1, 10_000, n), factors),
+    })
+    df.to_csv(analysis / "de.tsv.gz", sep="\t", index=False)
+
+
+def _joined(totals):
+    '''"spliced,unspliced,ambiguous" strings of count totals'''
+    values = totals.to_numpy().astype(str)
+    return np.char.add(
+        np.char.add(np.char.add(values[:, 0], ","), values[:, 1]),
+        np.char.add(",", values[:, 2]))
+
+
+if __name__ == '__main__':
+    main()
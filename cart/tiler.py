@@ -0,0 +1,473 @@
+"""
+Vector tile generator writing Mapbox Vector Tiles into one MBTiles archive.
+
+Features are sorted along a Z-order (Morton) curve of their max-zoom tile,
+so every tile at every zoom level is one contiguous range of point rows.
+Polygons are added to every tile their bounds (plus a buffer) intersect
+and clipped to the buffered tile. Tiles are encoded in parallel across
+processes. When a tile holds more than
+`max_features`, points are aggregated per pixel (numeric attributes summed)
+and then thinned with an even stride over the curve.
+"""
+
+import argparse
+import gzip
+import json
+import math
+import os
+import sqlite3
+import struct
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+
+
+ORIGIN = 20037508.342789244  # half of the epsg:3857 world width
+EXTENT = 4096
+TILES_PER_TASK = 64
+BUFFER = 64  # polygons are clipped this far outside the tile extent
+
+POINT, POLYGON = 1, 3  # mvt geometry types
+
+
+def main():
+    """
+    run script for creating vector tiles
+    ```
+    $ python -m cart.tiler -i marker.gpkg -o marker.mbtiles -z 9 -Z 12
+    ````
+    """
+    parser = argparse.ArgumentParser(
+        description="Create MBTiles vector tiles from point or hexagon data")
+    parser.add_argument(
+        "-i", "--input", type=str, required=True,
+        help="Input geospatial file (epsg:3857 points or polygons)")
+    parser.add_argument(
+        "-o", "--output", type=str, required=True,
+        help="Output mbtiles path")
+    parser.add_argument(
+        "-l", "--layer", type=str, default=None,
+        help="input layer name. output layer has the same name")
+    parser.add_argument(
+        "-z", "--minzoom", type=int, default=9,
+        help="min zoom")
+    parser.add_argument(
+        "-Z", "--maxzoom", type=int, default=12,
+        help="max zoom")
+    parser.add_argument(
+        "-f", "--max-features", type=int, default=200000,
+        help="max features per tile before aggregation and thinning")
+    parser.add_argument(
+        "-c", "--cpu", type=int, default=6,
+        help="number of processes")
+    args = parser.parse_args()
+
+    gdf = gpd.read_file(args.input, layer=args.layer)
+    layer = args.layer or os.path.splitext(os.path.basename(args.input))[0]
+    create_tiles(
+        gdf, args.output, layer=layer,
+        minzoom=args.minzoom, maxzoom=args.maxzoom,
+        max_features=args.max_features, cpu=args.cpu)
+
+
+def create_tiles(gdf, output, layer='all', minzoom=9, maxzoom=12,
+        max_features=200000, cpu=6):
+    '''
+    cut gdf (output of convert.matrix2gdf or factor.xy_to_hexagon)
+    into vector tiles from minzoom to maxzoom and write one mbtiles file
+    '''
+    if gdf.crs is not None and gdf.crs.to_epsg() != 3857:
+        gdf = gdf.to_crs('epsg:3857')  # type: ignore
+    features = _prepare(gdf, maxzoom)
+    tasks = []
+    for zoom in range(minzoom, maxzoom + 1):
+        keys, rows = tile_rows(features, zoom)
+        _, starts = np.unique(keys, return_index=True)
+        bounds = np.append(starts, len(keys))
+        tiles = [
+            (int(keys[start]),
+             range(start, stop) if rows is None else rows[start:stop])
+            for start, stop in zip(bounds[:-1], bounds[1:])]
+        for i in range(0, len(tiles), TILES_PER_TASK):
+            tasks.append((zoom, tiles[i:i + TILES_PER_TASK]))
+
+    if os.path.exists(output):
+        os.remove(output)
+    with sqlite3.connect(output) as db:
+        _init_mbtiles(db, gdf, features, layer, minzoom, maxzoom)
+        with Pool(cpu, initializer=_init_worker,
+                initargs=(features, layer, max_features)) as p:
+            for tiles in p.imap_unordered(_encode_tiles, tasks):
+                db.executemany(
+                    "INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                    [(z, x, (1 << z) - 1 - y, blob) for z, x, y, blob in tiles])
+    print(f"tiles written to {output}")
+
+
+def _prepare(gdf, maxzoom):
+    '''
+    flatten geometries into coordinate arrays and sort them along
+    the Z-order curve of their tiles at maxzoom
+    '''
+    geom_types = set(gdf.geom_type.unique())
+    if geom_types == {'Point'}:
+        geom_type = POINT
+        coords = shapely.get_coordinates(gdf.geometry.values)
+        offsets = np.arange(len(gdf) + 1)
+        centers = coords
+    elif geom_types == {'Polygon'}:
+        geom_type = POLYGON
+        rings = shapely.get_exterior_ring(gdf.geometry.values)
+        coords, index = shapely.get_coordinates(rings, return_index=True)
+        offsets = np.searchsorted(index, np.arange(len(gdf) + 1))
+        centers = shapely.get_coordinates(shapely.centroid(gdf.geometry.values))
+    else:
+        raise ValueError(f"unsupported geometry types {geom_types}")
+
+    n = 1 << maxzoom
+    size = 2 * ORIGIN / n
+    tx = np.clip(((centers[:, 0] + ORIGIN) // size).astype(np.int64), 0, n - 1)
+    ty = np.clip(((ORIGIN - centers[:, 1]) // size).astype(np.int64), 0, n - 1)
+    keys = morton_key(tx, ty)
+    order = np.argsort(keys, kind='stable')
+
+    lengths = np.diff(offsets)[order]
+    coord_index = np.repeat(offsets[:-1][order], lengths) + (
+        np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths))
+    properties = pd.DataFrame(gdf.drop(columns=gdf.geometry.name)).iloc[order]
+    features = {
+        'geom_type': geom_type,
+        'maxzoom': maxzoom,
+        'keys': keys[order],
+        'coords': coords[coord_index],
+        'offsets': np.concatenate([[0], np.cumsum(lengths)]),
+        'properties': properties.reset_index(drop=True),
+    }
+    if geom_type == POLYGON:
+        features['bounds'] = shapely.bounds(gdf.geometry.values)[order]
+    return features
+
+
+def tile_rows(features, zoom):
+    '''
+    Z-order keys at zoom of the tiles of features, sorted, and the feature
+    row of each (None when it is the key's index, i.e. for points). a
+    polygon is listed under every tile its bounds plus BUFFER intersect
+    '''
+    shift = 2 * (features['maxzoom'] - zoom)
+    if features['geom_type'] == POINT:
+        return features['keys'] >> np.uint64(shift), None
+    n = 1 << zoom
+    size = 2 * ORIGIN / n
+    pad = BUFFER / EXTENT * size
+    minx, miny, maxx, maxy = features['bounds'].T
+    tx0 = np.clip((minx - pad + ORIGIN) // size, 0, n - 1).astype(np.int64)
+    tx1 = np.clip((maxx + pad + ORIGIN) // size, 0, n - 1).astype(np.int64)
+    ty0 = np.clip((ORIGIN - maxy - pad) // size, 0, n - 1).astype(np.int64)
+    ty1 = np.clip((ORIGIN - miny + pad) // size, 0, n - 1).astype(np.int64)
+    width = tx1 - tx0 + 1
+    counts = width * (ty1 - ty0 + 1)
+    rows = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    keys = morton_key(tx0[rows] + k % width[rows], ty0[rows] + k // width[rows])
+    # stable, so rows stay in curve order within a tile
+    order = np.argsort(keys, kind='stable')
+    return keys[order], rows[order]
+
+
+def morton_key(tx, ty):
+    '''interleave bits of tile x (even bits) and tile y (odd bits)'''
+    return _part1by1(tx) | (_part1by1(ty) << 1)
+
+
+def _part1by1(v):
+    v = np.asarray(v, dtype=np.uint64) & np.uint64(0xFFFFFFFF)
+    for shift, mask in [
+            (16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+            (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+            (1, 0x5555555555555555)]:
+        v = (v | (v << np.uint64(shift))) & np.uint64(mask)
+    return v
+
+
+def tile_of_key(key, zoom):
+    '''(x, y) of a tile from its Z-order key at zoom'''
+    x = y = 0
+    for bit in range(zoom):
+        x |= ((key >> (2 * bit)) & 1) << bit
+        y |= ((key >> (2 * bit + 1)) & 1) << bit
+    return x, y
+
+
+_worker = {}
+
+
+def _init_worker(features, layer, max_features):
+    _worker.update(features=features, layer=layer, max_features=max_features)
+
+
+def _encode_tiles(task):
+    ''' pool worker. encode a group of tiles (key, rows) at one zoom'''
+    zoom, group = task
+    features = _worker['features']
+    tiles = []
+    for key, rows in group:
+        x, y = tile_of_key(key, zoom)
+        blob = encode_tile(
+            features, rows, zoom, x, y,
+            _worker['layer'], _worker['max_features'])
+        if blob is not None:
+            tiles.append((zoom, x, y, gzip.compress(blob)))
+    return tiles
+
+
+def encode_tile(features, rows, zoom, x, y, layer, max_features):
+    '''
+    encode feature rows (a range or an index array) as an mvt tile
+    (z, x, y), clipping polygons to the tile plus BUFFER
+    '''
+    if isinstance(rows, range):
+        rows = np.arange(rows.start, rows.stop)
+    size = 2 * ORIGIN / (1 << zoom)
+    minx = x * size - ORIGIN
+    maxy = ORIGIN - y * size
+    starts = features['offsets'][rows]
+    lengths = features['offsets'][rows + 1] - starts
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+    coords = features['coords'][
+        np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])]
+    qx = (coords[:, 0] - minx) / size * EXTENT
+    qy = (maxy - coords[:, 1]) / size * EXTENT
+    properties = features['properties'].iloc[rows]
+
+    if features['geom_type'] == POINT:
+        qx = np.round(qx).astype(np.int64)
+        qy = np.round(qy).astype(np.int64)
+        if len(properties) > max_features:
+            qx, qy, properties = _aggregate_points(qx, qy, properties)
+        rows = _thin(len(properties), max_features)
+        geometries = (_point_geometry(qx[i], qy[i]) for i in rows)
+    else:
+        rows = _thin(len(properties), max_features)
+        geometries = _clipped_rings(qx, qy, offsets, rows)
+    properties = properties.iloc[rows]
+    return _encode_layer(
+        layer, features['geom_type'], geometries, properties)
+
+
+def _aggregate_points(qx, qy, properties):
+    '''
+    merge points on the same pixel, summing numeric attributes. null
+    attributes are a group of their own, so no point is lost
+    '''
+    numeric = properties.select_dtypes('number').columns.tolist()
+    others = [c for c in properties.columns if c not in numeric]
+    df = properties.assign(_qx=qx, _qy=qy)
+    df = (df
+        .groupby(
+            ['_qx', '_qy'] + others, sort=False, observed=True, dropna=False)[numeric]
+        .sum()
+        .reset_index())
+    return (df['_qx'].to_numpy(), df['_qy'].to_numpy(),
+            df.drop(columns=['_qx', '_qy'])[properties.columns])
+
+
+def _thin(n, max_features):
+    '''evenly spaced rows along the curve, at most max_features'''
+    if n <= max_features:
+        return np.arange(n)
+    return np.unique(np.linspace(0, n - 1, max_features).astype(np.int64))
+
+
+def _point_geometry(qx, qy):
+    return [_command(1, 1), _zigzag(int(qx)), _zigzag(int(qy))]
+
+
+def _clipped_rings(qx, qy, offsets, rows):
+    '''
+    polygon geometries of rows clipped to the buffered tile extent, in
+    tile coordinates. a polygon split by the clip becomes a multipolygon
+    '''
+    starts = offsets[rows]
+    lengths = offsets[rows + 1] - starts
+    index = np.repeat(np.arange(len(rows)), lengths)
+    take = np.repeat(starts - (np.cumsum(lengths) - lengths), lengths) + \
+        np.arange(lengths.sum())
+    polygons = shapely.polygons(shapely.linearrings(
+        np.column_stack([qx[take], qy[take]]), indices=index))
+    clipped = shapely.clip_by_rect(
+        polygons, -BUFFER, -BUFFER, EXTENT + BUFFER, EXTENT + BUFFER)
+    parts, part_index = shapely.get_parts(clipped, return_index=True)
+    is_polygon = shapely.get_type_id(parts) == 3
+    parts, part_index = parts[is_polygon], part_index[is_polygon]
+    coords, ring = shapely.get_coordinates(
+        shapely.get_exterior_ring(parts), return_index=True)
+    coords = np.round(coords).astype(np.int64)
+    coords, ring = _ring_vertices(coords, ring)
+    # rings are contiguous per feature, so the cursor of each vertex is the
+    # previous vertex, or (0, 0) at the first vertex of a feature
+    feature = part_index[ring]
+    first = np.diff(feature, prepend=-1) != 0
+    deltas = coords - np.where(first[:, None], 0, np.roll(coords, 1, axis=0))
+    params = ((deltas << 1) ^ (deltas >> 63)).ravel().tolist()
+    ring_bounds = np.append(np.flatnonzero(np.diff(ring, prepend=-1)), len(ring))
+    feature_rings = np.searchsorted(
+        feature[ring_bounds[:-1]], np.arange(len(rows) + 1))
+    for i in range(len(rows)):
+        geometry = []
+        for j in range(feature_rings[i], feature_rings[i + 1]):
+            start, stop = ring_bounds[j], ring_bounds[j + 1]
+            geometry += (
+                [_command(1, 1)] + params[2 * start:2 * start + 2] +
+                [_command(2, stop - start - 1)] +
+                params[2 * start + 2:2 * stop] + [_command(7, 1)])
+        yield geometry or None
+
+
+def _ring_vertices(coords, ring):
+    '''
+    vertices of closed rings (coords with ring index) without repeated
+    and closing vertices, clockwise in tile coordinates. rings of less
+    than 3 vertices or no area are dropped
+    '''
+    start = np.diff(ring, prepend=-1) != 0
+    last = np.append(start[1:], True)[:len(ring)]
+    repeated = ~start & np.all(coords == np.roll(coords, 1, axis=0), axis=1)
+    keep = ~last & ~repeated
+    coords, ring = coords[keep], ring[keep]
+    # a ring ending on its first vertex once repeats are dropped
+    starts, lengths = _runs(ring)
+    first = np.repeat(starts, lengths)
+    start = np.diff(ring, prepend=-1) != 0
+    last = np.append(start[1:], True)[:len(ring)]
+    keep = ~(last & ~start & np.all(coords == coords[first], axis=1))
+    coords, ring = coords[keep], ring[keep]
+
+    starts, lengths = _runs(ring)
+    first = np.repeat(starts, lengths)
+    following = np.arange(1, len(ring) + 1)
+    following[starts + lengths - 1] = starts
+    x, y = coords[:, 0], coords[:, 1]
+    area = np.zeros(len(starts), dtype=np.int64)
+    if len(starts):
+        area = np.add.reduceat(x * y[following] - x[following] * y, starts)
+    # reverse counter-clockwise rings in place
+    reverse = np.repeat(area < 0, lengths)
+    position = np.arange(len(ring))
+    position[reverse] = (2 * first + np.repeat(lengths, lengths) - 1 -
+                         position)[reverse]
+    coords = coords[position]
+    valid = np.repeat((lengths >= 3) & (area != 0), lengths)
+    return coords[valid], ring[valid]
+
+
+def _runs(index):
+    '''start and length of the runs of equal values of a sorted index'''
+    starts = np.flatnonzero(np.diff(index, prepend=-1))
+    return starts, np.diff(np.append(starts, len(index)))
+
+
+def _command(command_id, count):
+    return (command_id & 0x7) | (count << 3)
+
+
+def _zigzag(n):
+    return (n << 1) ^ (n >> 63)
+
+
+def _encode_layer(name, geom_type, geometries, properties):
+    '''encode features into a single-layer mvt tile message'''
+    columns = properties.columns.tolist()
+    values = [properties[c].tolist() for c in columns]
+    value_index = {}
+    encoded = []
+    for row, geometry in enumerate(geometries):
+        if geometry is None:
+            continue
+        tags = []
+        for k, column in enumerate(values):
+            value = column[row]
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            key = (type(value), value)
+            if key not in value_index:
+                value_index[key] = len(value_index)
+            tags += [k, value_index[key]]
+        encoded.append(
+            _packed(2, tags) + _field(3, _varint(geom_type), wire=0) +
+            _packed(4, geometry))
+    if not encoded:
+        return None
+    layer = _field(15, _varint(2), wire=0) + _field(1, name.encode())
+    layer += b''.join(_field(2, f) for f in encoded)
+    layer += b''.join(_field(3, str(c).encode()) for c in columns)
+    layer += b''.join(_field(4, _value(v)) for _, v in value_index)
+    layer += _field(5, _varint(EXTENT), wire=0)
+    return _field(3, layer)
+
+
+def _value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return _field(7, _varint(int(value)), wire=0)
+    if isinstance(value, (int, np.integer)):
+        return _field(6, _varint(_zigzag(int(value))), wire=0)
+    if isinstance(value, (float, np.floating)):
+        return _field(3, struct.pack('<d', value), wire=1)
+    return _field(1, str(value).encode())
+
+
+def _field(number, payload, wire=2):
+    ''' protobuf field. length-delimited unless wire is 0 (varint) or 1 (64-bit)'''
+    if wire == 2:
+        return _varint(number << 3 | 2) + _varint(len(payload)) + payload
+    return _varint(number << 3 | wire) + payload
+
+
+def _packed(number, values):
+    return _field(number, b''.join(_varint(v) for v in values))
+
+
+def _varint(n):
+    out = bytearray()
+    while n > 0x7f:
+        out.append((n & 0x7f) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _init_mbtiles(db, gdf, features, layer, minzoom, maxzoom):
+    db.execute("CREATE TABLE metadata (name text, value text)")
+    db.execute(
+        "CREATE TABLE tiles (zoom_level integer, tile_column integer, "
+        "tile_row integer, tile_data blob)")
+    db.execute(
+        "CREATE UNIQUE INDEX tile_index on tiles "
+        "(zoom_level, tile_column, tile_row)")
+    minx, miny, maxx, maxy = gdf.total_bounds
+    transformer = Transformer.from_crs('epsg:3857', 'epsg:4326', always_xy=True)
+    west, south = transformer.transform(minx, miny)
+    east, north = transformer.transform(maxx, maxy)
+    fields = {
+        str(c): 'Number' if pd.api.types.is_numeric_dtype(t) else 'String'
+        for c, t in features['properties'].dtypes.items()}
+    metadata = {
+        'name': layer,
+        'format': 'pbf',
+        'minzoom': str(minzoom),
+        'maxzoom': str(maxzoom),
+        'bounds': f"{west},{south},{east},{north}",
+        'center': f"{(west + east) / 2},{(south + north) / 2},{minzoom}",
+        'json': json.dumps({'vector_layers': [{
+            'id': layer, 'fields': fields,
+            'minzoom': minzoom, 'maxzoom': maxzoom}]}),
+    }
+    db.executemany("INSERT INTO metadata VALUES (?, ?)", metadata.items())
+
+
+if __name__ == '__main__':
+    main()
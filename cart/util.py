@@ -1,58 +1,365 @@
 # type: ignore
+import numpy as np
 import pandas as pd
+from scipy import sparse
 
+from . import cache, report
 
-def read_features(features) -> pd.DataFrame:
-    header = ['name', 'gene_name', 'desc', 'gene_id', 'total_count', 'counts']
-    dtype_dict = {
-        'name': str,
-        'gene_name': str,
-        'desc': str,
-        'gene_id': 'int32',
-        'total_count': 'int32',
-        'counts': str
-    }
+
+# number of rows per chunk for the streaming readers
+DEFAULT_CHUNKSIZE = 1_000_000
+
+FEATURES_HEADER = ['name', 'gene_name', 'desc', 'gene_id', 'total_count', 'counts']
+FEATURES_DTYPE = {
+    'name': str,
+    'gene_name': str,
+    'desc': str,
+    'gene_id': 'int32',
+    'total_count': 'int32',
+    'counts': str
+}
+
+BARCODES_HEADER = [
+    'barcode', 'barcode_id', 'col1', 'col2', 'lane', 'tile',
+    'y', 'x', 'counts']
+BARCODES_DTYPE = {
+    'barcode': str,
+    'barcode_id': 'int32',
+    'y': 'int32',
+    'x': 'int32',
+}
+
+MATRIX_HEADER = ['gene_id', 'barcode_id', 'cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']
+MATRIX_DTYPE = {
+    'gene_id': 'int32',
+    'barcode_id': 'int32',
+    'cnt_spliced': 'int16',
+    'cnt_unspliced': 'int16',
+    'cnt_ambiguous': 'int16',
+}
+
+
+def read_features(features, cache_dir=None) -> pd.DataFrame:
+    if _use_cache(features, cache_dir, iter_features):
+        return cache.read(features, cache_dir)
     df = pd.read_csv(
         features, sep="\t",
-        names=header,
-        dtype=dtype_dict).set_index("gene_id")
+        names=FEATURES_HEADER,
+        dtype=FEATURES_DTYPE)
+    return _features_frame(df)
+
+
+def iter_features(features, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    ''' yield features table in chunks of `chunksize` rows'''
+    if _use_cache(features, cache_dir, iter_features):
+        yield from cache.iter_read(features, cache_dir, chunksize)
+        return
+    reader = pd.read_csv(
+        features, sep="\t",
+        names=FEATURES_HEADER,
+        dtype=FEATURES_DTYPE,
+        chunksize=chunksize)
+    with reader:
+        for df in reader:
+            yield _features_frame(df)
+
+
+def _features_frame(df):
+    df = df.set_index("gene_id")
     df = df[['gene_name']]  # type: ignore
     return df
 
 
-def read_barcodes(barcodes) -> pd.DataFrame:
-    header = [
-        'barcode', 'barcode_id', 'col1', 'col2', 'lane', 'tile',
-        'y', 'x', 'counts']
-    dtype_dict = {
-        'barcode': str,
-        'barcode_id': 'int32',
-        'y': 'int32',
-        'x': 'int32',
-    }
-
-    df = pd.read_csv(barcodes, sep="\t", names=header,
-            dtype=dtype_dict).set_index('barcode_id')
+def read_barcodes(barcodes, usecols=None, cache_dir=None) -> pd.DataFrame:
+    if _use_cache(barcodes, cache_dir, iter_barcodes):
+        return cache.read(barcodes, cache_dir, columns=usecols)
+    df = pd.read_csv(barcodes, sep="\t", names=BARCODES_HEADER,
+            usecols=_barcode_usecols(usecols),
+            dtype=BARCODES_DTYPE).set_index('barcode_id')
     return df  # type: ignore
 
 
-def read_matrix(matrix) -> pd.DataFrame:
-    header = ['gene_id', 'barcode_id', 'cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous']
-    dtype_dict = {
-        'gene_id': 'int32',
-        'barcode_id': 'int32',
-        'cnt_spliced': 'int16',
-        'cnt_unspliced': 'int16',
-        'cnt_ambiguous': 'int16',
-    }
-    df = pd.read_csv(   
-        matrix, 
-        sep=" ", names=header,
-        skiprows=3, dtype=dtype_dict)
+def iter_barcodes(barcodes, chunksize=DEFAULT_CHUNKSIZE, usecols=None,
+        cache_dir=None):
+    '''
+    yield barcodes table in chunks of `chunksize` rows
+    `usecols` limits parsing to the given columns, e.g. ['x', 'y']
+    '''
+    if _use_cache(barcodes, cache_dir, iter_barcodes):
+        yield from cache.iter_read(
+            barcodes, cache_dir, chunksize, columns=usecols)
+        return
+    reader = pd.read_csv(barcodes, sep="\t", names=BARCODES_HEADER,
+            usecols=_barcode_usecols(usecols),
+            dtype=BARCODES_DTYPE, chunksize=chunksize)
+    with reader:
+        for df in reader:
+            yield df.set_index('barcode_id')
+
+
+def _barcode_usecols(usecols):
+    ''' barcode_id is always parsed since it is the index'''
+    if usecols is None:
+        return None
+    return ['barcode_id'] + [c for c in usecols if c != 'barcode_id']
+
+
+def read_matrix(matrix, cache_dir=None) -> pd.DataFrame:
+    if _use_cache(matrix, cache_dir, iter_matrix):
+        return cache.read(matrix, cache_dir)
+    df = pd.read_csv(
+        matrix,
+        sep=" ", names=MATRIX_HEADER,
+        skiprows=3, dtype=MATRIX_DTYPE)
+    return _matrix_frame(df)
+
+
+def iter_matrix(matrix, chunksize=DEFAULT_CHUNKSIZE, cache_dir=None):
+    ''' yield matrix entries in chunks of `chunksize` rows'''
+    if _use_cache(matrix, cache_dir, iter_matrix):
+        yield from cache.iter_read(matrix, cache_dir, chunksize)
+        return
+    reader = pd.read_csv(
+        matrix,
+        sep=" ", names=MATRIX_HEADER,
+        skiprows=3, dtype=MATRIX_DTYPE,
+        chunksize=chunksize)
+    with reader:
+        for df in reader:
+            yield _matrix_frame(df)
+
+
+def _matrix_frame(df):
     df['cnt_total'] =  (
         df['cnt_spliced'] + \
         df['cnt_unspliced'] + \
-        df['cnt_ambiguous']).astype('int16')   
-    
-    return df  
+        df['cnt_ambiguous']).astype('int16')
+    return df
+
+
+class TileLookup:
+    '''
+    lookup arrays of a tile indexed by barcode_id and gene_id.
+    both ids are dense 1-based integers in the MatrixMarket file, so
+    joining matrix entries is a gather from these arrays, not a hash merge
+    '''
+
+    def __init__(self, df_barcode, df_feature):
+        barcode_ids = df_barcode.index.to_numpy()
+        size = int(barcode_ids.max()) + 1 if len(barcode_ids) else 0
+        self.x = np.zeros(size, dtype=df_barcode['x'].dtype)
+        self.y = np.zeros(size, dtype=df_barcode['y'].dtype)
+        self.x[barcode_ids] = df_barcode['x'].to_numpy()
+        self.y[barcode_ids] = df_barcode['y'].to_numpy()
+        self.has_barcode = np.zeros(size, dtype=bool)
+        self.has_barcode[barcode_ids] = True
+
+        genes = pd.Categorical(df_feature['gene_name'])
+        gene_ids = df_feature.index.to_numpy()
+        size = int(gene_ids.max()) + 1 if len(gene_ids) else 0
+        self.genes = genes.categories
+        self.gene_code = np.full(size, -1, dtype=genes.codes.dtype)
+        self.gene_code[gene_ids] = genes.codes
+        self.has_gene = np.zeros(size, dtype=bool)
+        self.has_gene[gene_ids] = True
+
+    def join(self, df_matrix) -> pd.DataFrame:
+        '''
+        inner join of matrix entries with barcode xy and gene names.
+        gene_name is returned as a categorical
+        '''
+        df_matrix, barcode_id, gene_id = self._match(df_matrix)
+        columns = {c: df_matrix[c].to_numpy() for c in df_matrix.columns}
+        columns['x'] = self.x[barcode_id]
+        columns['y'] = self.y[barcode_id]
+        columns['gene_name'] = pd.Categorical.from_codes(
+            self.gene_code[gene_id], categories=self.genes)
+        return pd.DataFrame(columns)
+
+    def gene_counts(self, df_matrix) -> np.ndarray:
+        '''
+        number of joined entries per gene, aligned with self.genes.
+        counts the rows join would return without building them
+        '''
+        _, _, gene_id = self._match(df_matrix)
+        return np.bincount(
+            self.gene_code[gene_id], minlength=len(self.genes))
+
+    def _match(self, df_matrix):
+        '''matrix entries with both a barcode and a gene, and their ids'''
+        barcode_id = df_matrix['barcode_id'].to_numpy()
+        gene_id = df_matrix['gene_id'].to_numpy()
+        valid = (
+            (barcode_id >= 0) & (barcode_id < len(self.has_barcode)) &
+            (gene_id >= 0) & (gene_id < len(self.has_gene)))
+        if not valid.all():
+            barcode_id = np.where(valid, barcode_id, 0)
+            gene_id = np.where(valid, gene_id, 0)
+        valid &= self.has_barcode[barcode_id]
+        valid &= self.has_gene[gene_id]
+        if not valid.all():
+            df_matrix = df_matrix[valid]
+            barcode_id = barcode_id[valid]
+            gene_id = gene_id[valid]
+        return df_matrix, barcode_id, gene_id
+
+
+def tile_lookup(barcodes, features, cache_dir=None):
+    '''TileLookup of the barcode xy and gene names of a tile'''
+    with report.stage('read') as rec:
+        df_feature = read_features(features, cache_dir=cache_dir)[['gene_name']]
+        df_barcode = read_barcodes(
+            barcodes, usecols=['x', 'y'], cache_dir=cache_dir)[['x', 'y']]
+        rec.read(barcodes, features)
+        rec.rows(rows_out=len(df_barcode) + len(df_feature))
+        return TileLookup(df_barcode, df_feature)
+
+
+def read_chunks(matrix, chunksize, cache_dir):
+    '''matrix frames of chunksize rows (whole tile if 0)'''
+    if chunksize:
+        chunks = iter_matrix(matrix, chunksize=chunksize, cache_dir=cache_dir)
+    else:
+        chunks = [read_matrix(matrix, cache_dir=cache_dir)]
+    return report.timed(chunks, 'read', path=matrix)
+
+
+def point_records(df, schema):
+    '''fiona point records from a frame with x, y and schema properties'''
+    names = list(schema['properties'])
+    columns = [df[name].tolist() for name in names]
+    for x, y, *values in zip(df['x'].tolist(), df['y'].tolist(), *columns):
+        yield {
+            'geometry': {'type': 'Point', 'coordinates': (x, y)},
+            'properties': dict(zip(names, values)),
+        }
+
+
+class SparseTile:
+    '''
+    gene x barcode sparse count matrices of a tile, one per count layer.
+    rows follow `gene_id`/`gene_name`, columns follow `barcode_id`/`x`/`y`
+    '''
+    layers = ['spliced', 'unspliced', 'ambiguous', 'total']
+
+    def __init__(self, matrices, gene_id, gene_name, barcode_id, x, y):
+        self.matrices = matrices
+        self.gene_id = gene_id
+        self.gene_name = gene_name
+        self.barcode_id = barcode_id
+        self.x = x
+        self.y = y
+
+    def __getitem__(self, layer):
+        return self.matrices[layer]
+
+    @property
+    def shape(self):
+        return (len(self.gene_id), len(self.barcode_id))
+
+    def gene_sums(self, layer='total') -> pd.Series:
+        ''' counts per gene, indexed by gene_name'''
+        sums = np.asarray(self.matrices[layer].sum(axis=1)).ravel()
+        return pd.Series(sums, index=pd.Index(self.gene_name, name='gene_name'))
+
+    def barcode_sums(self, layer='total') -> pd.Series:
+        ''' counts per barcode, indexed by barcode_id'''
+        sums = np.asarray(self.matrices[layer].sum(axis=0)).ravel()
+        return pd.Series(sums, index=pd.Index(self.barcode_id, name='barcode_id'))
+
+    def save(self, path):
+        ''' write to an uncompressed .npz, loaded back by load_sparse'''
+        arrays = {
+            'format': np.array(self.matrices['total'].format),
+            'shape': np.array(self.shape),
+            'gene_id': self.gene_id,
+            'gene_name': self.gene_name.astype(str),
+            'barcode_id': self.barcode_id,
+            'x': self.x,
+            'y': self.y,
+        }
+        for layer, m in self.matrices.items():
+            arrays[f"{layer}_data"] = m.data
+            arrays[f"{layer}_indices"] = m.indices
+            arrays[f"{layer}_indptr"] = m.indptr
+        np.savez(path, **arrays)
+
+
+def read_sparse(matrix, barcodes, features, format='csr', cache_dir=None,
+        chunksize=DEFAULT_CHUNKSIZE) -> SparseTile:
+    '''
+    load a tile as scipy.sparse matrices (format 'csr' or 'csc').
+    matrix entries without a barcode or gene in the tables are dropped,
+    the same inner join as convert
+    '''
+    df_feature = read_features(features, cache_dir=cache_dir)
+    df_barcode = read_barcodes(
+        barcodes, usecols=['x', 'y'], cache_dir=cache_dir)
+    gene_id = df_feature.index.to_numpy()
+    barcode_id = df_barcode.index.to_numpy()
+    gene_pos = _positions(gene_id)
+    barcode_pos = _positions(barcode_id)
+
+    rows, cols, values = [], [], {layer: [] for layer in SparseTile.layers}
+    for df in iter_matrix(matrix, chunksize=chunksize, cache_dir=cache_dir):
+        row = _lookup(gene_pos, df['gene_id'].to_numpy())
+        col = _lookup(barcode_pos, df['barcode_id'].to_numpy())
+        valid = (row >= 0) & (col >= 0)
+        rows.append(row[valid])
+        cols.append(col[valid])
+        for layer in SparseTile.layers:
+            values[layer].append(df[f"cnt_{layer}"].to_numpy()[valid])
+    rows = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    cols = np.concatenate(cols) if cols else np.zeros(0, dtype=np.int64)
+    shape = (len(gene_id), len(barcode_id))
+    matrices = {}
+    for layer in SparseTile.layers:
+        data = np.concatenate(values[layer]).astype('int32') if values[layer] \
+            else np.zeros(0, dtype='int32')
+        coo = sparse.coo_matrix((data, (rows, cols)), shape=shape)
+        matrices[layer] = coo.asformat(format)
+    return SparseTile(
+        matrices, gene_id, df_feature['gene_name'].to_numpy(),
+        barcode_id, df_barcode['x'].to_numpy(), df_barcode['y'].to_numpy())
+
+
+def load_sparse(path) -> SparseTile:
+    ''' load a tile written by SparseTile.save'''
+    with np.load(path, allow_pickle=False) as f:
+        kind = {'csr': sparse.csr_matrix, 'csc': sparse.csc_matrix}[str(f['format'])]
+        shape = tuple(f['shape'])
+        matrices = {
+            layer: kind(
+                (f[f"{layer}_data"], f[f"{layer}_indices"], f[f"{layer}_indptr"]),
+                shape=shape)
+            for layer in SparseTile.layers}
+        return SparseTile(
+            matrices, f['gene_id'], f['gene_name'].astype(object),
+            f['barcode_id'], f['x'], f['y'])
+
+
+def _positions(ids):
+    ''' dense id -> position array, -1 for ids not in the table'''
+    size = int(ids.max()) + 1 if len(ids) else 0
+    pos = np.full(size, -1, dtype=np.int64)
+    pos[ids] = np.arange(len(ids))
+    return pos
+
+
+def _lookup(pos, ids):
+    if len(pos) == 0:
+        return np.full(len(ids), -1, dtype=np.int64)
+    inside = (ids >= 0) & (ids < len(pos))
+    return np.where(inside, pos[np.where(inside, ids, 0)], -1)
+
 
+def _use_cache(source, cache_dir, iter_reader):
+    '''
+    check whether source should be read from cache_dir.
+    a missing or stale entry is (re)built by streaming iter_reader
+    '''
+    if cache_dir is None or not cache.is_cacheable(source):
+        return False
+    if not cache.is_fresh(source, cache_dir):
+        cache.build(source, cache_dir, iter_reader(source))
+    return True
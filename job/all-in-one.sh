@@ -33,12 +33,8 @@ meta -n $DATASET -d $sdge_dir -o $output_dir/vector/metadata.yaml -l 2
 
 echo 'convert sDGE'
 
-python -m cart.convert -o $output_dir/interim/vector-sdge \
--m $output_dir/vector/metadata.yaml -c 1
-
-find $output_dir/interim/vector-sdge -type f -print0 \
-| xargs -r0 singularity exec $CONTAINER ogrmerge.py \
--o $output_dir/vector/full_sdge.fgb -f FlatGeobuf -single -nln all
+python -m cart.convert -m $output_dir/vector/metadata.yaml \
+--merged $output_dir/vector/full_sdge.fgb -c 1
 
 echo 'filter marker genes'
 rm -f $output_dir/vector/marker.gpkg
@@ -76,9 +72,8 @@ aws s3 cp $histology_path $output_dir/raster/histology.tif
 singularity exec $CONTAINER gdal2tiles.py -z 6-15 \
 $output_dir/raster/histology.tif $output_dir/tile/raster-histology
 
-singularity exec $CONTAINER gdal_rasterize -a cnt_total -add -l all -tr 30 30 \
-$output_dir/vector/full_sdge.fgb \
-$output_dir/raster/count_sdge.tif
+python -m cart.raster -m $output_dir/vector/metadata.yaml -r 30 \
+-o $output_dir/raster/count_sdge.tif -c 1
 
 singularity exec $CONTAINER gdaldem hillshade -z 50 -compute_edges -alg Horn -igor \
   $output_dir/raster/count_sdge.tif $output_dir/raster/hillshade.tif
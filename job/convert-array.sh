@@ -0,0 +1,29 @@
+#! /bin/bash
+#SBATCH --job-name=convert-hd30-inj-colon-comb
+#SBATCH --mail-user=yonghah@umich.edu
+#SBATCH --mail-type=BEGIN,END
+#SBATCH --array=0-7
+#SBATCH --cpus-per-task=4
+#SBATCH --nodes=1
+#SBATCH --tasks-per-node=1
+#SBATCH --time=04:00:00
+#SBATCH --partition=standard
+#SBATCH --output=/home/%u/log/%A-%a-%x.log
+#SBATCH --mem=64000m
+#SBATCH --account=hmkang0
+#SBATCH --error=/home/%u/log/error-%A-%a-%x.log
+#SBATCH --get-user-env
+module load python/3.9.1
+
+# each array task converts every 8th tile. after all tasks finish,
+# combine them with a dependent job:
+# sbatch --dependency=afterok:$ARRAY_JOB_ID --wrap "merge -o $output_dir/vector/full_sdge.fgb -n 8"
+source /home/yonghah/venv/cart/bin/activate
+
+export output_dir=/home/yonghah/jobs/HD30-inj-colon-comb
+export cache_dir=/scratch/hmkang_root/hmkang0/cart-cache
+
+convert -m $output_dir/vector/metadata.yaml \
+--merged $output_dir/vector/full_sdge.fgb \
+--shard $SLURM_ARRAY_TASK_ID/$SLURM_ARRAY_TASK_COUNT \
+-c 4 --max-memory 60G --cache-dir $cache_dir
@@ -1,41 +1,99 @@
+import gzip
 import io
 import json
 from pathlib import Path
 import math
+import os
+import shutil
+import subprocess
+import sys
+import sqlite3
+import time
 from cart import factorde
 
 import pytest
+import yaml
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import fiona
+import rasterio
+from rasterio.enums import ColorInterp
+from shapely.geometry import box
 
 from cart import (
     __version__,
+    report,
 )
 from cart.convert import (
+    MERGED_SCHEMA,
+    convert2gpkg,
+    convert_tiles,
+    convert_merged,
+    filter_markers,
+    false_origin,
+    shifted_srs,
+    iter_matrix2gdf,
     matrix2gdf,
     read_barcodes,
     read_features,
     read_matrix,
 )
 from cart.util import (
+    TileLookup,
+    iter_barcodes,
+    iter_features,
+    iter_matrix,
+    load_sparse,
+    point_records,
     read_barcodes,
     read_features,
     read_matrix,
+    read_sparse,
+    SparseTile,
 )
 from cart.meta import (
     # get_extent,
+    extract_metadata_tiles,
+    gcs_to_sdge_batch,
     read_layout,
+    sdge_to_gcs,
+    sdge_to_gcs_batch,
+    Tile,
 )
+from cart.pyramid import Pyramid, build_pyramid
+from cart.schedule import imap_scheduled, parse_size, pool_memory, tile_memory
+from cart.shard import merge, parse_shard, pending_shards, select
+from cart.sort import (
+    CURVES, curve_key, hilbert_key, metadata_bounds, sorted_frames)
 from cart.split import (
-    _extract_genes
+    count_genes,
+    count_tile_genes,
+    frequency_table,
+)
+from cart.store import (
+    is_gene_store,
+    read_gene,
+    read_genes,
+    write_gene_store,
 )
 from cart.factor import (
     read_centroid,
-    create_hexagon
+    create_hexagon,
+    xy_to_hexagon,
+)
+from cart.raster import (
+    rasterize,
+)
+from cart.tiler import (
+    _aggregate_points,
+    create_tiles,
+    morton_key,
+    tile_of_key,
 )
 from cart.factorde import (
     _conversion,
+    conversion,
 )
 
 @pytest.fixture
@@ -82,6 +140,17 @@ def matrix():
     return io.StringIO(mat_string)
 
 
+@pytest.fixture
+def sdge_dir(tmp_path, matrix, barcodes, features):
+    '''tile directory with gzipped sDGE files'''
+    for name, buf in [
+            ("matrix.mtx.gz", matrix),
+            ("barcodes.tsv.gz", barcodes),
+            ("features.tsv.gz", features)]:
+        (tmp_path / name).write_bytes(gzip.compress(buf.getvalue().encode()))
+    return tmp_path
+
+
 def test_read_features(features):
     df = read_features(features)
     assert len(df) == 3  # very lazy test...
@@ -98,6 +167,139 @@ def test_read_matrix(matrix):
     assert len(df) == 8  # very lazy test...
 
 
+def test_iter_matrix(matrix):
+    chunks = list(iter_matrix(matrix, chunksize=3))
+    assert [len(df) for df in chunks] == [3, 3, 2]
+    df = pd.concat(chunks)
+    assert df['cnt_total'].tolist() == [1, 2, 1, 1, 1, 2, 1, 1]
+    assert [str(t) for t in df.dtypes] == \
+        ['int32', 'int32', 'int16', 'int16', 'int16', 'int16']
+
+
+def test_iter_barcodes(barcodes):
+    chunks = list(iter_barcodes(barcodes, chunksize=5, usecols=['x', 'y']))
+    assert [len(df) for df in chunks] == [5, 5, 2]
+    assert list(chunks[0].columns) == ['y', 'x']
+    assert chunks[0].index.name == 'barcode_id'
+    assert str(chunks[0]['x'].dtype) == 'int32'
+
+
+def test_iter_features(features):
+    chunks = list(iter_features(features, chunksize=2))
+    assert [len(df) for df in chunks] == [2, 1]
+    assert pd.concat(chunks)['gene_name'].tolist() == ['Gm26206', 'Xkr4', 'Rp1']
+
+
+def test_get_extent(sdge_dir):
+    tile = Tile(2, 2113, str(sdge_dir))
+    tile.get_extent(chunksize=5)
+    assert (tile.xmin, tile.ymin, tile.xmax, tile.ymax) == (1, 1, 4, 3)
+
+
+def test_extract_metadata_tiles(sdge_dir, tmp_path_factory, monkeypatch):
+    data_root = tmp_path_factory.mktemp("sdge")
+    for tile_id in ["2113", "2114"]:
+        shutil.copytree(sdge_dir, data_root / "2" / tile_id)
+    cache_dir = tmp_path_factory.mktemp("cache")
+    layout = read_layout('hiseq')
+    tiles = extract_metadata_tiles(
+        data_root, layout=layout, cache_dir=cache_dir, cpu=2)
+    assert sorted(tiles) == ['2-2113', '2-2114']
+    tile = tiles['2-2114']
+    assert (tile.xmin, tile.ymin, tile.xmax, tile.ymax) == (1, 1, 4, 3)
+    assert (tile.row, tile.col) == tuple(layout.loc[(2, 2114)][['row', 'col']])
+    assert len(list(cache_dir.glob("*.extent.json"))) == 2
+
+    # rerun reads extents from the cache only
+    def fail(*args):
+        raise AssertionError("extent was scanned again")
+    monkeypatch.setattr(Tile, '_scan_extent', staticmethod(fail))
+    tiles = extract_metadata_tiles(data_root, layout=layout, cache_dir=cache_dir)
+    assert tiles['2-2113'].xmax == 4
+
+    tiles = extract_metadata_tiles(data_root, cache_dir=cache_dir, shard=(1, 2))
+    assert list(tiles) == ['2-2114']
+
+    # meta shards only warm the cache and leave nothing to merge
+    output = tmp_path_factory.mktemp("meta") / "metadata.yaml"
+    subprocess.run(
+        [sys.executable, '-m', 'cart.meta', '-n', 'x', '-d', str(data_root),
+         '-o', str(output), '--cache-dir', str(cache_dir), '--shard', '0/2'],
+        check=True)
+    assert list(output.parent.iterdir()) == []
+
+
+def test_sdge_to_gcs_batch():
+    layout = read_layout('hiseq').reset_index()
+    rng = np.random.default_rng(0)
+    picked = layout.sample(50, random_state=0)
+    x = rng.integers(0, 98749, 50)
+    y = rng.integers(0, 20299, 50)
+    x_gcs, y_gcs = sdge_to_gcs_batch(
+        picked['lane'], picked['tile'], x, y, 98749, 20299)
+    expected = [
+        sdge_to_gcs_loc(lane, tile, xi, yi, layout)
+        for lane, tile, xi, yi in zip(picked['lane'], picked['tile'], x, y)]
+    assert list(zip(x_gcs, y_gcs)) == expected
+    assert sdge_to_gcs(1, 1112, 123, 456, width=98749, height=20299) == \
+        (1086362, 41054)
+    # floats and arrays are returned as given, not truncated
+    assert sdge_to_gcs(1, 1112, 123.5, 456.25, width=98749, height=20299) == \
+        (1086362.5, 41054.25)
+    xs, ys = sdge_to_gcs(
+        1, 1112, np.array([123, 124]), np.array([456, 457]),
+        width=98749, height=20299)
+    assert xs.tolist() == [1086362, 1086363] and ys.tolist() == [41054, 41055]
+
+    lane, tile, x_back, y_back = gcs_to_sdge_batch(x_gcs, y_gcs, 98749, 20299)
+    assert (lane == picked['lane']).all() and (tile == picked['tile']).all()
+    assert (x_back == x).all() and (y_back == y).all()
+
+    with pytest.raises(KeyError):
+        sdge_to_gcs_batch([1, 3], [1112, 1112], [0, 0], [0, 0], 98749, 20299)
+
+
+def sdge_to_gcs_loc(lane_id, tile_id, x, y, layout):
+    '''reference per-point transform through the layout table'''
+    tile = layout.set_index(['lane', 'tile']).loc[(lane_id, tile_id)]
+    max_row = layout['row'].max()
+    return (x + 98749 * (tile.col - 1), y + 20299 * (max_row - tile.row))
+
+
+def test_cached_readers(sdge_dir, tmp_path_factory):
+    cache_dir = tmp_path_factory.mktemp("cache")
+    for reader, name in [
+            (read_matrix, "matrix.mtx.gz"),
+            (read_barcodes, "barcodes.tsv.gz"),
+            (read_features, "features.tsv.gz")]:
+        expected = reader(sdge_dir / name)
+        built = reader(sdge_dir / name, cache_dir=cache_dir)
+        cached = reader(sdge_dir / name, cache_dir=cache_dir)
+        pd.testing.assert_frame_equal(built, expected)
+        pd.testing.assert_frame_equal(cached, expected)
+    assert len(list(cache_dir.glob("*.arrow"))) == 3
+
+    df = read_barcodes(
+        sdge_dir / "barcodes.tsv.gz", usecols=['x', 'y'], cache_dir=cache_dir)
+    assert sorted(df.columns) == ['x', 'y']
+    chunks = list(iter_matrix(
+        sdge_dir / "matrix.mtx.gz", chunksize=3, cache_dir=cache_dir))
+    assert [len(df) for df in chunks] == [3, 3, 2]
+
+    tile = Tile(2, 2113, str(sdge_dir))
+    tile.get_extent(cache_dir=cache_dir)
+    assert (tile.xmin, tile.ymin, tile.xmax, tile.ymax) == (1, 1, 4, 3)
+
+
+def test_cache_invalidation(sdge_dir, tmp_path_factory):
+    cache_dir = tmp_path_factory.mktemp("cache")
+    path = sdge_dir / "features.tsv.gz"
+    assert len(read_features(path, cache_dir=cache_dir)) == 3
+    path.write_bytes(gzip.compress(
+        b"ENSMUSG00000064842\tGm26206\tGene Expression\t1\t0\t0,0,0\n"))
+    assert len(read_features(path, cache_dir=cache_dir)) == 1
+
+
 # def test_matrix2widegdf(matrix, barcodes):
     # gdf = matrix2widegdf(matrix, barcodes)
     # # print("\n", gdf)
@@ -115,6 +317,212 @@ def test_matrix2gdf(matrix, barcodes, features):
     assert len(gdf) == 8
 
 
+def test_iter_matrix2gdf(matrix, barcodes, features):
+    gdfs = list(iter_matrix2gdf(matrix, barcodes, features, chunksize=3))
+    assert [len(gdf) for gdf in gdfs] == [3, 3, 2]
+    gdf = pd.concat(gdfs)
+    assert sorted(gdf['gene_name']) == ['Gm26206'] * 4 + ['Xkr4'] * 4
+
+
+@pytest.mark.parametrize("suffix", [".fgb", ".gpkg"])
+def test_convert_merged(sdge_dir, tmp_path_factory, suffix):
+    metadata = {'tiles': {
+        '2-2113': {'data_dir': str(sdge_dir),
+                   'false_easting': 0, 'false_northing': 0},
+        '2-2114': {'data_dir': str(sdge_dir),
+                   'false_easting': -100, 'false_northing': 0},
+    }}
+    output = tmp_path_factory.mktemp("merged") / f"full_sdge{suffix}"
+    convert_merged(metadata, str(output), cpu=2, chunksize=3)
+    # the spilled tiles are removed
+    assert [p.name for p in output.parent.iterdir()] == [output.name]
+    gdf = gpd.read_file(output, layer='all')
+    assert len(gdf) == 16
+    assert gdf.crs.to_epsg() == 3857
+    assert sorted(gdf.geometry.x.unique()) == [1, 2, 3, 4, 101, 102, 103, 104]
+    assert list(gdf.columns) == [
+        'cnt_spliced', 'cnt_unspliced', 'cnt_ambiguous', 'cnt_total',
+        'gene_name', 'geometry']
+
+
+def test_filter_markers(sdge_metadata, tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp("filter")
+    merged = str(out_dir / "full_sdge.fgb")
+    convert_merged(sdge_metadata, merged, cpu=1)
+    marker_sets = {
+        'A': 'Xkr4',
+        'B': 'Xkr4, Gm26206, Xkr4,',
+        'C': 'Rp1',
+    }
+    output = str(out_dir / "marker.gpkg")
+    filter_markers(merged, output, marker_sets, batch_size=3)
+    assert fiona.listlayers(output) == ['A', 'B', 'C']
+    assert len(gpd.read_file(output, layer='A')) == 8
+    layer_b = gpd.read_file(output, layer='B')
+    assert len(layer_b) == 16
+    assert sorted(layer_b['gene_name'].unique()) == ['Gm26206', 'Xkr4']
+    assert layer_b.crs.to_epsg() == 3857
+    assert len(gpd.read_file(output, layer='C')) == 0
+
+
+def test_gene_store(sdge_metadata, tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp("store")
+    merged = str(out_dir / "full_sdge.fgb")
+    convert_merged(sdge_metadata, merged, cpu=1)
+    store = out_dir / "genes"
+    write_gene_store(merged, store, batch_size=5)
+    assert is_gene_store(store)
+    with open(store / "genes.json") as f:
+        index = json.load(f)
+    assert {g: e['count'] for g, e in index['genes'].items()} == \
+        {'Gm26206': 8, 'Xkr4': 8}
+    gdf = read_gene(store, 'Xkr4')
+    assert len(gdf) == 8
+    assert set(gdf['gene_name']) == {'Xkr4'}
+    assert gdf['cnt_total'].sum() == 2 * 5
+    assert gdf.crs.to_epsg() == 3857
+    assert len(read_genes(store, ['Xkr4', 'Gm26206', 'Rp1'])) == 16
+
+    filtered = str(out_dir / "filtered.gpkg")
+    filter_markers(str(store), filtered, {'a': 'Xkr4', 'b': 'Xkr4,Rp1'})
+    for layer in ['a', 'b']:
+        with fiona.open(filtered, layer=layer) as f:
+            assert len(f) == 8
+
+
+def test_gene_store_many_genes(tmp_path):
+    # more genes than pyarrow's default of 1024 partitions
+    n = 1100
+    gdf = gpd.GeoDataFrame({
+        'cnt_spliced': 1, 'cnt_unspliced': 0, 'cnt_ambiguous': 0,
+        'cnt_total': np.arange(n), 'gene_name': [f"gene{i}" for i in range(n)],
+    }, geometry=gpd.points_from_xy(np.arange(n), np.zeros(n)), crs='epsg:3857')
+    merged = tmp_path / "full_sdge.fgb"
+    gdf.to_file(merged, layer='all')
+    for genes in [None, n]:
+        store = tmp_path / f"genes-{genes}"
+        write_gene_store(merged, store, genes=genes)
+        assert count_genes(store).to_dict() == {g: 1 for g in gdf['gene_name']}
+        assert read_gene(store, 'gene1099')['cnt_total'].tolist() == [1099]
+
+
+def test_count_genes(sdge_metadata, tmp_path_factory):
+    counts = count_tile_genes(sdge_metadata, cpu=2, chunksize=3)
+    assert counts.to_dict() == {'Gm26206': 8, 'Xkr4': 8}
+    merged = str(tmp_path_factory.mktemp("count") / "full_sdge.fgb")
+    convert_merged(sdge_metadata, merged, cpu=1)
+    assert count_genes(merged).sort_index().equals(counts.sort_index())
+    merged = str(tmp_path_factory.mktemp("count") / "full_sdge.gpkg")
+    convert_merged(sdge_metadata, merged, cpu=1)
+    assert count_genes(merged).sort_index().equals(counts.sort_index())
+
+    df = frequency_table(pd.Series({'a': 1, 'b': 3, 'c': 0}))
+    assert df['gene_name'].tolist() == ['b', 'a']
+    assert df['cum_fraction'].tolist() == [0.75, 1.0]
+    assert df['freq'].tolist() == [0.75, 0.25]
+
+
+def test_read_sparse(sdge_dir, tmp_path):
+    files = [sdge_dir / n for n in
+             ["matrix.mtx.gz", "barcodes.tsv.gz", "features.tsv.gz"]]
+    tile = read_sparse(*files, chunksize=3)
+    df = iter_matrix2gdf(*files, chunksize=100).__next__()
+    assert tile['total'].format == 'csr'
+    assert tile['total'].nnz == len(df)
+    assert tile['total'].sum() == df['cnt_total'].sum()
+    assert (tile['spliced'] + tile['unspliced'] + tile['ambiguous'] !=
+            tile['total']).nnz == 0
+    expected = df.groupby('gene_name')['cnt_total'].sum()
+    sums = tile.gene_sums()
+    assert sums[expected.index].tolist() == expected.tolist()
+    barcode_sums = tile.barcode_sums('spliced')
+    assert barcode_sums.sum() == df['cnt_spliced'].sum()
+    assert len(tile.x) == tile.shape[1] == len(barcode_sums)
+
+    tile = read_sparse(*files, format='csc')
+    tile.save(tmp_path / "tile.npz")
+    loaded = load_sparse(tmp_path / "tile.npz")
+    assert loaded['unspliced'].format == 'csc'
+    for layer in SparseTile.layers:
+        assert (loaded[layer] != tile[layer]).nnz == 0
+    assert loaded.gene_name.tolist() == tile.gene_name.tolist()
+    assert loaded.y.tolist() == tile.y.tolist()
+
+
+def test_tile_lookup_inner_join():
+    df_barcode = pd.DataFrame(
+        {'x': [10, 20, 30], 'y': [1, 2, 3]},
+        index=pd.Index([1, 2, 4], name='barcode_id'))
+    df_feature = pd.DataFrame(
+        {'gene_name': ['b', 'a']}, index=pd.Index([1, 2], name='gene_id'))
+    df_matrix = pd.DataFrame({
+        'gene_id': [1, 2, 2, 3, 1],
+        'barcode_id': [1, 4, 3, 1, 9],
+        'cnt_total': [1, 2, 3, 4, 5]})
+    df = TileLookup(df_barcode, df_feature).join(df_matrix)
+    assert df['cnt_total'].tolist() == [1, 2]
+    assert df['x'].tolist() == [10, 30]
+    assert df['gene_name'].tolist() == ['b', 'a']
+
+
+def test_gather_join_matches_merge():
+    '''gather join gives the same rows as the pandas merge'''
+    rng = np.random.default_rng(0)
+    n_barcodes, n_genes, n_entries = 5_000, 200, 20_000
+    df_barcode = pd.DataFrame({
+        'x': rng.integers(0, 100_000, n_barcodes, dtype='int32'),
+        'y': rng.integers(0, 20_000, n_barcodes, dtype='int32'),
+    }, index=pd.Index(
+        np.arange(1, n_barcodes + 1, dtype='int32'), name='barcode_id'))
+    df_feature = pd.DataFrame(
+        {'gene_name': [f"gene{i}" for i in range(n_genes)]},
+        index=pd.Index(np.arange(1, n_genes + 1, dtype='int32'), name='gene_id'))
+    df_matrix = pd.DataFrame({
+        'gene_id': rng.integers(1, n_genes + 1, n_entries, dtype='int32'),
+        'barcode_id': rng.integers(1, n_barcodes + 1, n_entries, dtype='int32'),
+        'cnt_total': rng.integers(1, 5, n_entries, dtype='int16'),
+        'entry': np.arange(n_entries),
+    })
+    df_merge = (df_barcode
+        .merge(df_matrix, on='barcode_id')
+        .merge(df_feature, on='gene_id'))
+    df_gather = TileLookup(df_barcode, df_feature).join(df_matrix)
+
+    columns = ['entry', 'gene_id', 'barcode_id', 'x', 'y', 'cnt_total']
+    expected = df_merge.sort_values('entry', ignore_index=True)
+    pd.testing.assert_frame_equal(
+        df_gather[columns], expected[columns], check_dtype=False)
+    assert (np.asarray(df_gather['gene_name'], dtype=object) ==
+            expected['gene_name'].to_numpy()).all()
+
+
+def test_false_origin():
+    assert false_origin(shifted_srs(-2666223, -41054)) == (-2666223, -41054)
+    assert false_origin("epsg:3857") is None
+    assert false_origin(shifted_srs(-2666223, 0) + " +over") is None
+
+
+def test_shift_matches_proj(matrix, barcodes, features):
+    t_srs = shifted_srs(-2666223, -41054)
+    gdf = matrix2gdf(matrix, barcodes, features, t_srs, dst_crs='epsg:3857')
+    assert gdf.crs.to_epsg() == 3857
+    x = gdf.geometry.x.to_numpy()
+    y = gdf.geometry.y.to_numpy()
+    proj = gpd.GeoSeries(
+        gpd.points_from_xy(x + -2666223, y + -41054), crs=t_srs
+    ).to_crs('epsg:3857')
+    assert np.allclose(proj.x, x, atol=1e-6)
+    assert np.allclose(proj.y, y, atol=1e-6)
+    assert (x.min(), y.min()) == (2666224, 41055)
+
+
+def test_convert2gpkg_chunked(tmp_path, matrix, barcodes, features):
+    output = str(tmp_path / "tile.gpkg")
+    convert2gpkg(matrix, barcodes, features, output, "epsg:3857", chunksize=3)
+    gdf = gpd.read_file(output, layer='all')
+    assert len(gdf) == 8
+
+
 # def test_get_extent(barcodes):
     # df = read_barcodes(barcodes)
     # xmin, ymin, xmax, ymax = get_extent(df)
@@ -161,6 +569,571 @@ def test_matrix2gdf(matrix, barcodes, features):
 #     # gdf.to_file(Path(data_dir) / "test_hex.gpkg")
 #     # print(gdf)
 
+def test_xy_to_hexagon():
+    df = pd.DataFrame({'x': [0, 100, 250.5], 'y': [0, 50, -20]})
+    gdf = xy_to_hexagon(df, 80, rotation=30)
+    assert gdf.crs.to_epsg() == 3857
+    side = 80 * 2 / math.sqrt(3)
+    for (x, y), hexagon in zip(df[['x', 'y']].to_numpy(), gdf.geometry):
+        expected = create_hexagon(side, x, y, 30)
+        assert hexagon.equals_exact(expected, 1e-9)
+    assert np.allclose(gdf.geometry.area, 2 * math.sqrt(3) * 80 ** 2)
+
+
+@pytest.fixture
+def sdge_metadata(sdge_dir):
+    '''metadata of two copies of the fixture tile, side by side'''
+    extent = {'xmin': 1, 'ymin': 1, 'xmax': 4, 'ymax': 3}
+    return {'tiles': {
+        '2-2113': dict(extent, data_dir=str(sdge_dir),
+                       false_easting=0, false_northing=0),
+        '2-2114': dict(extent, data_dir=str(sdge_dir),
+                       false_easting=-10, false_northing=0),
+    }}
+
+
+def test_convert_tiles_incremental(sdge_metadata, sdge_dir, tmp_path):
+    outdir = tmp_path / "geospatial"
+    assert sorted(convert_tiles(sdge_metadata, outdir, cpu=2)) == \
+        ['2-2113', '2-2114']
+    with fiona.open(outdir / "2-2114.gpkg") as f:
+        assert len(f) == 8
+    assert (tmp_path / "geospatial.manifest.json").exists()
+    assert convert_tiles(sdge_metadata, outdir, cpu=2) == []
+
+    sdge_metadata['tiles']['2-2114']['false_easting'] = -20
+    assert convert_tiles(sdge_metadata, outdir, cpu=2) == ['2-2114']
+    # a different sort order, or none, reconverts every tile
+    assert len(convert_tiles(sdge_metadata, outdir, cpu=2, sort='hilbert')) == 2
+    assert convert_tiles(sdge_metadata, outdir, cpu=2, sort='hilbert') == []
+    assert len(convert_tiles(sdge_metadata, outdir, cpu=2, sort='zorder')) == 2
+    assert len(convert_tiles(sdge_metadata, outdir, cpu=2)) == 2
+    os.remove(outdir / "2-2113.gpkg")
+    assert convert_tiles(sdge_metadata, outdir, cpu=2) == ['2-2113']
+
+    stat = os.stat(sdge_dir / "matrix.mtx.gz")
+    os.utime(sdge_dir / "matrix.mtx.gz", ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert len(convert_tiles(sdge_metadata, outdir, cpu=2)) == 2
+    assert len(convert_tiles(sdge_metadata, outdir, cpu=2, force=True)) == 2
+    assert sorted(p.name for p in outdir.iterdir()) == ['2-2113.gpkg', '2-2114.gpkg']
+
+
+def test_report_stages(sdge_metadata, tmp_path, capsys):
+    path = tmp_path / "run.jsonl"
+    with report.run(path, 'convert'):
+        convert_tiles(sdge_metadata, tmp_path / "geospatial", cpu=2, chunksize=5)
+    df = report.load(path)
+    assert df['run'].nunique() == 1 and (df['command'] == 'convert').all()
+    tiles = df[df['tile'].notna()]
+    # one record per tile and stage, chunks of 5 rows summed
+    assert not tiles.duplicated(['tile', 'stage']).any()
+    assert set(tiles['tile']) == {'2-2113', '2-2114'}
+    assert {'tile', 'read', 'join', 'reproject', 'geometry', 'write'} <= set(tiles['stage'])
+    join = tiles[tiles['stage'] == 'join'].set_index('tile')
+    assert (join['rows_in'] == 8).all() and (join['calls'] == 2).all()
+    write = tiles[tiles['stage'] == 'write']
+    assert (write['bytes_written'] > 0).all()
+    assert (tiles[tiles['stage'] == 'read']['bytes_read'] > 0).all()
+    assert (df['peak_rss_mb'] > 0).all() and (df['wall_s'] >= 0).all()
+    table = pd.read_csv(report.summary_path(path), sep="\t", index_col=0)
+    assert table.loc['join', 'tiles'] == 2 and table.loc['join', 'rows_in'] == 16
+    assert 'slowest tiles' in capsys.readouterr().out
+    # without a report nothing is measured or written
+    with report.run(None, 'convert'):
+        with report.stage('read') as rec:
+            rec.read(path)
+    assert rec.bytes_read == 0 and not report.enabled()
+    assert len(report.load(path)) == len(df)
+
+
+@pytest.mark.skipif(
+    not report.reset_peak_rss(), reason="rss high-water mark can't be reset")
+def test_report_stage_peak_rss(tmp_path):
+    path = tmp_path / "run.jsonl"
+    with report.run(path, 'test'):
+        with report.stage('outer'):
+            with report.stage('big'):
+                block = np.ones(2**27 // 8)  # 128 MB
+                block[:] = 2
+                del block
+            with report.stage('small'):
+                pass
+    peak = report.load(path).set_index('stage')['peak_rss_mb']
+    # a later stage doesn't inherit the peak of an earlier one,
+    # an enclosing stage keeps the peak of the stages inside it
+    assert peak['big'] - peak['small'] > 100
+    assert peak['outer'] >= peak['big']
+    assert (report.load(path)['rss_scope'] == 'stage').all()
+
+
+def _timed_job(args):
+    start = time.monotonic()
+    time.sleep(0.05)
+    return args, start, time.monotonic()
+
+
+def test_imap_scheduled_memory_budget():
+    assert parse_size('64G') == 64 * 2**30
+    assert parse_size('512MiB') == 512 * 2**20
+    assert parse_size(1000) == 1000
+    with pytest.raises(ValueError):
+        parse_size('lots')
+
+    estimates = [1, 3, 10, 5, 3]
+    jobs = [(e, (i, e)) for i, e in enumerate(estimates)]
+    results = list(imap_scheduled(_timed_job, jobs, cpu=4, max_memory=6))
+    assert sorted(args for args, _, _ in results) == sorted(a for _, a in jobs)
+    # the largest job starts first
+    first = min(results, key=lambda r: r[1])
+    assert first[0][1] == 10
+    # the jobs running at each job start fit the budget, except the
+    # job larger than the budget, which runs alone
+    for _, start, _ in results:
+        running = [e for (_, e), s, f in results if s <= start < f]
+        assert sum(running) <= 6 or running == [10]
+
+    assert len(list(imap_scheduled(_timed_job, jobs, cpu=2))) == 5
+
+
+def test_tile_memory(sdge_metadata):
+    metadata_tile = sdge_metadata['tiles']['2-2113']
+    whole = tile_memory(metadata_tile)
+    assert whole > 0
+    assert tile_memory(metadata_tile, chunksize=1) < whole
+    # a pool holds its cpu largest tiles at once
+    tiles = [metadata_tile, {'data_dir': metadata_tile['data_dir']}]
+    assert pool_memory(tiles, cpu=1) == whole
+    assert pool_memory(tiles, cpu=4) == 2 * whole
+
+
+def _run_shards(args, count):
+    '''run count shards of a cart command as separate processes'''
+    procs = [
+        subprocess.Popen(
+            [sys.executable, '-m'] + args + ['--shard', f"{i}/{count}"],
+            cwd=Path(__file__).parents[1], stdout=subprocess.DEVNULL)
+        for i in range(count)]
+    assert [p.wait() for p in procs] == [0] * count
+
+
+def test_sharded_convert(sdge_metadata, tmp_path):
+    assert parse_shard('1/4') == (1, 4)
+    with pytest.raises(ValueError):
+        parse_shard('4/4')
+    assert select(['c', 'a', 'b', 'd'], (1, 2)) == ['b', 'd']
+
+    tmp_path = tmp_path / "shards"
+    tmp_path.mkdir()
+    meta = tmp_path / "metadata.yaml"
+    with open(meta, 'w') as f:
+        yaml.dump(sdge_metadata, f)
+    merged = tmp_path / "full_sdge.fgb"
+    with pytest.raises(RuntimeError):
+        merge(merged, 2)
+    _run_shards(['cart.convert', '-m', str(meta), '-M', str(merged), '-c', '1'], 2)
+    assert pending_shards(merged, 2) == []
+    merge(merged, 2)
+    with fiona.open(merged) as f:
+        assert len(f) == 16
+    assert sorted(p.name for p in tmp_path.iterdir()) == \
+        ['full_sdge.fgb', 'metadata.yaml']
+
+    outdir = tmp_path / "geospatial"
+    _run_shards(['cart.convert', '-m', str(meta), '-o', str(outdir), '-c', '1'], 2)
+    merge(outdir, 2)
+    assert sorted(p.name for p in outdir.iterdir()) == \
+        ['2-2113.gpkg', '2-2114.gpkg']
+    # the merged manifest marks every tile up to date
+    assert convert_tiles(sdge_metadata, outdir, cpu=1) == []
+
+
+def test_hilbert_key():
+    assert hilbert_key([0, 0, 1, 1], [0, 1, 1, 0], order=1).tolist() == [0, 1, 2, 3]
+    gx, gy = np.meshgrid(np.arange(16), np.arange(16))
+    keys = hilbert_key(gx.ravel(), gy.ravel(), order=4)
+    assert sorted(keys.tolist()) == list(range(256))
+    # consecutive cells along the curve are neighbours
+    order = np.argsort(keys)
+    steps = np.abs(np.diff(gx.ravel()[order])) + np.abs(np.diff(gy.ravel()[order]))
+    assert (steps == 1).all()
+
+
+def test_sorted_frames(tmp_path):
+    rng = np.random.default_rng(0)
+    frames = [
+        pd.DataFrame({
+            'x': rng.uniform(0, 100, 10), 'y': rng.uniform(0, 50, 10),
+            'gene_name': pd.Categorical(rng.choice(['a', 'b'], 10)),
+            'id': np.arange(i * 10, i * 10 + 10)})
+        for i in range(5)]
+    bounds = (0, 0, 100, 50)
+    for curve in CURVES:
+        df = pd.concat(sorted_frames(
+            iter(frames), bounds, curve, run_size=7, tmp_dir=tmp_path))
+        assert sorted(df['id']) == list(range(50))
+        keys = curve_key(df['x'], df['y'], bounds, curve)
+        assert (np.diff(keys) >= 0).all()
+        expected = pd.concat(frames).set_index('id')['gene_name'].astype(str)
+        assert (df.set_index('id')['gene_name'] == expected[df['id']]).all()
+    assert list(sorted_frames(iter([]), bounds)) == []
+
+
+def test_convert_sorted(sdge_metadata, tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp("sorted")
+    bounds = metadata_bounds(sdge_metadata)
+    merged = out_dir / "full_sdge.gpkg"
+    convert_merged(sdge_metadata, str(merged), cpu=2, chunksize=3, sort='hilbert')
+    convert_tiles(sdge_metadata, out_dir / "tiles", cpu=1, sort='zorder')
+    for path, curve in [
+            (merged, 'hilbert'), (out_dir / "tiles" / "2-2114.gpkg", 'zorder')]:
+        gdf = gpd.read_file(path)
+        if curve == 'zorder':
+            bounds = metadata_bounds({'tiles': {
+                '2-2114': sdge_metadata['tiles']['2-2114']}})
+        keys = curve_key(gdf.geometry.x, gdf.geometry.y, bounds, curve)
+        assert (np.diff(keys) >= 0).all()
+    assert len(gpd.read_file(merged)) == 16
+
+    merged = out_dir / "sharded.gpkg"
+    for i in range(2):
+        convert_merged(sdge_metadata, str(merged), cpu=1, shard=(i, 2))
+    merge(merged, 2, sort='hilbert')
+    gdf = gpd.read_file(merged)
+    assert len(gdf) == 16
+    keys = curve_key(gdf.geometry.x, gdf.geometry.y, gdf.total_bounds, 'hilbert')
+    assert (np.diff(keys) >= 0).all()
+
+
+def _bbox_read_bytes(path, bboxes, page_size=4096):
+    '''
+    estimated bytes of feature pages read by bbox queries on a gpkg:
+    rows are stored in fid order, so a query touches the pages holding
+    the fids it returns
+    '''
+    with fiona.open(path) as src:
+        rows_per_page = max(1, page_size * len(src) // os.path.getsize(path))
+        total = 0
+        for bbox in bboxes:
+            fids = [int(f.id) for f in src.filter(bbox=bbox)]
+            total += len({fid // rows_per_page for fid in fids}) * page_size
+    return total / len(bboxes)
+
+
+def test_sorted_output_bbox_benchmark(tmp_path):
+    rng = np.random.default_rng(1)
+    n = 100_000
+    df = pd.DataFrame({
+        'x': rng.uniform(0, 10_000, n), 'y': rng.uniform(0, 5_000, n),
+        'cnt_spliced': 1, 'cnt_unspliced': 0, 'cnt_ambiguous': 0,
+        'cnt_total': 1, 'gene_name': rng.choice(['Xkr4', 'Rp1'], n)})
+    frames = {
+        'unsorted': [df],
+        'hilbert': sorted_frames([df], (0, 0, 10_000, 5_000), run_size=30_000),
+    }
+    bboxes = [
+        (x, y, x + 500, y + 250) for x, y in
+        zip(rng.uniform(0, 9_500, 30), rng.uniform(0, 4_750, 30))]
+    read = {}
+    for name, parts in frames.items():
+        path = tmp_path / f"{name}.gpkg"
+        with fiona.open(
+                path, 'w', driver='GPKG', layer='all',
+                schema=MERGED_SCHEMA, crs='EPSG:3857') as dst:
+            for part in parts:
+                dst.writerecords(point_records(part, MERGED_SCHEMA))
+        read[name] = _bbox_read_bytes(path, bboxes)
+    print(f"bytes read per bbox: {read}")
+    assert read['hilbert'] * 5 < read['unsorted']
+
+
+def test_rasterize(sdge_metadata, tmp_path_factory):
+    output = tmp_path_factory.mktemp("raster") / "count.tif"
+    rasterize(sdge_metadata, str(output), resolution=1, cpu=2, chunksize=3)
+    with rasterio.open(output) as src:
+        counts = src.read(1)
+        assert src.crs.to_epsg() == 3857
+        assert tuple(src.bounds) == (1, 1, 15, 4)
+    assert counts.sum() == 2 * 10
+    # barcode 3 at (3, 1) holds one count of each gene
+    assert counts[2, 2] == 2 and counts[2, 12] == 2
+
+    output = tmp_path_factory.mktemp("raster") / "xkr4.tif"
+    rasterize(sdge_metadata, str(output), resolution=2, genes=['Xkr4'], cpu=1)
+    with rasterio.open(output) as src:
+        assert src.read(1).sum() == 2 * 5
+
+    # chunksize 0 reads each tile whole
+    output = tmp_path_factory.mktemp("raster") / "whole.tif"
+    rasterize(sdge_metadata, str(output), resolution=1, cpu=1, chunksize=0)
+    with rasterio.open(output) as src:
+        assert (src.read(1) == counts).all()
+
+
+def test_build_pyramid(sdge_metadata, tmp_path_factory):
+    out_dir = tmp_path_factory.mktemp("pyramid")
+    raster = out_dir / "count.tif"
+    rasterize(sdge_metadata, str(raster), resolution=1, cpu=1)
+    with rasterio.open(raster) as src:
+        expected = src.read(1)
+    build_pyramid(
+        sdge_metadata, out_dir / "pyramid", resolution=1, levels=3,
+        cpu=2, chunksize=3)
+    pyramid = Pyramid(out_dir / "pyramid")
+    assert pyramid.shapes == [(14, 3), (7, 2), (4, 1)]
+    assert (pyramid.counts(0) == expected).all()
+    padded = np.pad(expected, ((0, 1), (0, 0)))
+    blocks = padded.reshape(2, 2, 7, 2).sum(axis=(1, 3))
+    assert (pyramid.counts(1) == blocks).all()
+    assert pyramid.counts(2).sum() == 20
+    assert pyramid.counts(2, genes=['Xkr4']).sum() == 10
+    assert pyramid.counts(1, genes=['Xkr4', 'Gm26206', 'Rp1']).sum() == 20
+    assert pyramid.transform(2) == (1, 4, 4)
+    # chunksize 0 reads each tile whole
+    build_pyramid(
+        sdge_metadata, out_dir / "whole", resolution=1, levels=1, cpu=1,
+        chunksize=0)
+    assert (Pyramid(out_dir / "whole").counts(0) == expected).all()
+
+
+@pytest.fixture
+def histology(tmp_path):
+    '''2x2 overlapping crops of a smooth random image, with layout metadata'''
+    import cv2
+    rng = np.random.default_rng(0)
+    base = cv2.GaussianBlur(rng.random((300, 500, 3)), (0, 0), 3)
+    base = ((base - base.min()) / np.ptp(base) * 255).astype(np.uint8)
+    h, w = 170, 280
+    true = {(1, 1): (0, 0), (1, 2): (218, 2), (2, 1): (3, 128), (2, 2): (220, 130)}
+    error = {(1, 1): (0, 0), (1, 2): (4, -3), (2, 1): (-2, 5), (2, 2): (3, 3)}
+    tiles, image_dir = {}, tmp_path / "images"
+    image_dir.mkdir()
+    for (row, col), (x, y) in true.items():
+        name = f"2-21{row}{col}"
+        cv2.imwrite(str(image_dir / f"{name}.png"), base[y:y + h, x:x + w])
+        ex, ey = error[(row, col)]
+        tiles[name] = {
+            'row': row, 'col': col,
+            'false_easting': -(x + ex), 'false_northing': h + y + ey - 300}
+    metadata = {'tiles': tiles, 'tile_layout': {'grid_width': w}}
+    return base, true, image_dir, metadata
+
+
+def test_stitch_layout(histology, tmp_path, monkeypatch):
+    import cv2
+    from cart import stitch
+    from cart.stitch import adjacent_pairs, pair_offset, stitch_layout
+    base, true, image_dir, metadata = histology
+    assert adjacent_pairs(metadata['tiles']) == [
+        ('2-2111', '2-2112'), ('2-2111', '2-2121'),
+        ('2-2112', '2-2122'), ('2-2121', '2-2122')]
+    a = cv2.imread(str(image_dir / "2-2111.png"))
+    b = cv2.imread(str(image_dir / "2-2112.png"))
+    shift, response = pair_offset(a, b, np.array([222, -1]))
+    assert np.allclose(shift, [-4, 3], atol=0.5) and response > 0.3
+
+    output = tmp_path / "stitched.png"
+    image_paths = sorted(str(p) for p in image_dir.iterdir())
+    stitch_layout(image_paths, metadata, str(output), cpu=2, blend=10)
+    mosaic = cv2.imread(str(output))
+    assert mosaic.shape == (300, 500, 3)
+    covered = np.zeros(base.shape[:2], dtype=bool)
+    for x, y in true.values():
+        covered[y:y + 170, x:x + 280] = True
+    diff = np.abs(mosaic.astype(int) - base.astype(int))[covered]
+    assert diff.mean() < 2
+
+    # streamed GeoTIFF with the same pixels, in the epsg:3857 frame
+    output = tmp_path / "stitched.tif"
+    monkeypatch.setattr(stitch, 'BLOCK_SIZE', 64)
+    stitch.stitch_layout(image_paths, metadata, str(output), cpu=2, blend=10)
+    with rasterio.open(output) as src:
+        assert src.crs.to_epsg() == 3857
+        assert src.res == (1, 1)
+        assert abs(src.bounds.left) <= 1 and abs(src.bounds.top - 300) <= 1
+        assert src.block_shapes[0] == (64, 64)
+        assert src.overviews(1) == [2, 4, 8]
+        rgb = src.read()
+    assert (np.moveaxis(rgb, 0, 2)[..., ::-1] == mosaic).all()
+
+    # BGRA images: sizes come from the headers, bands are written as RGBA
+    bgra_dir = tmp_path / "bgra"
+    bgra_dir.mkdir()
+    for path in image_paths:
+        image = cv2.imread(path)
+        cv2.imwrite(
+            str(bgra_dir / Path(path).name),
+            cv2.cvtColor(image, cv2.COLOR_BGR2BGRA))
+    bgra_paths = sorted(str(p) for p in bgra_dir.iterdir())
+    assert stitch.image_header(bgra_paths[0]) == ((170, 280, 4), np.uint8)
+    output = tmp_path / "stitched-rgba.tif"
+    stitch.stitch_layout(bgra_paths, metadata, str(output), cpu=2, blend=10)
+    with rasterio.open(output) as src:
+        assert src.colorinterp[3] == ColorInterp.alpha
+        rgba = np.moveaxis(src.read(), 0, 2)
+    assert (rgba[..., :3] == np.moveaxis(rgb, 0, 2)).all()
+    # opaque where images cover the mosaic, transparent in the gaps
+    assert (rgba[..., 3][covered] == 255).all()
+    assert (rgba[..., 3] == 0).any()
+
+
+def test_stitch_layout_refines_shifted_tile(tmp_path):
+    import cv2
+    from cart.stitch import stitch_layout
+    rng = np.random.default_rng(1)
+    base = cv2.GaussianBlur(rng.random((300, 500, 3)), (0, 0), 3)
+    base = ((base - base.min()) / np.ptp(base) * 255).astype(np.uint8)
+    # tiles of 200 x 120 on a regular grid, imaged 250 x 150 (20% overlap)
+    # centred on the tile; tile 2-2122 was imaged 6 px right, 5 px up
+    grid_width, grid_height, w, h = 200, 120, 250, 150
+    shifted = {(2, 2): (6, -5)}
+    tiles, image_dir = {}, tmp_path / "images"
+    image_dir.mkdir()
+    for row in [1, 2]:
+        for col in [1, 2]:
+            x = 30 + (col - 1) * grid_width - 25
+            y = 20 + (row - 1) * grid_height - 15
+            dx, dy = shifted.get((row, col), (0, 0))
+            name = f"2-21{row}{col}"
+            cv2.imwrite(
+                str(image_dir / f"{name}.png"),
+                base[y + dy:y + dy + h, x + dx:x + dx + w])
+            tiles[name] = {
+                'row': row, 'col': col,
+                'false_easting': -(col - 1) * grid_width,
+                'false_northing': -(2 - row) * grid_height}
+    metadata = {'tiles': tiles, 'tile_layout': {
+        'grid_width': grid_width, 'grid_height': grid_height}}
+    image_paths = sorted(str(p) for p in image_dir.iterdir())
+
+    # images abut without the overlap: nothing to register
+    with pytest.raises(ValueError):
+        stitch_layout(image_paths, metadata, str(tmp_path / "a.png"), cpu=1)
+    positions = stitch_layout(
+        image_paths, metadata, str(tmp_path / "b.png"), overlap=0.2, cpu=1)
+    moved = positions['2-2122'] - positions['2-2111']
+    assert np.allclose(moved, [grid_width + 6, grid_height - 5], atol=1)
+
+
+def test_morton_key_roundtrip():
+    tx = np.array([0, 1, 5, 4095])
+    ty = np.array([0, 2, 3, 1234])
+    keys = morton_key(tx, ty)
+    assert [tile_of_key(int(k), 12) for k in keys] == list(zip(tx, ty))
+    assert (keys >> np.uint64(2)).tolist() == \
+        morton_key(tx // 2, ty // 2).tolist()
+
+
+def test_create_tiles(tmp_path):
+    gdf = gpd.GeoDataFrame(
+        {'cnt_total': [1, 2, 3], 'gene_name': ['a', 'b', 'a']},
+        geometry=gpd.points_from_xy([1, 1, -1e6], [-1, -2, 1e6]),
+        crs='epsg:3857')
+    output = tmp_path / "sdge.mbtiles"
+    create_tiles(gdf, str(output), layer='all', minzoom=0, maxzoom=2, cpu=2)
+    with sqlite3.connect(output) as db:
+        tiles = db.execute(
+            "SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles "
+            "ORDER BY 1, 2, 3").fetchall()
+        metadata = dict(db.execute("SELECT name, value FROM metadata"))
+    # tile_row is flipped (TMS) in mbtiles
+    assert [t[:3] for t in tiles] == [
+        (0, 0, 0), (1, 0, 1), (1, 1, 0), (2, 1, 2), (2, 2, 1)]
+    assert json.loads(metadata['json'])['vector_layers'][0]['fields'] == \
+        {'cnt_total': 'Number', 'gene_name': 'String'}
+    # the point at (1, -1) is at the top-left pixel of its zoom 2 tile:
+    # MoveTo(1) command 9, zigzag(0), zigzag(0)
+    blob = gzip.decompress(tiles[-1][3])
+    assert bytes([0x22, 3, 9, 0, 0]) in blob
+
+
+def test_aggregate_points_conserves_counts():
+    properties = pd.DataFrame(
+        {'gene_name': ['a', None, 'b', None], 'cnt_total': [1, 2, 3, 4]})
+    qx, qy, df = _aggregate_points(
+        np.zeros(4, int), np.zeros(4, int), properties)
+    assert df['cnt_total'].sum() == 10
+    assert len(qx) == len(qy) == len(df) == 3
+    assert df.loc[df['gene_name'].isna(), 'cnt_total'].tolist() == [6]
+
+
+def test_create_tiles_polygon_across_tiles(tmp_path):
+    # a square across x=0, the edge of tiles (1, 0, 0) and (1, 1, 0)
+    square = box(-1e6, 1e6, 1e6, 2e6)
+    gdf = gpd.GeoDataFrame({'topK': [3]}, geometry=[square], crs='epsg:3857')
+    output = tmp_path / "factor.mbtiles"
+    create_tiles(gdf, str(output), layer='factor', minzoom=1, maxzoom=1, cpu=1)
+    with sqlite3.connect(output) as db:
+        tiles = db.execute(
+            "SELECT tile_column, tile_row, tile_data FROM tiles "
+            "ORDER BY 1").fetchall()
+    assert [t[:2] for t in tiles] == [(0, 1), (1, 1)]
+    # 1e6 in tile coordinates of a zoom 1 tile (ORIGIN wide)
+    d = round(1e6 / 20037508.342789244 * 4096)
+    # clipped to the tile extent (4096) plus a buffer of 64
+    expected = [(4096 - d, 4096 + 64), (-64, d)]
+    for (_, _, blob), (xmin, xmax) in zip(tiles, expected):
+        features = _decode_mvt(gzip.decompress(blob))
+        assert len(features) == 1
+        geom_type, rings = features[0]
+        assert geom_type == 3 and len(rings) == 1
+        xs = [x for x, _ in rings[0]]
+        assert (min(xs), max(xs)) == (xmin, xmax)
+
+
+def _decode_mvt(blob):
+    '''(geometry type, rings) of the features of a one-layer mvt tile'''
+    def varint(buf, i):
+        n, shift = 0, 0
+        while True:
+            n |= (buf[i] & 0x7f) << shift
+            shift += 7
+            i += 1
+            if buf[i - 1] < 0x80:
+                return n, i
+
+    def fields(buf):
+        i = 0
+        while i < len(buf):
+            key, i = varint(buf, i)
+            if key & 7 == 0:
+                value, i = varint(buf, i)
+            elif key & 7 == 1:
+                value, i = buf[i:i + 8], i + 8
+            else:
+                n, i = varint(buf, i)
+                value, i = buf[i:i + n], i + n
+            yield key >> 3, value
+
+    def packed(buf):
+        values, i = [], 0
+        while i < len(buf):
+            value, i = varint(buf, i)
+            values.append(value)
+        return values
+
+    [layer] = [v for k, v in fields(blob) if k == 3]
+    features = []
+    for feature in (v for k, v in fields(layer) if k == 2):
+        feature = dict(fields(feature))
+        geometry = packed(feature[4])
+        rings, x, y, i = [], 0, 0, 0
+        while i < len(geometry):
+            command, count = geometry[i] & 7, geometry[i] >> 3
+            i += 1
+            if command == 7:
+                continue
+            if command == 1:
+                rings.append([])
+            for _ in range(count):
+                dx, dy = geometry[i], geometry[i + 1]
+                x += (dx >> 1) ^ -(dx & 1)
+                y += (dy >> 1) ^ -(dy & 1)
+                rings[-1].append((x, y))
+                i += 2
+        features.append((feature[3], rings))
+    return features
+
+
 def test_factorde():
     df = pd.DataFrame(
         {
@@ -182,3 +1155,182 @@ def test_factorde():
     print(res)
     assert res == ans
 
+
+def test_factorde_matches_to_json():
+    rng = np.random.default_rng(0)
+    n = 200
+    df = pd.DataFrame({
+        'gene': [f"g{i}" for i in range(n)],
+        'factor': rng.integers(0, 4, n),
+        'Chi2': rng.uniform(0, 100, n),
+        'pval': rng.uniform(0, 1, n) * 10.0 ** -rng.integers(0, 20, n),
+        'FoldChange': rng.lognormal(0, 1, n),
+        'gene_tot': rng.integers(1, 10_000, n),
+    })
+    # the grouped to_json output the viewer was built on
+    expected = (df
+        .sort_values(['factor', 'Chi2'], ascending=False)
+        .groupby('factor')
+        .apply(lambda x: x.head(3).to_dict(orient='records'))
+    ).to_json(indent=2)
+    assert _conversion(df, topn=3) == expected
+
+
+def test_factorde_streaming(tmp_path):
+    rng = np.random.default_rng(0)
+    n = 500
+    df = pd.DataFrame({
+        'gene': [f"g{i}" for i in range(n)],
+        'factor': rng.integers(0, 5, n),
+        'Chi2': rng.permutation(n).astype(float),
+        'pval': rng.uniform(0, 1, n),
+    })
+    df.loc[3, 'pval'] = np.nan
+    src = tmp_path / "de.tsv.gz"
+    df.to_csv(src, sep="\t", index=False)
+    for topn in [0, 3]:
+        output = tmp_path / "de.json"
+        conversion(
+            src, output, topn, sidecar=tmp_path / "factors", chunksize=37)
+        with open(output) as f:
+            res = json.load(f)
+        expected = json.loads(df.sort_values(['factor', 'Chi2'], ascending=False)
+            .groupby('factor')
+            .apply(lambda x: x.head(topn).to_dict(orient='records') if topn
+                   else x.to_dict(orient='records'))
+            .to_json())
+        assert res.keys() == expected.keys()
+        for factor, records in expected.items():
+            assert [r['gene'] for r in res[factor]] == [r['gene'] for r in records]
+            assert np.allclose(
+                pd.DataFrame(res[factor])['pval'].astype(float),
+                pd.DataFrame(records)['pval'].astype(float), equal_nan=True)
+    side = pd.read_parquet(tmp_path / "factors" / "factor-2.parquet")
+    assert side['gene'].tolist() == [r['gene'] for r in res['2']]
+    assert _conversion(df.iloc[:0], topn=2) == "{}"
+
+
+
+def test_synthetic_dataset(tmp_path):
+    from cart.synthetic import generate
+    tile_dirs = generate(tmp_path, barcodes=500, genes=50, tiles=2, seed=1)
+    assert [d.name for d in tile_dirs] == ['2101', '2102']
+    df_matrix = read_matrix(tile_dirs[0] / "matrix.mtx.gz")
+    df_barcode = read_barcodes(tile_dirs[0] / "barcodes.tsv.gz")
+    df_feature = read_features(tile_dirs[0] / "features.tsv.gz")
+    assert len(df_barcode) == 500 and len(df_feature) == 50
+    assert (df_matrix['cnt_total'] > 0).all()
+    assert not df_matrix.duplicated(['gene_id', 'barcode_id']).any()
+    # barcode and feature totals agree with the matrix
+    totals = df_barcode['counts'].str.split(',', expand=True).astype(int).sum(axis=1)
+    assert totals.sum() == df_matrix['cnt_total'].sum()
+    tiles = extract_metadata_tiles(tmp_path)
+    assert sorted(tiles) == ['2-2101', '2-2102']
+    fit_result = next((tmp_path / "analysis").glob("*.fit_result.tsv.gz"))
+    assert len(xy_to_hexagon(read_centroid(str(fit_result)), 80)) > 0
+    de = pd.read_csv(tmp_path / "analysis" / "de.tsv.gz", sep="\t")
+    assert json.loads(_conversion(de, topn=2)).keys() == {str(k) for k in range(10)}
+
+
+def test_benchmark_compare(tmp_path):
+    from cart.benchmark import compare, run_case
+    from cart.synthetic import generate
+    generate(tmp_path / "data", barcodes=200, genes=20, tiles=1)
+    result = run_case('read_matrix', tmp_path / "data", tmp_path)
+    assert result['wall_s'] > 0 and result['peak_rss_mb'] >= 0
+    # the import and setup floor is not counted in the peak
+    assert result['setup_rss_mb'] > result['peak_rss_mb']
+    baseline = {'cases': {
+        'a': {'wall_s': 10.0, 'peak_rss_mb': 1000},
+        'b': {'wall_s': 0.01, 'peak_rss_mb': 100}}}
+    results = {'cases': {
+        'a': {'wall_s': 13.0, 'peak_rss_mb': 1100},
+        'b': {'wall_s': 0.03, 'peak_rss_mb': 110},
+        'c': {'wall_s': 1.0, 'peak_rss_mb': 100}}}
+    # a is 30% slower, b grew by less than the noise floor, c is new
+    assert compare(results, baseline) == [('a', 'wall_s', 10.0, 13.0)]
+    assert compare(results, baseline, time_tolerance=0.5) == []
+
+
+def test_run_stages_budget(tmp_path):
+    from cart.pipeline import Stage, run_stages
+    # each stage logs its start and end on the shared monotonic clock
+    sleep = [sys.executable, '-c',
+        'import time; print(time.monotonic(), flush=True); '
+        'time.sleep(0.3); print(time.monotonic())']
+
+    def stages():
+        return [
+            Stage('a', sleep, outputs=[]),
+            Stage('b', sleep, outputs=[]),
+            Stage('c', [sys.executable, '-c', 'raise SystemExit(1)'], deps=['a']),
+            Stage('d', sleep, deps=['c']),
+        ]
+
+    def overlap(state, *names):
+        logs = state.parent / 'logs'
+        (a_start, a_end), (b_start, b_end) = [
+            map(float, (logs / f"{n}.log").read_text().split()) for n in names]
+        return a_start < b_end and b_start < a_end
+
+    for cpu, overlaps in [(2, True), (1, False)]:
+        state = tmp_path / str(cpu) / "state.json"
+        status = run_stages(stages(), state, cpu=cpu)
+        assert status == {
+            'a': 'done', 'b': 'done', 'c': 'failed', 'd': 'blocked'}
+        assert overlap(state, 'a', 'b') == overlaps
+    # a stage larger than the memory budget runs alone, memory functions
+    # are resolved before the stage starts
+    big = stages()[:2]
+    big[0].memory = lambda: 10
+    state = tmp_path / "mem" / "state.json"
+    run_stages(big, state, cpu=2, max_memory=5, force=True)
+    assert big[0].memory == 10
+    assert not overlap(state, 'a', 'b')
+
+
+def test_pipeline(tmp_path):
+    from cart.pipeline import STATE_FILE, build_stages, run_stages
+    from cart.synthetic import generate
+    generate(tmp_path / "data", barcodes=300, genes=30, tiles=2)
+    with open(tmp_path / "markers.yaml", 'w') as f:
+        yaml.dump({'marker_sets': {'syn': {'top': 'Gene1, Gene2'}}}, f)
+    config = {
+        'dataset': 'syn',
+        'sdge_dir': str(tmp_path / "data"),
+        'output_dir': str(tmp_path / "out"),
+        'lane': 2,
+        'marker_yaml': str(tmp_path / "markers.yaml"),
+        'factor_result': str(next((tmp_path / "data" / "analysis").glob("*fit_result*"))),
+        'factor_de': str(tmp_path / "data" / "analysis" / "de.tsv.gz"),
+        'histology_path': 's3://bucket/histology.tif',
+        'cpu': 4,
+        'stages': {'convert': {'cpu': 3}},
+        'skip': ['hillshade', 'marker_tiles', 'factor_tiles', 'fetch_histology'],
+    }
+    stages = build_stages(config)
+    names = [s.name for s in stages]
+    # skipped stages and stages depending on them are left out
+    assert names == ['meta', 'convert', 'raster', 'filter', 'factor', 'factor_de']
+    convert = stages[names.index('convert')]
+    assert convert.cpu == 3 and convert.command[convert.command.index('-c') + 1] == '3'
+
+    state = tmp_path / "out" / STATE_FILE
+    status = run_stages(stages, state, cpu=4, max_memory=2**40)
+    assert set(status.values()) == {'done'}
+    # the wide stages got a memory estimate from their tiles
+    assert all(stages[names.index(n)].memory > 0 for n in ['meta', 'convert', 'raster'])
+    with fiona.open(tmp_path / "out" / "vector" / "marker.gpkg", layer='top') as f:
+        assert {feat['properties']['gene_name'] for feat in f} <= {'Gene1', 'Gene2'}
+    assert set(run_stages(stages, state, cpu=4).values()) == {'skipped'}
+
+    # only the stages downstream of a changed input run again
+    with open(tmp_path / "markers.yaml", 'w') as f:
+        yaml.dump({'marker_sets': {'syn': {'top': 'Gene1'}}}, f)
+    status = run_stages(stages, state, cpu=4, dry_run=True)
+    assert [n for n, s in status.items() if s == 'would run'] == ['filter']
+    status = run_stages(stages, state, cpu=4)
+    assert [n for n, s in status.items() if s == 'done'] == ['filter']
+    # rewriting metadata.yaml unchanged does not rerun convert
+    assert run_stages(stages[:1], state, cpu=4, force=True) == {'meta': 'done'}
+    assert set(run_stages(stages, state, cpu=4).values()) == {'skipped'}